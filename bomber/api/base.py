@@ -1,29 +1,252 @@
+import hashlib
 import logging
+import random
+import re
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from bomber.utils import TTLCache
+
+# 可以安全重试的请求
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUS = {502, 503, 504}
+
+# 每个 service 一个缓存、session 和熔断器，key-类
+_caches = {}
+_sessions = {}
+_breakers = {}
+_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    熔断期间直接失败，不再请求下游
+    是 ConnectionError 的子类，和下游连不上时 requests 抛出的异常一样处理，
+    只检查 resp.ok 的调用处遇到它和原来遇到连接失败的行为一致
+    """
+
+
+class CircuitBreaker(object):
+    """
+    连续失败 threshold 次后熔断 cooldown 秒，
+    之后放过一个请求试探，成功则恢复，失败继续熔断
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
 
 
 class BaseAPI(object):
-    def _request(self, method, endpoint, **kwargs):
+    """
+    每个 service 共用一个 requests.Session，复用连接
+    - timeout: 默认的 (连接, 读取) 超时秒数，调用时传 timeout 可以覆盖
+    - retries: 幂等请求在连接失败、超时和 502/503/504 时的重试次数，
+      按指数退避加随机抖动等待
+    - 连续 breaker_threshold 次调用失败后熔断 breaker_cooldown 秒，
+      期间直接抛出 CircuitOpenError；一次调用不论重试几次最多记一次失败，
+      只有最后一次尝试是连接失败、超时或 502/503/504 才算失败，
+      其他响应(包括 500 等)说明下游可用
+
+    cache_ttls: 可以缓存的 GET 接口，[(endpoint 正则, 秒数)]
+    - 只缓存成功的响应，key 是 endpoint、params 和 before_request 加上的
+      auth / headers，不同 token 的请求互不命中
+    - 缓存的是响应内容，每次命中返回新的 Response，调用处改动不影响缓存
+    - 缓存在进程内，invalidate 只清理当前进程，其他进程和 worker
+      最多在 ttl 秒内读到旧数据，会变的接口 ttl 要设得短
+    """
+    timeout = (3, 30)
+    retries = 2
+    backoff = 0.2
+    backoff_max = 5
+    pool_size = 20
+    breaker_threshold = 5
+    breaker_cooldown = 30
+
+    cache_ttls = []
+    cache_size = 10000
+
+    @classmethod
+    def _session(cls):
+        session = _sessions.get(cls)
+        if session is None:
+            with _lock:
+                session = _sessions.get(cls)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=cls.pool_size,
+                                          pool_maxsize=cls.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    _sessions[cls] = session
+        return session
+
+    @classmethod
+    def _breaker(cls):
+        breaker = _breakers.get(cls)
+        if breaker is None:
+            breaker = _breakers.setdefault(
+                cls, CircuitBreaker(cls.breaker_threshold,
+                                    cls.breaker_cooldown))
+        return breaker
+
+    @classmethod
+    def _cache(cls):
+        cache = _caches.get(cls)
+        if cache is None:
+            cache = _caches.setdefault(cls, TTLCache(max_size=cls.cache_size))
+        return cache
+
+    @classmethod
+    def cache_ttl(cls, endpoint):
+        for pattern, ttl in cls.cache_ttls:
+            if re.match(pattern, endpoint):
+                return ttl
+        return 0
+
+    @staticmethod
+    def _cache_params(params):
+        return tuple(sorted((params or {}).items()))
+
+    @classmethod
+    def _cache_key(cls, endpoint, kwargs):
+        """ (endpoint, params, 调用方身份) """
+        auth = kwargs.get('auth')
+        if isinstance(auth, list):
+            auth = tuple(auth)
+        headers = tuple(sorted((kwargs.get('headers') or {}).items()))
+        identity = repr((auth, headers)).encode('utf-8')
+        return (endpoint,
+                cls._cache_params(kwargs.get('params')),
+                hashlib.sha1(identity).hexdigest())
+
+    @staticmethod
+    def _cache_value(result):
+        return (result.status_code, result.url, result.encoding,
+                tuple(result.headers.items()), result.content)
+
+    @staticmethod
+    def _cached_response(value):
+        response = requests.Response()
+        (response.status_code, response.url, response.encoding,
+         headers, response._content) = value
+        response.headers = CaseInsensitiveDict(headers)
+        return response
+
+    @classmethod
+    def invalidate(cls, endpoint=None, params=None):
+        """
+        不传 endpoint 时清空整个 service 的缓存，
+        否则删除所有调用方对这个 endpoint 和 params 的缓存，只对当前进程有效
+        """
+        if endpoint is None:
+            cls._cache().clear()
+        else:
+            key = endpoint, cls._cache_params(params)
+            cls._cache().remove(lambda cached: cached[:2] == key)
+
+    @classmethod
+    def cache_stats(cls):
+        cache = cls._cache()
+        return {'hits': cache.hits, 'misses': cache.misses,
+                'size': len(cache)}
+
+    def _request(self, method, endpoint, cache_ttl=0, **kwargs):
         kwargs['method'] = method
 
         request_url = '%s%s' % (self.get_base_url(), endpoint)
         kwargs['url'] = request_url
 
         self.before_request(kwargs)
-        result = requests.request(**kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+
+        key = None
+        if cache_ttl:
+            key = self._cache_key(endpoint, kwargs)
+            cached = self._cache().get(key)
+            if cached is not None:
+                return self._cached_response(cached)
+
+        result = self._send(kwargs)
         if not result.ok:
             logging.error('request to %s (%s) failed: %s',
                           self.__class__.__name__, request_url, result.text)
+        elif key is not None:
+            self._cache().set(key, self._cache_value(result), cache_ttl)
         return result
 
+    def _send(self, kwargs):
+        name = self.__class__.__name__
+        breaker = self._breaker()
+        if not breaker.allow():
+            raise CircuitOpenError('%s circuit open, skip %s' %
+                                   (name, kwargs['url']))
+
+        attempts = 1
+        if kwargs['method'] in IDEMPOTENT_METHODS:
+            attempts += self.retries
+        for attempt in range(attempts):
+            if attempt:
+                delay = min(self.backoff_max, self.backoff * 2 ** attempt)
+                time.sleep(random.uniform(0, delay))
+            last = attempt + 1 >= attempts
+            try:
+                result = self._session().request(**kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if last:
+                    breaker.failure()
+                    raise
+                logging.warning('request to %s (%s) error, retry: %s',
+                                name, kwargs['url'], str(e))
+                continue
+
+            if result.status_code not in RETRY_STATUS:
+                breaker.success()
+                return result
+            if last:
+                breaker.failure()
+                return result
+            logging.warning('request to %s (%s) status %s, retry',
+                            name, kwargs['url'], result.status_code)
+
     def get_base_url(self):
         raise NotImplementedError
 
     def before_request(self, kwargs):
         pass
 
-    def get(self, endpoint, params=None, **kwargs):
-        return self._request('GET', endpoint, params=params, **kwargs)
+    def get(self, endpoint, params=None, cache=True, **kwargs):
+        ttl = self.cache_ttl(endpoint) if cache else 0
+        return self._request('GET', endpoint, cache_ttl=ttl, params=params,
+                             **kwargs)
 
     def post(self, endpoint, data=None, json=None, **kwargs):
         return self._request('POST', endpoint, data=data, json=json, **kwargs)
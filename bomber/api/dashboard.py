@@ -6,6 +6,10 @@ app = default_app()
 
 
 class Dashboard(BaseServiceAPI):
+    cache_ttls = [
+        (r'^/users/\d+/apply-history$', 60),
+    ]
+
     def default_token(self):
         return app.config['service.dashboard.token']
 
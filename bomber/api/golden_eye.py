@@ -6,6 +6,12 @@ app = default_app()
 
 
 class GoldenEye(BaseServiceAPI):
+    # 用户可以修改号码，extra-phone 只短时间缓存
+    cache_ttls = [
+        (r'^/applications/\d+$', 120),
+        (r'^/users/\d+/extra-phone$', 30),
+    ]
+
     def default_token(self):
         return app.config['service.golden_eye.token']
 
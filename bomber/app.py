@@ -10,6 +10,8 @@ from bomber.plugins import UserPlugin
 
 from bomber.plugins import ApiUserPlugin, ip_whitelist_plugin
 from bomber.plugins.application_plugin import ApplicationPlugin
+from bomber.metrics import enable_multiprocess
+from bomber.plugins.metrics_plugin import metrics_plugin
 from bomber.plugins.packing_plugin import logging_plugin
 from bomber.utils import env_detect
 from bomber.error import register_error_handler
@@ -78,6 +80,7 @@ def install_plugins():
     app.install(ApplicationPlugin())
     app.install(logging_plugin)
     app.install(ip_whitelist_plugin)
+    app.install(metrics_plugin)
 
 
 def base_config():
@@ -86,8 +89,17 @@ def base_config():
     db.init()
 
 
+def init_metrics():
+    # gunicorn 多进程时汇总各个 worker 的指标，见 bomber.metrics
+    directory = app.config.get('metrics.multiprocess_dir')
+    if directory:
+        enable_multiprocess(
+            directory, float(app.config.get('metrics.snapshot_interval', 5)))
+
+
 def init_app():
     base_config()
+    init_metrics()
 
     load_controllers()
     install_plugins()
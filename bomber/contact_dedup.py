@@ -0,0 +1,82 @@
+"""
+total_contact 去重，由 worker.drop_duplicated_contact 使用
+
+同一个 (sn, dn, s) 只保留一条：
+- 有非反转(is_c=False)的记录时保留其中 tc、td 最大的一条，
+  并保证反向 (dn, sn, s) 有一条反转记录
+- 只有反转记录时保留 tc、td 最大的一条，反向的非反转记录更大时用它替换
+- sn == dn 的记录全部删除
+
+排序和分组在 mongo 中完成(dedup_pipeline)，每个 (sn, dn, s) 只返回最好的一条
+和所有 id，正反两个方向放在同一个结果里，worker 逐条用 resolve_contact_edges
+处理，不需要把所有记录读到内存
+"""
+
+
+def dedup_pipeline(numbers):
+    return [
+        {'$match': {'$or': [{'sn': {'$in': numbers}},
+                            {'dn': {'$in': numbers}}]}},
+        {'$project': {'sn': 1, 'dn': 1, 's': 1, 'sa': 1, 'da': 1,
+                      'tc': {'$ifNull': ['$tc', 1]},
+                      'td': {'$ifNull': ['$td', 0]},
+                      'is_c': {'$ifNull': ['$is_c', False]}}},
+        # 非反转的优先，再按 tc、td 倒序
+        {'$sort': {'is_c': 1, 'tc': -1, 'td': -1}},
+        {'$group': {'_id': {'sn': '$sn', 'dn': '$dn', 's': '$s'},
+                    'best': {'$first': '$$ROOT'},
+                    'ids': {'$push': '$_id'}}},
+        # 正反两个方向合到一起
+        {'$group': {'_id': {'a': {'$min': ['$_id.sn', '$_id.dn']},
+                            'b': {'$max': ['$_id.sn', '$_id.dn']},
+                            's': '$_id.s'},
+                    'edges': {'$push': {'best': '$best', 'ids': '$ids'}}}},
+    ]
+
+
+def reverse_contact(doc):
+    return {
+        'src_number': doc['dn'],
+        'dest_number': doc['sn'],
+        'src_name': doc.get('da'),
+        'dest_name': doc.get('sa'),
+        'total_count': doc['tc'],
+        'total_duration': doc['td'],
+        'source': doc['s'],
+        'is_calc': True,
+    }
+
+
+def _rank(doc):
+    return doc['tc'], doc['td']
+
+
+def resolve_contact_edges(edges):
+    """
+    edges: dedup_pipeline 返回的一条结果中的 edges
+    返回 (要删除的 id, 要插入的 TotalContact 字段)
+    """
+    by_key = {(e['best']['sn'], e['best']['dn']): e for e in edges}
+    delete_ids, insert_list = [], []
+    for (sn, dn), edge in by_key.items():
+        best = edge['best']
+        others = [i for i in edge['ids'] if i != best['_id']]
+        if sn == dn:
+            delete_ids.extend(edge['ids'])
+            continue
+
+        reverse = by_key.get((dn, sn))
+        if not best['is_c']:
+            delete_ids.extend(others)
+            if reverse is None:
+                insert_list.append(reverse_contact(best))
+            continue
+
+        # 只有反转记录，反向的非反转记录更大时用它重新生成
+        if (reverse and not reverse['best']['is_c'] and
+                _rank(reverse['best']) > _rank(best)):
+            delete_ids.extend(edge['ids'])
+            insert_list.append(reverse_contact(reverse['best']))
+        else:
+            delete_ids.extend(others)
+    return delete_ids, insert_list
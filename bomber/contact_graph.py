@@ -0,0 +1,134 @@
+"""
+联系人关系图，存在 contact_edge 中(models.ContactEdge)
+
+total_contact 中的每条非反转关系 sn -> dn 在 contact_edge 中存两条：
+(n=sn, c=dn, o=True) 和 (n=dn, c=sn, o=False)
+- 查询某个号码的所有联系人只需要按 n 查询，不需要 sn/dn 的 or 查询，
+  get_contact_from_mongo 在 worker.contact_graph_read 打开后用它
+- import_contact_to_mon 写 total_contact 时同步增量更新，
+  drop_duplicated_contact 去重后同步通话次数和时长、删除自己到自己的边，
+  历史数据用 scripts/build_contact_graph.py 导入
+- sn == dn 的关系不写入
+- 按 (n, -td) 索引取通话时长最长的前 k 个联系人，不需要读出所有的边
+"""
+import logging
+
+from pymongo import DeleteMany, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from bomber.models import ContactEdge
+
+PROJECTION = {'_id': 0, 'c': 1, 'na': 1, 's': 1, 'o': 1, 'tc': 1, 'td': 1}
+
+# mongo 的重复 key 错误码
+DUPLICATE_KEY = 11000
+
+
+def _edge_operations(src_number, dest_number, source, total_count,
+                     total_duration, src_name, dest_name, overwrite):
+    if not (src_number and dest_number) or src_number == dest_number:
+        return []
+    operations = []
+    for number, counterparty, name, outgoing in (
+            (src_number, dest_number, dest_name, True),
+            (dest_number, src_number, src_name, False)):
+        key = {'n': number, 'c': counterparty, 's': source, 'o': outgoing}
+        doc = ContactEdge(number=number,
+                          counterparty=counterparty,
+                          name=name,
+                          source=source,
+                          outgoing=outgoing,
+                          total_count=total_count,
+                          total_duration=total_duration).to_mongo()
+        doc = {k: v for k, v in doc.items() if k not in key}
+        update = {'$setOnInsert': doc}
+        if overwrite:
+            weight = {'tc': doc.pop('tc'), 'td': doc.pop('td')}
+            update['$set'] = weight
+        operations.append(UpdateOne(key, update, upsert=True))
+    return operations
+
+
+def add_edge_operations(src_number, dest_number, source, total_count=1,
+                        total_duration=0, src_name=None, dest_name=None):
+    """ 新增一条关系的两个方向，已经存在的不覆盖 """
+    return _edge_operations(src_number, dest_number, source, total_count,
+                            total_duration, src_name, dest_name, False)
+
+
+def sync_edge_operations(src_number, dest_number, source, total_count,
+                         total_duration, src_name=None, dest_name=None):
+    """ 按 total_contact 中保留的记录更新通话次数和时长，缺少的边补上 """
+    return _edge_operations(src_number, dest_number, source, total_count,
+                            total_duration, src_name, dest_name, True)
+
+
+def remove_self_loop_operations(numbers):
+    """ 删除以前导入的自己到自己的边 """
+    return [DeleteMany({'n': number, 'c': number}) for number in numbers]
+
+
+def update_weight_operations(src_number, dest_number, total_count,
+                             total_duration):
+    """ 更新两个号码之间所有来源的通话次数和时长 """
+    weight = {'$set': {'tc': total_count, 'td': total_duration}}
+    return [
+        UpdateMany({'n': src_number, 'c': dest_number, 'o': True}, weight),
+        UpdateMany({'n': dest_number, 'c': src_number, 'o': False}, weight),
+    ]
+
+
+def apply_operations(operations):
+    """
+    并发 upsert 同一条边时 mongo 会报重复 key，这些操作重试一次，
+    重试时边已经存在，按普通的 update 执行
+    """
+    if not operations:
+        return None
+    collection = ContactEdge._get_collection()
+    try:
+        return collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY for error in errors):
+            raise
+        logging.info('contact edge duplicated, retry %s operations',
+                     len(errors))
+        retry = [operations[error['index']] for error in errors]
+        return collection.bulk_write(retry, ordered=False)
+
+
+def _edge(doc):
+    return {
+        'number': doc['c'],
+        'name': doc.get('na'),
+        'source': doc.get('s'),
+        'outgoing': doc.get('o', True),
+        'total_count': doc.get('tc', 1),
+        'total_duration': doc.get('td', 0),
+    }
+
+
+def counterparties(number, sources=None):
+    """
+    号码的所有联系人，同一个号码的不同来源各一条，按来源排序
+    sources 不为空时只返回这些来源的
+    """
+    query = {'n': number}
+    if sources is not None:
+        query['s'] = {'$in': list(sources)}
+    cursor = (ContactEdge
+              ._get_collection()
+              .find(query, PROJECTION)
+              .sort('s', 1))
+    return [_edge(doc) for doc in cursor]
+
+
+def top_counterparties(number, k=10):
+    """ 按通话时长倒序的前 k 个联系人 """
+    cursor = (ContactEdge
+              ._get_collection()
+              .find({'n': number}, PROJECTION)
+              .sort('td', -1)
+              .limit(k))
+    return [_edge(doc) for doc in cursor]
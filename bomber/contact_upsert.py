@@ -0,0 +1,141 @@
+from collections import OrderedDict
+
+from peewee import Case
+
+from bomber.constant_mapping import SubRelation
+from bomber.db import db
+from bomber.models import Contact
+from bomber.phone import normalize_number
+
+# 每条 insert / update 语句最多带的号码个数
+CHUNK_SIZE = 500
+
+
+class ContactUpsert(object):
+    """
+    批量写入某个用户的联系人
+
+        upsert = ContactUpsert(user_id)
+        upsert.add(number, name, relationship, source)
+        upsert.update_frequency(number, total_count, total_duration)
+        counts = upsert.flush()
+
+    - 创建时一次查询该用户已有的号码，之后的去重都在内存中完成，
+      先 add 的号码优先
+    - flush 时在一个事务里 insert_many 新号码，通话频率用 CASE 一次更新，
+      可以多次 flush，total 记录累计的条数
+    - 号码默认用 normalize_number 规范化，已有的号码也按同样的方式规范化后
+      去重，更新通话频率时更新库里原来的号码；已经规范化过的传 strip=False
+    """
+
+    def __init__(self, user_id, numbers=None, strip=True):
+        self.user_id = user_id
+        self.strip = strip
+        # 规范化后的号码 -> 库里的号码
+        # numbers 不为空时只查询这些号码是否已经存在
+        self.existing = {}
+        if numbers is None or numbers:
+            query = (Contact.select(Contact.number)
+                     .where(Contact.user_id == user_id))
+            if numbers:
+                query = query.where(Contact.number << list(numbers))
+            for number, in query.tuples():
+                self.existing.setdefault(self.normalize(number),
+                                         []).append(number)
+        # number -> row，保持添加顺序
+        self.inserts = OrderedDict()
+        # number -> (total_count, total_duration)
+        self.frequencies = OrderedDict()
+        self.skipped = 0
+        self.total = {'inserted': 0, 'updated': 0, 'skipped': 0}
+
+    def normalize(self, number):
+        if number is None:
+            return ''
+        if not self.strip:
+            return str(number)[:64]
+        return normalize_number(str(number))[:64]
+
+    def exists(self, number):
+        number = self.normalize(number)
+        return bool(number) and (number in self.existing or
+                                 number in self.inserts)
+
+    def add(self, number, name, relationship, source,
+            sub_relation=SubRelation.UNKNOWN.value, total_count=None,
+            total_duration=None, real_relationship=None):
+        """ 号码是新的返回规范化后的号码，否则返回 None """
+        number = self.normalize(number)
+        if not number or number in self.existing or number in self.inserts:
+            self.skipped += 1
+            return None
+
+        if real_relationship is None:
+            real_relationship = relationship
+        self.inserts[number] = {
+            'user_id': self.user_id,
+            'name': name[:128] if name else name,
+            'number': number,
+            'relationship': relationship,
+            'sub_relation': sub_relation,
+            'source': source,
+            'total_count': total_count,
+            'total_duration': total_duration,
+            'real_relationship': real_relationship,
+        }
+        return number
+
+    def update_frequency(self, number, total_count, total_duration):
+        """ 更新已有号码的通话次数和时长，号码不存在返回 None """
+        number = self.normalize(number)
+        if number in self.inserts:
+            self.inserts[number]['total_count'] = total_count
+            self.inserts[number]['total_duration'] = total_duration
+            return number
+        if number and number in self.existing:
+            self.frequencies[number] = total_count, total_duration
+            return number
+        return None
+
+    def flush(self):
+        """
+        写入数据库，返回这次写入的 {'inserted', 'updated', 'skipped'}
+        写入失败时抛出异常，这次的号码不会留到下次 flush
+        """
+        rows = list(self.inserts.values())
+        # 同一个号码库里可能有多种写法，都要更新
+        frequencies = [(stored, frequency)
+                       for number, frequency in self.frequencies.items()
+                       for stored in self.existing[number]]
+        counts = {'inserted': len(rows),
+                  'updated': len(frequencies),
+                  'skipped': self.skipped}
+        self.inserts = OrderedDict()
+        self.frequencies = OrderedDict()
+        self.skipped = 0
+        if rows or frequencies:
+            with db.atomic():
+                for idx in range(0, len(rows), CHUNK_SIZE):
+                    Contact.insert_many(rows[idx:idx + CHUNK_SIZE]).execute()
+                for idx in range(0, len(frequencies), CHUNK_SIZE):
+                    self._update_frequencies(
+                        frequencies[idx:idx + CHUNK_SIZE])
+
+        for row in rows:
+            self.existing[row['number']] = [row['number']]
+        for key, value in counts.items():
+            self.total[key] += value
+        return counts
+
+    def _update_frequencies(self, frequencies):
+        total_count = Case(Contact.number,
+                           [(number, count)
+                            for number, (count, _) in frequencies])
+        total_duration = Case(Contact.number,
+                              [(number, duration)
+                               for number, (_, duration) in frequencies])
+        (Contact
+         .update(total_count=total_count, total_duration=total_duration)
+         .where(Contact.user_id == self.user_id,
+                Contact.number << [number for number, _ in frequencies])
+         .execute())
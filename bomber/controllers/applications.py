@@ -49,6 +49,7 @@ from bomber.utils import (
     plain_query
 )
 from bomber.controllers.asserts import late_fee_limit
+from bomber.overdue_days import application_overdue_days
 
 
 @get('/api/v1/applications/unclaimed')
@@ -58,7 +59,7 @@ def unclaimed(bomber):
         Application.latest_bomber >> None,
         Application.cycle <<
         ([bomber.role.cycle] if bomber.role.cycle else Cycle.values()),
-    ).order_by(-Application.overdue_days, Application.apply_at)
+    ).order_by(-application_overdue_days(), Application.apply_at)
     data = (BillService()
             .get_base_applications(apps,
                                    application_serializer,
@@ -309,7 +310,8 @@ def processing(bomber):
                     .alias('entry_at'),
                     fn.MAX(DispatchAppHistoryR.expected_out_time)
                     .alias('expected_out_time'),
-                    ApplicationR.overdue_days,
+                    application_overdue_days(ApplicationR)
+                    .alias('overdue_days'),
                     ApplicationR.amount_net,
                     fn.Date(ApplicationR.promised_date)
                     .alias('promised_date'),
@@ -342,7 +344,8 @@ def processing(bomber):
                       ApplicationR.external_id,
                       sub1.c.created_at.alias('entry_at'),
                       ApplicationR.promised_date.alias('expected_out_time'),
-                      ApplicationR.overdue_days,
+                      application_overdue_days(ApplicationR)
+                      .alias('overdue_days'),
                       ApplicationR.amount_net,
                       fn.Date(ApplicationR.promised_date).alias('promised_date'),
                       fn.Date(ApplicationR.follow_up_date).alias('follow_up_date'),
@@ -434,7 +437,8 @@ def processing(bomber):
     if 'mobile' in args:
         apps = apps.where(ApplicationR.user_mobile_no == args.mobile)
     if 'overdue_days' in args:
-        apps = apps.where(ApplicationR.overdue_days == args.overdue_days)
+        apps = apps.where(application_overdue_days(ApplicationR) ==
+                          args.overdue_days)
     if 'promised' in args:
         apps = apps.where(
             ApplicationR.promised_date.is_null(
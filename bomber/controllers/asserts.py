@@ -34,6 +34,7 @@ from bomber.constant_mapping import (
 )
 
 from bomber.utils import get_cycle_by_overdue_days
+from bomber.overdue_days import actual_overdue_days
 
 def late_fee_limit(cycle):
     # 罚金减免上限
@@ -164,7 +165,7 @@ def auto_call_ptp(promised_amount, promised_date,
     if promised_date < datetime.now().date():
         abort(400, 'promise date invalid')
 
-    new_cycle = get_cycle_by_overdue_days(application.overdue_days)
+    new_cycle = get_cycle_by_overdue_days(actual_overdue_days(application))
     if new_cycle > application.cycle:
         abort(400, 'Can not extend PTP')
 
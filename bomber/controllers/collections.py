@@ -27,6 +27,7 @@ from bomber.serializers import (
 from bomber.validator import collection_validator, cs_ptp_validator
 from bomber.controllers.asserts import set_ptp_for_special_bomber
 from bomber.utils import get_cycle_by_overdue_days
+from bomber.overdue_days import actual_overdue_days
 
 
 @get('/api/v1/applications/<app_id:int>/collection_history')
@@ -59,7 +60,8 @@ def add_collection_history(bomber, application):
                            if 'promised_amount' in form
                            else None)
         if promised_date:
-            real_cycle = get_cycle_by_overdue_days(application.overdue_days)
+            real_cycle = get_cycle_by_overdue_days(
+                actual_overdue_days(application))
             if real_cycle > application.cycle:
                 abort(400, 'Can not extend PTP')
         bombing_history = BombingHistory.create(
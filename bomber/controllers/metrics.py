@@ -0,0 +1,12 @@
+from bottle import get, response
+
+from bomber.metrics import CONTENT_TYPE, multiprocess_dir, render_all
+from bomber.plugins import packing_plugin
+from bomber.plugins.packing_plugin import logging_plugin
+from bomber.plugins.metrics_plugin import metrics_plugin
+
+
+@get('/metrics', skip=[packing_plugin, logging_plugin, metrics_plugin])
+def get_metrics():
+    response.set_header('Content-Type', CONTENT_TYPE)
+    return render_all(multiprocess_dir())
@@ -11,6 +11,7 @@ from bomber.serializers import template_serializer
 from bomber.api import BillService
 from bomber.utils import to_datetime
 from bomber.models_readonly import ConnectHistoryR
+from bomber.overdue_days import actual_overdue_days
 
 cs_number_conf = {
     'DanaCepat': '02150202889',
@@ -35,7 +36,7 @@ def get_sms_templates(bomber, application):
     total_amount = round(application.amount + bill_dict['late_fee'], 2)
     data = {
         'user_name': application.user_name,
-        'overdue_days': application.overdue_days,
+        'overdue_days': actual_overdue_days(application),
         'promised_date': promise_date.strftime('%d-%m-%Y'),
         'due_at': bill_dict['due_at'].strftime('%d-%m-%Y'),
         'targe_date': promise_date.strftime('%d-%m-%Y'),
@@ -63,7 +64,7 @@ def get_call_templates(bomber, application):
     total_amount = round(application.amount + application.late_fee, 2)
     data = {
         'user_name': application.user_name,
-        'overdue_days': application.overdue_days,
+        'overdue_days': actual_overdue_days(application),
         'promised_date': promise_date.strftime('%d-%m-%Y'),
         'unpaid': 'Rp{:,}'.format(round(application.unpaid, 2)),
         'total_amount': 'Rp{:,}'.format(total_amount),
@@ -88,7 +89,7 @@ def get_pay_method(bomber, application):
     total_amount = round(application.amount + bill_dict['late_fee'], 2)
     data = {
         'user_name': application.user_name,
-        'overdue_days': application.overdue_days,
+        'overdue_days': actual_overdue_days(application),
         'promised_date': promise_date.strftime('%d-%m-%Y'),
         'unpaid': 'Rp{:,}'.format(round(bill_dict['unpaid'], 2)),
         'total_amount': 'Rp{:,}'.format(total_amount),
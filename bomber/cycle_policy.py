@@ -0,0 +1,80 @@
+"""
+逾期天数和 cycle 的对应关系，按逾期天数判断 cycle 的地方都用这里
+
+    C1A 1-10  C1B 11-30  C2 31-60  C3 61-90  M3 91+
+
+- cycle_of: 单个逾期天数，bisect 查找
+- cycles_of: 一次计算 list 或 numpy 数组 / pandas Series
+- cycle_case: 在数据库里计算 cycle 的 CASE 表达式
+"""
+from bisect import bisect_right
+
+from bomber.constant_mapping import Cycle
+
+# 超过这个天数的不属于任何 cycle
+MAX_OVERDUE_DAYS = 999999
+
+CYCLES = (Cycle.C1A.value, Cycle.C1B.value, Cycle.C2.value,
+          Cycle.C3.value, Cycle.M3.value)
+# 每个 cycle 的第一天，和 CYCLES 一一对应
+CYCLE_START_DAYS = (1, 11, 31, 61, 91)
+# 每个 cycle 的最后一天，M3 没有
+CYCLE_END_DAYS = dict(zip(CYCLES, [day - 1 for day in CYCLE_START_DAYS[1:]]))
+
+# 逾期天数进入对应阶段时记录时间的字段
+ENTRY_START_DAYS = (1, 4, 11, 31, 61, 91)
+ENTRY_FIELDS = ('dpd1_entry', 'C1A_entry', 'C1B_entry', 'C2_entry',
+                'C3_entry', None)
+
+# 升级到这些 cycle 时记录进入时间
+CYCLE_ENTRY_FIELDS = {
+    Cycle.C1B.value: 'C1B_entry',
+    Cycle.C2.value: 'C2_entry',
+    Cycle.C3.value: 'C3_entry',
+}
+
+
+def cycle_of(overdue_days, default=0):
+    """ 逾期天数对应的 cycle，不在任何 cycle 中返回 default """
+    if overdue_days > MAX_OVERDUE_DAYS:
+        return default
+    idx = bisect_right(CYCLE_START_DAYS, overdue_days)
+    return CYCLES[idx - 1] if idx else default
+
+
+def cycles_of(overdue_days, default=0):
+    """ list 返回 list，numpy 数组和 pandas Series 用 searchsorted 返回数组 """
+    if not hasattr(overdue_days, '__array__'):
+        return [cycle_of(days, default) for days in overdue_days]
+
+    import numpy as np
+    days = np.asarray(overdue_days)
+    table = np.array((default,) + CYCLES)
+    cycles = table[np.searchsorted(CYCLE_START_DAYS, days, side='right')]
+    cycles[days > MAX_OVERDUE_DAYS] = default
+    return cycles
+
+
+def cycle_case(overdue_days, default=0):
+    """
+    overdue_days 为字段或表达式，如 Application.overdue_days，
+    返回计算 cycle 的 CASE 表达式
+    """
+    from peewee import Case
+
+    return Case(None,
+                [(overdue_days.between(
+                    start, CYCLE_END_DAYS.get(cycle, MAX_OVERDUE_DAYS)), cycle)
+                 for cycle, start in zip(CYCLES, CYCLE_START_DAYS)],
+                default)
+
+
+def cycle_end_day(cycle, default=None):
+    """ cycle 的最后一天，用于计算预计出案时间，M3 返回 default """
+    return CYCLE_END_DAYS.get(cycle, default)
+
+
+def entry_field(overdue_days):
+    """ 逾期天数所在阶段的进入时间字段，不在任何阶段中返回 None """
+    idx = bisect_right(ENTRY_START_DAYS, overdue_days)
+    return ENTRY_FIELDS[idx - 1] if idx else None
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError
+
+from bomber.models import ProcessedMessage
+from bomber.utils import TTLCache
+
+# mongo 的重复 key 错误码
+DUPLICATE_KEY = 11000
+
+
+class IdempotencyStore(object):
+    """
+    sqs 至少投递一次，worker 用它过滤重复投递的消息
+
+        if store.processed(keys):
+            # 已经处理过，删除消息
+        elif store.claim(keys):
+            try:
+                ...
+            except:
+                store.release(keys)
+            else:
+                store.done(keys, action)
+        else:
+            # 本进程正在执行，不删除，可见性超时后重新投递
+
+    - processed 先查进程内的 LRU 缓存，未命中时按 _id 查一次 processed_message
+    - 只有执行成功后 done 才写入 processed_message，
+      执行失败或进程被强制杀掉时没有记录，重新投递的消息会再次执行
+    - claim 只在进程内占用，避免同一进程同时执行内容相同的消息；
+      不同 worker 同时执行同一条消息由 sqs 的可见性超时保证
+    - mongo 中的记录由 ttl 索引在 expire_at 之后自动删除
+    """
+
+    def __init__(self, ttl=86400, cache_size=10000, durable=True):
+        self.ttl = int(ttl)
+        self.durable = durable
+        self._cache = TTLCache(max_size=int(cache_size), ttl=self.ttl)
+        self._running = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def message_key(action, msg_id):
+        return 'msg:%s:%s' % (action, msg_id)
+
+    @staticmethod
+    def content_key(action, payload):
+        content = json.dumps(payload, sort_keys=True, default=str)
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        return 'content:%s:%s' % (action, digest)
+
+    def seen(self, key):
+        """ 只查进程内缓存 """
+        return key in self._cache
+
+    def processed(self, keys):
+        """ 任一 key 已经执行成功过时返回 True """
+        if any(self.seen(key) for key in keys):
+            return True
+        if not self.durable:
+            return False
+
+        try:
+            found = [doc['_id'] for doc in (ProcessedMessage
+                                            ._get_collection()
+                                            .find({'_id': {'$in': keys}},
+                                                  {'_id': 1}))]
+        except Exception as e:
+            # 去重只是优化，查询失败时按未处理过继续执行
+            logging.error('check processed message %s error: %s',
+                          keys, str(e))
+            return False
+        for key in found:
+            self._cache.set(key, True)
+        return bool(found)
+
+    def claim(self, keys):
+        """ 本进程没有在执行同样的消息时返回 True 并占用 keys """
+        with self._lock:
+            if self._running.intersection(keys):
+                return False
+            self._running.update(keys)
+        return True
+
+    def done(self, keys, action=None):
+        """ 执行成功后记录，之后重新投递的消息会被跳过 """
+        if self.durable:
+            self._insert(keys, action)
+        for key in keys:
+            self._cache.set(key, True)
+        self.release(keys)
+
+    def release(self, keys):
+        with self._lock:
+            self._running.difference_update(keys)
+
+    def _insert(self, keys, action):
+        expire_at = datetime.now() + timedelta(seconds=self.ttl)
+        documents = [ProcessedMessage(key=key,
+                                      action=action,
+                                      expire_at=expire_at).to_mongo()
+                     for key in keys]
+        try:
+            (ProcessedMessage
+             ._get_collection()
+             .insert_many(documents, ordered=False))
+        except BulkWriteError as e:
+            # 内容相同的消息已经由其他 worker 记录过
+            errors = [error for error in e.details.get('writeErrors', [])
+                      if error.get('code') != DUPLICATE_KEY]
+            if errors:
+                logging.error('record processed message %s error: %s',
+                              keys, errors)
+        except Exception as e:
+            logging.error('record processed message %s error: %s',
+                          keys, str(e))
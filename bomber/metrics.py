@@ -0,0 +1,290 @@
+"""
+进程内的监控指标，按 prometheus 文本格式输出
+
+- worker 在 run_worker 中记录每个 action 的耗时、成功失败次数和执行中的个数，
+  通过 serve 启动的 http 服务暴露
+- web 进程通过 /metrics 接口暴露
+
+registry 是进程内的，gunicorn 多个 worker 进程时每次抓取只能拿到其中一个进程的值。
+配置 metrics.multiprocess_dir 后每个进程定期把自己的值写到这个目录
+(SnapshotWriter)，/metrics 汇总目录中所有进程的值(render_all)：
+- counter / histogram 累加，已退出进程的值保留
+- gauge 只累加最近 max_age 秒内更新过的进程
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# 秒，action 中有执行几十分钟的任务
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                   300, 900, 3600)
+
+
+def _labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + list(extra or [])
+    if not items:
+        return ''
+    pairs = ['%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+             for k, v in items]
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class MetricsRegistry(object):
+    """ 线程安全的 counter / gauge / histogram 集合 """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta = {}
+        # name -> {labels_key: value}
+        self._values = defaultdict(dict)
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._meta:
+            self._meta[name] = (kind, help_text or name)
+
+    def inc(self, name, labels=None, value=1, help_text=None):
+        key = _labels_key(labels)
+        with self._lock:
+            self._declare(name, 'counter', help_text)
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def gauge_add(self, name, labels=None, value=1, help_text=None):
+        key = _labels_key(labels)
+        with self._lock:
+            self._declare(name, 'gauge', help_text)
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def gauge_set(self, name, value, labels=None, help_text=None):
+        key = _labels_key(labels)
+        with self._lock:
+            self._declare(name, 'gauge', help_text)
+            self._values[name][key] = value
+
+    def observe(self, name, value, labels=None, help_text=None,
+                buckets=DEFAULT_BUCKETS):
+        key = _labels_key(labels)
+        with self._lock:
+            self._declare(name, 'histogram', help_text)
+            values = self._values[name]
+            if key not in values:
+                values[key] = Histogram(buckets)
+            values[key].observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._meta.clear()
+            self._values.clear()
+
+    def snapshot(self):
+        """ 当前所有值，可以 json 序列化 """
+        result = {}
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                values = []
+                for key, value in self._values[name].items():
+                    if kind == 'histogram':
+                        value = {'buckets': list(value.buckets[:-1]),
+                                 'counts': list(value.counts),
+                                 'sum': value.sum,
+                                 'count': value.count}
+                    values.append([[list(item) for item in key], value])
+                result[name] = {'kind': kind, 'help': help_text,
+                                'values': values}
+        return result
+
+    def merge(self, snapshot, gauges=True):
+        """ 把 snapshot 中的值累加进来，gauges=False 时跳过 gauge """
+        with self._lock:
+            for name, metric in snapshot.items():
+                kind = metric['kind']
+                if kind == 'gauge' and not gauges:
+                    continue
+                self._declare(name, kind, metric['help'])
+                values = self._values[name]
+                for labels, value in metric['values']:
+                    key = tuple(tuple(item) for item in labels)
+                    if kind != 'histogram':
+                        values[key] = values.get(key, 0) + value
+                        continue
+                    if key not in values:
+                        values[key] = Histogram(value['buckets'])
+                    histogram = values[key]
+                    histogram.counts = [a + b for a, b in
+                                        zip(histogram.counts, value['counts'])]
+                    histogram.sum += value['sum']
+                    histogram.count += value['count']
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._meta):
+                kind, help_text = self._meta[name]
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key, value in sorted(self._values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, _format_labels(key),
+                                                  _format_value(value)))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        le = [('le', _format_value(bound))]
+                        lines.append('%s_bucket%s %s' % (
+                            name, _format_labels(key, le), cumulative))
+                    lines.append('%s_sum%s %s' % (
+                        name, _format_labels(key), _format_value(value.sum)))
+                    lines.append('%s_count%s %s' % (
+                        name, _format_labels(key), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _snapshot_path(directory, pid):
+    return os.path.join(directory, 'metrics-%s.json' % pid)
+
+
+class SnapshotWriter(object):
+    """ 每 interval 秒把 registry 的值写到 directory 下本进程的文件 """
+
+    def __init__(self, directory, interval=5, registry=registry):
+        self.directory = directory
+        self.interval = float(interval)
+        self.registry = registry
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """ fork 之后的进程第一次调用时启动写入线程 """
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            thread = threading.Thread(target=self._run,
+                                      name='metrics-snapshot', daemon=True)
+            thread.start()
+
+    def write(self):
+        path = _snapshot_path(self.directory, os.getpid())
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logging.error('write metrics snapshot error: %s', str(e))
+            time.sleep(self.interval)
+
+
+_writer = None
+
+
+def enable_multiprocess(directory, interval=5):
+    global _writer
+    _writer = SnapshotWriter(directory, interval)
+
+
+def multiprocess_dir():
+    return _writer.directory if _writer else None
+
+
+def ensure_writer():
+    if _writer is not None:
+        _writer.ensure_started()
+
+
+def render_all(directory=None, max_age=60, registry=registry):
+    """ 汇总 directory 中所有进程和本进程的值，directory 为空时只输出本进程 """
+    if not directory:
+        return registry.render()
+    merged = MetricsRegistry()
+    merged.merge(registry.snapshot())
+    own_path = _snapshot_path(directory, os.getpid())
+    now = time.time()
+    for path in glob.glob(_snapshot_path(directory, '*')):
+        if path == own_path:
+            continue
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            fresh = now - os.path.getmtime(path) <= max_age
+        except (OSError, ValueError) as e:
+            logging.error('read metrics snapshot %s error: %s', path, str(e))
+            continue
+        merged.merge(snapshot, gauges=fresh)
+    return merged.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host='0.0.0.0'):
+    """ 在后台线程中启动 /metrics 服务，返回 server，调用 shutdown 停止 """
+    server = _ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server', daemon=True)
+    thread.start()
+    return server
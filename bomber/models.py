@@ -1248,6 +1248,21 @@ class MonLogger(DynamicDocument):
     body = mon.StringField(null=True, db_field='bd')
 
 
+# 已处理的 sqs 消息，用于 worker 去重，过期后由 mongo ttl 索引自动删除
+class ProcessedMessage(BaseDocument):
+    meta = {
+        'collection': 'processed_message',
+        'indexes': [
+            {'fields': ['expire_at'], 'expireAfterSeconds': 0},
+        ]
+    }
+
+    # 以 key 为 _id，写入时重复即说明处理过
+    key = mon.StringField(primary_key=True)
+    action = mon.StringField(db_field='a')
+    expire_at = ChinaDateTimeField(db_field='ex')
+
+
 #手动呼叫纪录
 class CallActions(ModelBase):
     id = BigIntegerField(default=idg, primary_key=True)
@@ -1383,7 +1398,13 @@ class CycleTarget(ModelBase):
 
 class TotalContact(BaseDocument):
     meta = {
-        'collection': 'total_contact'
+        'collection': 'total_contact',
+        'indexes': [
+            {'fields': ['src_number', 'dest_number', 'source', 'is_calc'],
+             'background': True},
+            {'fields': ['dest_number'], 'background': True},
+            {'fields': ['src_number', 'source'], 'background': True},
+        ]
     }
 
     src_number = mon.StringField(db_field='sn')
@@ -1490,6 +1511,28 @@ class TotalContact(BaseDocument):
         }.get(source)
 
 
+# total_contact 的邻接表，每条关系按两个号码各存一条，按号码查询不需要 or
+class ContactEdge(BaseDocument):
+    meta = {
+        'collection': 'contact_edge',
+        'indexes': [
+            {'fields': ['number', 'counterparty', 'source', 'outgoing'],
+             'unique': True, 'background': True},
+            {'fields': ['number', '-total_duration'], 'background': True},
+        ]
+    }
+
+    number = mon.StringField(db_field='n', required=True)
+    counterparty = mon.StringField(db_field='c', required=True)
+    # 对方号码的名字
+    name = mon.StringField(db_field='na')
+    source = mon.IntField(db_field='s')
+    # True: number 是 total_contact 中的 src_number
+    outgoing = mon.BooleanField(db_field='o', default=True)
+    total_count = mon.IntField(db_field='tc', default=1)
+    total_duration = mon.IntField(db_field='td', default=0)
+
+
 # 人员变动时分件的操作日志
 class DispatchAppLogs(ModelBase):
     id = IntegerField(primary_key=True)
@@ -0,0 +1,208 @@
+"""
+逾期天数重算，由 worker.calc_overdue_days / calc_overdue_days_over 使用
+
+- 现金贷催收单: 所有未完成状态一条 UPDATE
+- 分期子账单: 所有未完成状态一条 UPDATE
+- 分期催收单: 用 UPDATE ... JOIN 子查询(每个催收单子账单的最大逾期天数)
+  一次更新，不再逐个催收单 UPDATE
+- 每个阶段记录影响的行数和耗时
+
+over=False 更新逾期天数 <= 95 的件，over=True 更新 > 95 的件
+
+incremental=True 时现金贷催收单只写逾期天数需要落库的行(persist_filter):
+- 跨过 cycle 边界(10/30/60/90)的
+- 实际逾期天数或库里的逾期天数是 TRIGGER_DAYS 中的某一天的，
+  按逾期天数等值查询的任务能查到当天的件，第二天再更新掉
+其余现金贷催收单库里的逾期天数会落后于实际值，需要准确值的地方用
+application_overdue_days(SQL 拼接用 application_overdue_days_sql)在查询时计算，
+已经查出来的催收单用 actual_overdue_days；
+分期子账单和分期催收单每次都全部更新
+"""
+import logging
+import operator
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import reduce
+
+from peewee import Case, fn, SQL
+
+from bomber.constant_mapping import (
+    ApplicationStatus,
+    ApplicationType,
+    AutoCallMessageCycle,
+)
+from bomber.cycle_policy import CYCLE_START_DAYS, cycle_case
+from bomber.db import db
+from bomber.models import Application, OverdueBill
+
+OVER_DAYS = 95
+
+UNFINISHED_STATUSES = [ApplicationStatus.PROCESSING.value,
+                       ApplicationStatus.UNCLAIMED.value,
+                       ApplicationStatus.AB_TEST.value]
+
+
+def _message_days():
+    # bomber_auto_message_daily 每三天发一次
+    days = set()
+    for stage in AutoCallMessageCycle:
+        days.update(range(*stage.value['scope'], 3))
+    return days
+
+
+# 按逾期天数等值查询的任务:
+# 4 更新 C1A_entry，21/46/76 换催收员，96 交给 calc_overdue_days_over
+DISPATCH_DAYS = {4, 21, 46, 76, OVER_DAYS + 1} | _message_days()
+
+TRIGGER_DAYS = sorted(set(CYCLE_START_DAYS) | DISPATCH_DAYS)
+
+
+def current_overdue_days(model):
+    """ 按 origin_due_at 计算的实际逾期天数 """
+    origin_diff_days = fn.DATEDIFF(fn.NOW(), model.origin_due_at)
+    return fn.GREATEST(origin_diff_days, SQL('0'))
+
+
+def application_overdue_days(model=Application):
+    """ 催收单的实际逾期天数，现金贷按 origin_due_at 计算，分期的用库里的 """
+    return Case(None,
+                [(model.type == ApplicationType.CASH_LOAN.value,
+                  current_overdue_days(model))],
+                model.overdue_days)
+
+
+def actual_overdue_days(application):
+    """ 已查出的催收单的实际逾期天数，与 application_overdue_days 一致 """
+    if (application.type == ApplicationType.CASH_LOAN.value and
+            application.origin_due_at):
+        days = (datetime.now().date() - application.origin_due_at.date()).days
+        return max(days, 0)
+    return application.overdue_days
+
+
+def application_overdue_days_sql(alias='t1'):
+    """ application_overdue_days 的 SQL，alias 为 application 表的别名 """
+    return ('(CASE WHEN {t}.type = {cash_loan} '
+            'THEN GREATEST(DATEDIFF(NOW(), {t}.origin_due_at), 0) '
+            'ELSE {t}.overdue_days END)'
+            .format(t=alias, cash_loan=ApplicationType.CASH_LOAN.value))
+
+
+def persist_filter(model):
+    """ 增量模式下需要写入逾期天数的行 """
+    actual = current_overdue_days(model)
+    stored = model.overdue_days
+    conditions = [actual << TRIGGER_DAYS,
+                  stored << TRIGGER_DAYS,
+                  # 应还时间往后改了
+                  actual < stored]
+    conditions.extend((stored < day) & (actual >= day)
+                      for day in CYCLE_START_DAYS)
+    return (stored != actual) & reduce(operator.or_, conditions)
+
+
+def escalation_filter():
+    """ 库里的逾期天数已经超出当前 cycle 的件 """
+    return cycle_case(Application.overdue_days) > Application.cycle
+
+
+def _days_filter(model, over, incremental):
+    if over:
+        days = model.overdue_days > OVER_DAYS
+    else:
+        days = model.overdue_days <= OVER_DAYS
+    if incremental:
+        return days & persist_filter(model)
+    return days
+
+
+def update_cash_loan(over=False, incremental=False):
+    return (Application
+            .update(overdue_days=current_overdue_days(Application))
+            .where(Application.status << UNFINISHED_STATUSES,
+                   _days_filter(Application, over, incremental),
+                   Application.type == ApplicationType.CASH_LOAN.value)
+            .execute())
+
+
+def update_overdue_bills(over=False):
+    # 分期催收单的逾期天数取子账单的最大值，子账单每次都全部更新
+    return (OverdueBill
+            .update(overdue_days=current_overdue_days(OverdueBill))
+            .where(OverdueBill.status << UNFINISHED_STATUSES,
+                   _days_filter(OverdueBill, over, False))
+            .execute())
+
+
+def month_first_day(now=None):
+    now = now or datetime.now()
+    return now.replace(day=1, hour=1, minute=30, second=0, microsecond=0)
+
+
+def update_instalment_sql(exclude_repaid_before=None):
+    """
+    分期催收单的逾期天数取其子账单的最大值
+    exclude_repaid_before 不为空时排除在这之前创建的已还款的子账单
+    """
+    application = Application._meta.db_table
+    overdue_bill = OverdueBill._meta.db_table
+    params = list(UNFINISHED_STATUSES)
+    params.append(ApplicationType.CASH_LOAN_STAGING.value)
+    exclude = ''
+    if exclude_repaid_before is not None:
+        exclude = 'AND NOT (ob.status = %s AND ob.created_at < %s)'
+        params.extend([ApplicationStatus.REPAID.value, exclude_repaid_before])
+
+    sql = """
+        UPDATE {application} AS a
+        INNER JOIN (
+            SELECT ob.collection_id, MAX(ob.overdue_days) AS overdue_days
+            FROM {overdue_bill} AS ob
+            INNER JOIN {application} AS app ON app.id = ob.collection_id
+            WHERE app.status IN ({statuses}) AND app.type = %s {exclude}
+            GROUP BY ob.collection_id
+        ) AS t ON t.collection_id = a.id
+        SET a.overdue_days = t.overdue_days
+    """.format(application=application,
+               overdue_bill=overdue_bill,
+               statuses=', '.join(['%s'] * len(UNFINISHED_STATUSES)),
+               exclude=exclude)
+    return sql, params
+
+
+def update_instalment_applications(exclude_repaid_before=None):
+    sql, params = update_instalment_sql(exclude_repaid_before)
+    return db.execute_sql(sql, params).rowcount
+
+
+def recalc_overdue_days(over=False, incremental=False, tolerate=()):
+    """
+    返回 {阶段: {'rows': 影响行数, 'seconds': 耗时}}
+    分期催收单的 UPDATE 只会改写最大逾期天数变了的行，增量模式下不需要额外条件
+    tolerate 中的阶段出错时只记录日志，rows 为 None，其他阶段的异常直接抛出
+    """
+    # 逾期天数 <= 95 的分期件排除当月之前已还款的那一期
+    exclude_before = None if over else month_first_day()
+    phases = [
+        ('cash_loan', lambda: update_cash_loan(over, incremental)),
+        ('overdue_bill', lambda: update_overdue_bills(over)),
+        ('instalment', lambda: update_instalment_applications(exclude_before)),
+    ]
+    stats = OrderedDict()
+    for name, run in phases:
+        start = time.perf_counter()
+        try:
+            rows = run()
+        except Exception as e:
+            if name not in tolerate:
+                raise
+            logging.error('recalc overdue days %s (over=%s) error: %s',
+                          name, over, str(e))
+            rows = None
+        seconds = round(time.perf_counter() - start, 3)
+        stats[name] = {'rows': rows, 'seconds': seconds}
+        logging.info('recalc overdue days %s (over=%s, incremental=%s) done, '
+                     'rows: %s, seconds: %s',
+                     name, over, incremental, rows, seconds)
+    return stats
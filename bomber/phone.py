@@ -0,0 +1,39 @@
+"""
+手机号规范化，规则与 bomber.utils.number_strip 一致：
+去掉 +86，只保留数字，去掉开头的 62 和所有开头的 0
+
+- normalize_number: 单个号码，结果放在有上限的 LRU 缓存里，
+  add_contact 等地方同一个号码会反复规范化
+- normalize_numbers: 一次规范化整个 list 或 pandas Series
+"""
+import re
+from functools import lru_cache
+
+NUMBER_CACHE_SIZE = 65536
+
+non_digit_re = re.compile(r'\D+')
+
+
+def _normalize(number):
+    # 印尼的号码有86开头，所以去掉中国 的 86 要跟着 + 一起
+    number = non_digit_re.sub('', number.replace('+86', ''))
+    if number.startswith('62'):
+        number = number[2:]
+    return number.lstrip('0')
+
+
+normalize_number = lru_cache(maxsize=NUMBER_CACHE_SIZE)(_normalize)
+
+
+def normalize_numbers(numbers):
+    """ list 返回 list，pandas Series 用向量化的字符串操作，返回 Series """
+    if hasattr(numbers, 'str'):
+        return (numbers.str.replace('+86', '', regex=False)
+                .str.replace(r'\D+', '', regex=True)
+                .str.replace(r'^62', '', regex=True)
+                .str.lstrip('0'))
+    return [normalize_number(number) for number in numbers]
+
+
+def cache_info():
+    return normalize_number.cache_info()
@@ -0,0 +1,29 @@
+import time
+
+from bottle import request, response, HTTPResponse
+
+from bomber.metrics import ensure_writer, registry
+
+
+def metrics_plugin(callback):
+    def wrapper(*args, **kwargs):
+        ensure_writer()
+        start = time.time()
+        status = None
+        try:
+            return callback(*args, **kwargs)
+        except HTTPResponse as e:
+            status = e.status_code
+            raise
+        except Exception:
+            status = 500
+            raise
+        finally:
+            labels = {'route': request.route.rule, 'method': request.method}
+            registry.observe('bomber_http_request_seconds',
+                             time.time() - start, labels,
+                             help_text='Request handling time in seconds')
+            registry.inc('bomber_http_requests_total',
+                         dict(labels, status=status or response.status_code),
+                         help_text='Requests handled by status')
+    return wrapper
@@ -0,0 +1,240 @@
+"""
+消息队列后端
+
+worker 和 bomber.sns 只用到 boto3 sqs client 的以下方法，本地后端实现同样的接口：
+receive_message / send_message / send_message_batch / delete_message /
+delete_message_batch / change_message_visibility / get_queue_attributes
+
+通过 aws.sqs.backend 配置选择：
+- sqs: 默认，使用 boto3
+- memory: 进程内队列，用于压测和测试
+- sqlite:<path>: sqlite 文件队列，可以在多个进程之间共享
+"""
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+
+
+class LocalQueue(ABC):
+    """ 本地队列的公共逻辑，子类实现 _put / _take / _delete / _change """
+
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        message_id = str(uuid.uuid4())
+        self._put(QueueUrl, message_id, MessageBody)
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        successful = []
+        for entry in Entries:
+            resp = self.send_message(QueueUrl, entry['MessageBody'])
+            successful.append({'Id': entry['Id'],
+                               'MessageId': resp['MessageId']})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1,
+                        WaitTimeSeconds=0, **kwargs):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            messages = self._take(QueueUrl, MaxNumberOfMessages,
+                                  self.visibility_timeout)
+            remaining = deadline - time.time()
+            if messages or remaining <= 0:
+                break
+            self._wait(min(remaining, 0.1))
+
+        if not messages:
+            return {}
+        return {'Messages': [{'MessageId': message_id,
+                              'ReceiptHandle': receipt_handle,
+                              'Body': body}
+                             for message_id, receipt_handle, body in messages]}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self._delete(QueueUrl, ReceiptHandle)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        for entry in Entries:
+            self._delete(QueueUrl, entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries],
+                'Failed': []}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle,
+                                  VisibilityTimeout, **kwargs):
+        self._change(QueueUrl, ReceiptHandle, VisibilityTimeout)
+        return {}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        return {'Attributes': {
+            'VisibilityTimeout': str(self.visibility_timeout)}}
+
+    def _wait(self, seconds):
+        time.sleep(seconds)
+
+    @abstractmethod
+    def _put(self, url, message_id, body):
+        pass
+
+    @abstractmethod
+    def _take(self, url, max_number, visibility_timeout):
+        """ 返回 [(message_id, receipt_handle, body)] 并设置不可见 """
+
+    @abstractmethod
+    def _delete(self, url, receipt_handle):
+        pass
+
+    @abstractmethod
+    def _change(self, url, receipt_handle, visibility_timeout):
+        pass
+
+
+class MemoryQueue(LocalQueue):
+    """ 进程内队列，进程退出后消息丢失 """
+
+    def __init__(self, visibility_timeout=30):
+        super().__init__(visibility_timeout)
+        # url -> {message_id: [body, receipt_handle, visible_at]}
+        self._queues = defaultdict(OrderedDict)
+        self._cond = threading.Condition()
+
+    def _put(self, url, message_id, body):
+        with self._cond:
+            self._queues[url][message_id] = [body, None, 0]
+            self._cond.notify_all()
+
+    def _take(self, url, max_number, visibility_timeout):
+        now = time.time()
+        result = []
+        with self._cond:
+            for message_id, item in self._queues[url].items():
+                if len(result) >= max_number:
+                    break
+                if item[2] > now:
+                    continue
+                item[1] = '%s#%s' % (message_id, uuid.uuid4().hex)
+                item[2] = now + visibility_timeout
+                result.append((message_id, item[1], item[0]))
+        return result
+
+    def _find(self, url, receipt_handle):
+        message_id = receipt_handle.split('#', 1)[0]
+        item = self._queues[url].get(message_id)
+        if item is None or item[1] != receipt_handle:
+            return None, None
+        return message_id, item
+
+    def _delete(self, url, receipt_handle):
+        with self._cond:
+            message_id, item = self._find(url, receipt_handle)
+            if item is not None:
+                del self._queues[url][message_id]
+
+    def _change(self, url, receipt_handle, visibility_timeout):
+        with self._cond:
+            _, item = self._find(url, receipt_handle)
+            if item is not None:
+                item[2] = time.time() + visibility_timeout
+                self._cond.notify_all()
+
+    def _wait(self, seconds):
+        with self._cond:
+            self._cond.wait(seconds)
+
+    def size(self, url):
+        with self._cond:
+            return len(self._queues[url])
+
+
+class SQLiteQueue(LocalQueue):
+    """ sqlite 文件队列，多个进程可以共用同一个文件 """
+
+    def __init__(self, path, visibility_timeout=30):
+        super().__init__(visibility_timeout)
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS message ('
+                         'id TEXT PRIMARY KEY, '
+                         'queue TEXT NOT NULL, '
+                         'body TEXT NOT NULL, '
+                         'receipt_handle TEXT, '
+                         'visible_at REAL NOT NULL DEFAULT 0, '
+                         'seq INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_message_queue '
+                         'ON message (queue, visible_at, seq)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return _Closing(conn)
+
+    def _put(self, url, message_id, body):
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT INTO message (id, queue, body, seq) '
+                         'VALUES (?, ?, ?, '
+                         '(SELECT IFNULL(MAX(seq), 0) + 1 FROM message))',
+                         (message_id, url, body))
+
+    def _take(self, url, max_number, visibility_timeout):
+        now = time.time()
+        result = []
+        with self._lock, self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('SELECT id, body FROM message '
+                                'WHERE queue = ? AND visible_at <= ? '
+                                'ORDER BY seq LIMIT ?',
+                                (url, now, max_number)).fetchall()
+            for message_id, body in rows:
+                receipt_handle = '%s#%s' % (message_id, uuid.uuid4().hex)
+                conn.execute('UPDATE message SET receipt_handle = ?, '
+                             'visible_at = ? WHERE id = ?',
+                             (receipt_handle, now + visibility_timeout,
+                              message_id))
+                result.append((message_id, receipt_handle, body))
+            conn.execute('COMMIT')
+        return result
+
+    def _delete(self, url, receipt_handle):
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM message '
+                         'WHERE queue = ? AND receipt_handle = ?',
+                         (url, receipt_handle))
+
+    def _change(self, url, receipt_handle, visibility_timeout):
+        with self._lock, self._connect() as conn:
+            conn.execute('UPDATE message SET visible_at = ? '
+                         'WHERE queue = ? AND receipt_handle = ?',
+                         (time.time() + visibility_timeout, url,
+                          receipt_handle))
+
+    def size(self, url):
+        with self._lock, self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM message '
+                                'WHERE queue = ?', (url,)).fetchone()[0]
+
+
+class _Closing(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.close()
+
+
+def create_backend(backend='sqs', visibility_timeout=30):
+    if backend == 'memory':
+        return MemoryQueue(visibility_timeout)
+    if backend.startswith('sqlite:'):
+        return SQLiteQueue(backend[len('sqlite:'):], visibility_timeout)
+    # 只有用 sqs 时才需要 boto3
+    import boto3
+    return boto3.client('sqs')
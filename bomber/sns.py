@@ -1,10 +1,14 @@
 import json
+import threading
+from collections import defaultdict
 from enum import Enum
 
 import boto3
 import logging
 from bottle import default_app
 
+from bomber.queue_backend import create_backend
+
 
 app = default_app()
 
@@ -40,6 +44,8 @@ class MessageAction(Enum):
     BOMBER_CALC_SUMMARY2 = 'BOMBER_CALC_SUMMARY2'
     BOMBER_SYNC_CONTACTS = 'BOMBER_SYNC_CONTACTS'
     APPLICATION_BOMBER = 'APPLICATION_BOMBER'
+    # 批量入催，payload 中是多个 APPLICATION_BOMBER
+    APPLICATION_BOMBER_BATCH = 'APPLICATION_BOMBER_BATCH'
     BOMBER_AUTO_SMS = 'BOMBER_AUTO_SMS'
     BOMBER_REMIND_PROMISE = 'BOMBER_REMIND_PROMISE'
     BOMBER_AUTO_CALL_LIST = 'BOMBER_AUTO_CALL_LIST'
@@ -93,23 +99,76 @@ class MessageAction(Enum):
     BOMBER_TODAY_PTP_FOLLOW_SWITCH_ON = 'BOMBER_TODAY_PTP_FOLLOW_SWITCH_ON'
 
 
-def send_to_bus(action, payload):
-    arn = app.config['aws.sns.arn_bus']
-    return send_to_sns(arn, action, payload)
+class Lane(Enum):
+    """
+    消息通道，不同通道可以配置各自的队列（aws.sqs.<lane>_queue_url）
+    未配置的通道使用 aws.sqs.queue_url
+    """
+    REALTIME = 'realtime'
+    DEFAULT = 'default'
+    BATCH = 'batch'
 
 
-def send_to_sns(arn, action, payload):
-    assert isinstance(action, MessageAction)
+# 由 bomber.worker 中的 @action(..., lane=...) 注册，key-MessageAction
+action_lanes = {}
+
+
+def lane_queue_url(lane):
+    url = None
+    if lane != Lane.DEFAULT:
+        url = app.config.get('aws.sqs.%s_queue_url' % lane.value)
+    return url or app.config['aws.sqs.queue_url']
+
+
+def action_queue_url(action):
+    return lane_queue_url(action_lanes.get(action, Lane.DEFAULT))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
 
-    client = boto3.client('sns')
+def get_client(service_name):
+    """
+    boto3 client 创建开销大且线程安全，按服务缓存复用
+    sqs 按 aws.sqs.backend 配置可以换成本地队列，见 bomber.queue_backend
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _clients[service_name] = _create_client(service_name)
+    return client
 
-    message = json.dumps({
+
+def _create_client(service_name):
+    if service_name == 'sqs':
+        return create_backend(
+            app.config.get('aws.sqs.backend', 'sqs'),
+            int(app.config.get('aws.sqs.visibility_timeout', 300)))
+    return boto3.client(service_name)
+
+
+def build_message(action, payload):
+    assert isinstance(action, MessageAction)
+
+    return json.dumps({
         'action': action.value,
         'payload': payload,
     })
+
+
+def send_to_bus(action, payload):
+    arn = app.config['aws.sns.arn_bus']
+    return send_to_sns(arn, action, payload)
+
+
+def send_to_sns(arn, action, payload):
+    message = build_message(action, payload)
     logging.info('sns message body: %s', message)
 
-    response = client.publish(
+    response = get_client('sns').publish(
         TopicArn=arn,
         Message=message,
     )
@@ -120,22 +179,15 @@ def send_to_sns(arn, action, payload):
 
 
 def send_to_default_q(action, payload):
-    url = app.config['aws.sqs.queue_url']
+    url = action_queue_url(action)
     return send_to_sqs(url, action, payload)
 
 
 def send_to_sqs(url, action, payload):
-    assert isinstance(action, MessageAction)
-
-    client = boto3.client('sqs')
-
-    message = json.dumps({
-        'action': action.value,
-        'payload': payload,
-    })
+    message = build_message(action, payload)
     logging.info('send sqs message body: %s', message)
 
-    response = client.send_message(
+    response = get_client('sqs').send_message(
         QueueUrl=url,
         MessageBody=message,
     )
@@ -143,3 +195,111 @@ def send_to_sqs(url, action, payload):
     msg_id = response
     logging.info('sqs message id: %s', response['MessageId'])
     return msg_id
+
+
+class PublishError(Exception):
+    """ MessagePublisher 退出时仍有消息发送失败 """
+
+
+class MessagePublisher(object):
+    """
+    批量发送消息，用于循环中大量发送消息的场景
+
+        with MessagePublisher() as publisher:
+            for idx in range(0, len(ids), 100):
+                publisher.send_to_default_q(action, {'ids': ids[idx:idx+100]})
+
+    - sqs 消息按队列攒够 10 条用 send_message_batch 发送一次，退出时发送剩余消息
+    - sns 没有批量接口，只复用 client 逐条发送
+    - sent / failed 记录发送成功和失败的条数
+    - strict: with 块正常结束但有消息发送失败时抛出 PublishError，
+      让调用方的消息处理失败后重试，而不是悄悄丢掉消息
+    """
+    MAX_BATCH = 10
+    # send_message_batch 所有消息加起来不能超过 256KB
+    MAX_BATCH_BYTES = 256 * 1024
+
+    def __init__(self, strict=True):
+        self.strict = strict
+        self.sent = 0
+        self.failed = 0
+        self._pending = defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        # 已经有异常时不覆盖原来的异常
+        if self.strict and self.failed and exc_type is None:
+            raise PublishError('send message failed: %s, sent: %s'
+                               % (self.failed, self.sent))
+
+    def send_to_bus(self, action, payload):
+        arn = app.config['aws.sns.arn_bus']
+        return self.send_to_sns(arn, action, payload)
+
+    def send_to_sns(self, arn, action, payload):
+        try:
+            response = send_to_sns(arn, action, payload)
+        except Exception:
+            self.failed += 1
+            raise
+        self.sent += 1
+        return response
+
+    def send_to_default_q(self, action, payload):
+        url = action_queue_url(action)
+        return self.send_to_sqs(url, action, payload)
+
+    def send_to_sqs(self, url, action, payload):
+        message = build_message(action, payload)
+        pending = self._pending[url]
+        size = sum(len(m.encode()) for m in pending) + len(message.encode())
+        if pending and size > self.MAX_BATCH_BYTES:
+            self._flush_queue(url)
+        self._pending[url].append(message)
+        if len(self._pending[url]) >= self.MAX_BATCH:
+            self._flush_queue(url)
+
+    def flush(self):
+        for url in list(self._pending):
+            self._flush_queue(url)
+        logging.info('sqs publisher sent: %s, failed: %s',
+                     self.sent, self.failed)
+
+    def _flush_queue(self, url):
+        messages = self._pending.pop(url, [])
+        if not messages:
+            return
+
+        entries = [{'Id': str(i), 'MessageBody': message}
+                   for i, message in enumerate(messages)]
+        try:
+            response = get_client('sqs').send_message_batch(QueueUrl=url,
+                                                            Entries=entries)
+        except Exception as e:
+            # 整批失败不抛出，继续发送其他队列的消息
+            self.failed += len(messages)
+            logging.error('send sqs message batch failed: %s, bodies: %s',
+                          str(e), messages)
+            return
+        self.sent += len(response.get('Successful', []))
+        logging.info('send sqs message batch: %s', len(messages))
+
+        for item in response.get('Failed', []):
+            message = messages[int(item['Id'])]
+            if item.get('SenderFault'):
+                self.failed += 1
+                logging.error('send sqs message failed: %s %s, body: %s',
+                              item.get('Code'), item.get('Message'), message)
+                continue
+            # 服务端错误逐条重试一次
+            try:
+                get_client('sqs').send_message(QueueUrl=url,
+                                               MessageBody=message)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error('send sqs message failed: %s, body: %s',
+                              str(e), message)
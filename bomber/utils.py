@@ -4,11 +4,12 @@ import re
 import sys
 import time
 import logging
+import threading
 from operator import itemgetter as _itemgetter
 import heapq as _heapq
 from dateutil import parser
 from pytz import timezone
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from datetime import datetime, date
 from enum import Enum
@@ -321,19 +322,9 @@ def str_datetime(s, fmt='%Y-%m-%d %H:%M:%S'):
 
 # 根据逾期天数计算获取对应的cycle
 def get_cycle_by_overdue_days(overdue_days):
-    cycle_days_map = {
-        1: [1, 10],
-        2: [11, 30],
-        3: [31, 60],
-        4: [61, 90],
-        5: [91, 999999],
-    }
-    cycle = 0
-    for k,v in cycle_days_map.items():
-        if v[0] <= overdue_days <= v[1]:
-            cycle = k
-            break
-    return cycle
+    # constant_mapping -> configuration 会导入 utils，延迟导入避免循环引用
+    from bomber.cycle_policy import cycle_of
+    return cycle_of(overdue_days)
 
 
 def time_logger(func):
@@ -345,4 +336,67 @@ def time_logger(func):
         logging.info('function %s runtime: %s,department_summary_logging_time',
                      func.__name__, time_diff)
         return r
-    return w
\ No newline at end of file
+    return w
+
+
+class TTLCache(object):
+    """
+    线程安全的 LRU 缓存，每个 key 有过期时间
+    - max_size: 最多缓存的条数，超出后淘汰最久未使用的
+    - ttl: 默认过期秒数
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.time():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        expire_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def remove(self, predicate):
+        """ 删除 predicate(key) 为真的所有 key，返回删除的条数 """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def __contains__(self, key):
+        # 不计入 hits / misses
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1] >= time.time()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -1,19 +1,25 @@
 import traceback
+from ast import literal_eval
 from functools import partial
 import json
 import logging
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from itertools import cycle as CycleIter
 from datetime import datetime, date, timedelta
 from decimal import Decimal
 import random
-from copy import deepcopy
+import time
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
 from math import ceil
 
 import boto3
 import bottle
-from peewee import fn, SQL, JOIN_LEFT_OUTER, JOIN_INNER, R
+from peewee import fn, Case, SQL, JOIN_LEFT_OUTER, JOIN_INNER, R
 from mongoengine import Q
+from pymongo import UpdateMany, UpdateOne
 from deprecated.sphinx import deprecated
 
 from bomber.api import (
@@ -66,7 +72,23 @@ from bomber.controllers.report_calculation.collection_tool import (
     average_call_duration_team
 )
 from bomber.controllers.report_calculation.collection_agent import get_agent
+from bomber import contact_graph
+from bomber.contact_dedup import dedup_pipeline, resolve_contact_edges
+from bomber.contact_upsert import ContactUpsert
+from bomber.cycle_policy import (
+    CYCLE_ENTRY_FIELDS,
+    ENTRY_FIELDS,
+    cycle_end_day,
+    cycle_of,
+    entry_field,
+)
 from bomber.db import db, readonly_db
+from bomber.overdue_days import (
+    application_overdue_days,
+    application_overdue_days_sql,
+    escalation_filter,
+    recalc_overdue_days,
+)
 from bomber.models_readonly import (
     DispatchAppHistoryR,
     AutoCallActionsR,
@@ -122,7 +144,13 @@ from bomber.models import (
     Role,
     SCI,
 )
-from bomber.sns import MessageAction, send_to_default_q
+from bomber.phone import normalize_number
+from bomber.sns import (
+    MessagePublisher,
+    MessageAction,
+    action_lanes,
+    Lane,
+    send_to_default_q)
 from bomber.utils import (
     get_cycle_by_overdue_days,
     str_no_utc_datetime,
@@ -143,12 +171,35 @@ app = bottle.default_app()
 client = boto3.client('sqs')
 #对外展示dict,key-函数名；v-函数数组
 actions = {}
-
-
-def action(msg_action):
+#action 的运行参数,key-函数名；v-参数dict
+#concurrency: 线程池模式下该 action 同时执行的上限,None 表示不限制
+#max_duration: 最长执行秒数,执行期间 worker 会持续延长消息的可见性超时,
+#              超过该时长不再延长,None 表示不延长
+#sync_log: 执行前同步写入 WorkerLog,用于需要统计自身执行次数的 action,
+#          其余 action 的 WorkerLog 在执行完成后异步批量写入
+#dedup_content: 除了按消息 id 去重外,payload 完全相同的消息
+#               在去重有效期内也只处理一次
+#lane: 消息通道,send_to_default_q 会把消息发到该通道的队列
+action_options = {}
+
+
+def action(msg_action, concurrency=None, max_duration=None, sync_log=False,
+           dedup_content=False, lane=None):
     action_name = msg_action.value.lower()
     if action_name not in actions:
         actions[action_name] = []
+    options = action_options.setdefault(action_name, {})
+    if lane is not None:
+        options['lane'] = lane
+        action_lanes[msg_action] = lane
+    if concurrency is not None:
+        options['concurrency'] = concurrency
+    if max_duration is not None:
+        options['max_duration'] = max_duration
+    if sync_log:
+        options['sync_log'] = True
+    if dedup_content:
+        options['dedup_content'] = True
 
     def wrapper(func):
         actions[action_name].append(func)
@@ -215,7 +266,7 @@ def dpd1_process(lst):
 
 
 # auto_ivr,自动外呼系统
-@action(MessageAction.GET_IVR)
+@action(MessageAction.GET_IVR, lane=Lane.BATCH)
 def get_ivr(payload, msg_id):
     logging.warning('start get_ivr')
     sys_config = (SystemConfig.select()
@@ -529,7 +580,97 @@ def app_merge(payload, msg_id):
      .where(Application.id << ids)).execute()
 
 
-@action(MessageAction.APPLICATION_BOMBER)
+def count_loan_success(history, gold_app):
+    return len([1 for i in history
+                if i['status'] in [80, 90, 100, 70] and
+                i['id'] != gold_app['id']])
+
+
+def overdue_bill_fields(collection_id, application_id, sub_bill_id, sub_bill):
+    return {
+        "collection_id": collection_id,
+        "bill_id": sub_bill.get("bill_id"),
+        "sub_bill_id": sub_bill_id,
+        "periods": sub_bill.get("periods"),
+        "overdue_days": sub_bill.get('overdue_days'),
+        "origin_due_at": sub_bill.get('origin_due_at'),
+        "amount": sub_bill.get("amount"),
+        "amount_net": sub_bill.get('amount_net'),
+        "interest_rate": sub_bill.get('interest_rate'),
+        "external_id": application_id
+    }
+
+
+def overdue_application_fields(id, type, application_id, gold_app, sub_bill,
+                               loan_success_times, ptp_info):
+    """ 新入催的催收单字段，单条和批量入催共用 """
+    return dict(
+        id=id,
+        user_id=gold_app['user_id'],
+        user_mobile_no=gold_app['user_mobile_no'],
+        user_name=gold_app['id_name'],
+        app=gold_app['app'],
+        device_no=gold_app['device_no'],
+        contact=json.dumps(gold_app.get('contact')),
+        apply_at=gold_app.get('apply_date'),
+
+        id_ektp=gold_app.get('id_ektp'),
+        birth_date=birth_dt_ktp(gold_app.get('id_ektp')),
+        gender=gender_ktpnum(gold_app.get('id_ektp')),
+
+        profile_province=(gold_app.get('profile_province') or {}).get('name'),
+        profile_city=(gold_app.get('profile_city') or {}).get('name'),
+        profile_district=(gold_app.get('profile_district') or {}).get('name'),
+        profile_residence_time=gold_app.get('profile_residence_time'),
+        profile_residence_type=gold_app.get('profile_residence_type'),
+        profile_address=gold_app.get('profile_address'),
+        profile_education=gold_app.get('profile_education'),
+        profile_college=(gold_app.get('profile_college') or {}).get('name'),
+
+        job_name=gold_app.get('job_name'),
+        job_tel=gold_app.get('job_tel'),
+        job_bpjs=gold_app.get('job_bpjs'),
+        job_user_email=gold_app.get('job_user_email'),
+        job_type=gold_app.get('job_type'),
+        job_industry=gold_app.get('job_industry'),
+        job_department=gold_app.get('job_department'),
+        job_province=(gold_app.get('job_province') or {}).get('name'),
+        job_city=(gold_app.get('job_city') or {}).get('name'),
+        job_district=(gold_app.get('job_district') or {}).get('name'),
+        job_address=gold_app.get('job_address'),
+
+        amount=sub_bill.get("amount"),
+        amount_net=sub_bill.get("amount_net"),
+        interest_rate=sub_bill.get("interest_rate"),
+        # late_fee_rate=bill.get('late_fee_rate'),
+        # late_fee_initial=late_fee_initial,
+        # late_fee=late_fee,
+        # interest=interest,
+        term=gold_app.get('term'),
+        origin_due_at=sub_bill.get("origin_due_at"),
+        # due_at=bill.get('due_at'),
+        overdue_days=sub_bill.get("overdue_days"),
+
+        repay_at=sub_bill.get('repay_at'),
+        # principal_paid=principal_paid,
+        # late_fee_paid=late_fee_paid,
+        # repaid=repaid,
+        # unpaid=unpaid,
+
+        loan_success_times=loan_success_times,
+        arrived_at=datetime.now(),
+        follow_up_date=datetime.now(),
+
+        promised_amount=ptp_info and ptp_info.promised_amount,
+        promised_date=ptp_info and ptp_info.promised_date,
+        external_id=application_id,
+        type=type,
+        bill_id=sub_bill.get("bill_id"),
+        dpd1_entry=datetime.now(),
+    )
+
+
+@action(MessageAction.APPLICATION_BOMBER, lane=Lane.REALTIME)
 def application_overdue(payload, msg_id):
 
     application_id = payload['id']
@@ -587,36 +728,18 @@ def application_overdue(payload, msg_id):
                       'to Dashboard Failed.', user_id)
         return
     history = apply_history.json().get('data')
-    loan_success_times = len([1 for i in history
-                              if i['status'] in [80, 90, 100, 70] and
-                              i['id'] != gold_app['id']])
+    loan_success_times = count_loan_success(history, gold_app)
 
     id = application_id
     type = ApplicationType.CASH_LOAN.value
-    bill_id = sub_bill.get("bill_id")
-    amount = sub_bill.get("amount")
-    amount_net = sub_bill.get('amount_net')
-    interest_rate = sub_bill.get('interest_rate')
-    overdue_days = sub_bill.get('overdue_days')
-    origin_due_at = sub_bill.get('origin_due_at')
-    sub_overdue_bill = {
-        "collection_id": id,
-        "bill_id": bill_id,
-        "sub_bill_id": sub_bill_id,
-        "periods": sub_bill.get("periods"),
-        "overdue_days": overdue_days,
-        "origin_due_at": origin_due_at,
-        "amount": amount,
-        "amount_net": amount_net,
-        "interest_rate": interest_rate,
-        "external_id": application_id
-    }
+    sub_overdue_bill = overdue_bill_fields(id, application_id, sub_bill_id,
+                                           sub_bill)
     # 根据催收单类型来生成id
     if sub_bill['category'] == ApplicationType.CASH_LOAN_STAGING.value:
         if local_app and local_app.status != ApplicationStatus.REPAID.value:
             sub_overdue_bill["collection_id"] = local_app.id
-            local_app.amount += amount
-            local_app.amount_net += amount_net
+            local_app.amount += sub_bill.get("amount")
+            local_app.amount_net += sub_bill.get('amount_net')
             local_app.save()
             new_overdue = OverdueBill.create(**sub_overdue_bill)
             logging.info(
@@ -630,73 +753,9 @@ def application_overdue(payload, msg_id):
 
     ptp_info = BombingHistory.filter(BombingHistory.application == id).first()
 
-    promised_amount = ptp_info and ptp_info.promised_amount
-    promised_date = ptp_info and ptp_info.promised_date
-
-    application = Application.create(
-        id=id,
-        user_id=gold_app['user_id'],
-        user_mobile_no=gold_app['user_mobile_no'],
-        user_name=gold_app['id_name'],
-        app=gold_app['app'],
-        device_no=gold_app['device_no'],
-        contact=json.dumps(gold_app.get('contact')),
-        apply_at=gold_app.get('apply_date'),
-
-        id_ektp=gold_app.get('id_ektp'),
-        birth_date=birth_dt_ktp(gold_app.get('id_ektp')),
-        gender=gender_ktpnum(gold_app.get('id_ektp')),
-
-        profile_province=(gold_app.get('profile_province') or {}).get('name'),
-        profile_city=(gold_app.get('profile_city') or {}).get('name'),
-        profile_district=(gold_app.get('profile_district') or {}).get('name'),
-        profile_residence_time=gold_app.get('profile_residence_time'),
-        profile_residence_type=gold_app.get('profile_residence_type'),
-        profile_address=gold_app.get('profile_address'),
-        profile_education=gold_app.get('profile_education'),
-        profile_college=(gold_app.get('profile_college') or {}).get('name'),
-
-        job_name=gold_app.get('job_name'),
-        job_tel=gold_app.get('job_tel'),
-        job_bpjs=gold_app.get('job_bpjs'),
-        job_user_email=gold_app.get('job_user_email'),
-        job_type=gold_app.get('job_type'),
-        job_industry=gold_app.get('job_industry'),
-        job_department=gold_app.get('job_department'),
-        job_province=(gold_app.get('job_province') or {}).get('name'),
-        job_city=(gold_app.get('job_city') or {}).get('name'),
-        job_district=(gold_app.get('job_district') or {}).get('name'),
-        job_address=gold_app.get('job_address'),
-
-        amount=amount,
-        amount_net=amount_net,
-        interest_rate=interest_rate,
-        # late_fee_rate=bill.get('late_fee_rate'),
-        # late_fee_initial=late_fee_initial,
-        # late_fee=late_fee,
-        # interest=interest,
-        term=gold_app.get('term'),
-        origin_due_at=origin_due_at,
-        # due_at=bill.get('due_at'),
-        overdue_days=overdue_days,
-
-        repay_at=sub_bill.get('repay_at'),
-        # principal_paid=principal_paid,
-        # late_fee_paid=late_fee_paid,
-        # repaid=repaid,
-        # unpaid=unpaid,
-
-        loan_success_times=loan_success_times,
-        arrived_at=datetime.now(),
-        follow_up_date=datetime.now(),
-
-        promised_amount=promised_amount,
-        promised_date=promised_date,
-        external_id=application_id,
-        type=type,
-        bill_id=bill_id,
-        dpd1_entry=datetime.now()
-    )
+    application = Application.create(**overdue_application_fields(
+        id, type, application_id, gold_app, sub_bill, loan_success_times,
+        ptp_info))
 
     new_overdue = OverdueBill.create(**sub_overdue_bill)
 
@@ -713,493 +772,646 @@ def application_overdue(payload, msg_id):
     add_contact(application)
 
 
+@action(MessageAction.APPLICATION_BOMBER_BATCH)
+def application_overdue_batch(payload, msg_id):
+    """
+    DPD1 集中入催时批量处理 APPLICATION_BOMBER
+    payload: {'items': [{'id': application_id, 'bill_sub_id': sub_bill_id}]}
+    """
+    items = [(int(i['id']), int(i['bill_sub_id'])) for i in payload['items']]
+    for idx in range(0, len(items), 50):
+        result = applications_overdue(items[idx:idx + 50])
+        logging.info('application overdue batch %s: created %s, '
+                     'skipped %s, failed %s', msg_id,
+                     len(result['created']), len(result['skipped']),
+                     len(result['failed']))
+
+
+def fetch_overdue_profile(application_id):
+    """ 返回 (gold_app, loan_success_times)，请求失败时抛出 ValueError """
+    gold_eye = GoldenEye().get('/applications/%s' % application_id)
+    if not gold_eye.ok:
+        raise ValueError('Request to GoldenEye failed')
+    gold_app = gold_eye.json().get('data')
+
+    apply_history = Dashboard().get('/users/%s/apply-history' %
+                                    gold_app['user_id'])
+    if not apply_history.ok:
+        raise ValueError('Request to Dashboard failed')
+    history = apply_history.json().get('data')
+    return gold_app, count_loan_success(history, gold_app)
+
+
+def applications_overdue(items):
+    """
+    application_overdue 的批量版本，items: [(application_id, sub_bill_id)]
+    - 子账单一次请求 BillService，催收单、子账单和 escalation 在一个事务里
+      insert_many
+    - 判断逻辑与 application_overdue 一致，同一批次里同一个分期单的多个子账单
+      和依次处理时一样合并到同一个催收单
+    返回 {'created': [...], 'skipped': [...], 'failed': [(item, reason)]}
+    """
+    result = {'created': [], 'skipped': [], 'failed': []}
+
+    def skip(item, reason):
+        logging.info('application %s,sub_bill_id %s overdue, %s',
+                     item[0], item[1], reason)
+        result['skipped'].append(item)
+
+    def fail(item, reason):
+        logging.error('application %s,sub_bill_id %s overdue failed: %s',
+                      item[0], item[1], reason)
+        result['failed'].append((item, reason))
+
+    items = list(OrderedDict.fromkeys(items))
+    app_ids = list({app_id for app_id, _ in items})
+
+    local_apps = {}
+    for local_app in (Application.select()
+                      .where(Application.external_id << app_ids)
+                      .order_by(Application.finished_at)):
+        local_apps.setdefault(local_app.external_id, local_app)
+
+    staging_ids = [app_id for app_id, local_app in local_apps.items()
+                   if local_app.type ==
+                   ApplicationType.CASH_LOAN_STAGING.value]
+    exists_bills = set()
+    if staging_ids:
+        exists_bills = {(ob.external_id, ob.sub_bill_id) for ob in
+                        (OverdueBillR
+                         .select(OverdueBillR.external_id,
+                                 OverdueBillR.sub_bill_id)
+                         .where(OverdueBillR.external_id << staging_ids))}
+
+    # 已经存在的非分期催收单只补充联系人
+    contact_apps = OrderedDict()
+    pending = []
+    for item in items:
+        local_app = local_apps.get(item[0])
+        if (local_app and
+                local_app.type != ApplicationType.CASH_LOAN_STAGING.value):
+            contact_apps[local_app.id] = local_app
+            skip(item, 'already exists')
+            continue
+        if local_app and item in exists_bills:
+            skip(item, 'already exists')
+            continue
+        pending.append(item)
+
+    sub_bills = {}
+    if pending:
+        try:
+            sub_bills = {int(b['id']): b for b in BillService().sub_bill_list(
+                bill_sub_ids=[sub_bill_id for _, sub_bill_id in pending])}
+        except Exception as e:
+            for item in pending:
+                fail(item, 'get sub_bill info failed: %s' % str(e))
+            pending = []
+
+    candidates = []
+    for item in pending:
+        sub_bill = sub_bills.get(item[1])
+        if not sub_bill:
+            fail(item, 'sub_bill not found')
+        elif sub_bill['status'] == 2:
+            skip(item, 'bills already cleared')
+        elif not sub_bill.get('overdue_days', 0):
+            skip(item, 'no overdue')
+        else:
+            candidates.append((item, sub_bill))
+
+    # 追加到未还完的分期催收单的子账单不需要用户信息
+    profile_ids = set()
+    for (app_id, _), sub_bill in candidates:
+        local_app = local_apps.get(app_id)
+        if (sub_bill['category'] != ApplicationType.CASH_LOAN_STAGING.value
+                or not local_app
+                or local_app.status == ApplicationStatus.REPAID.value):
+            profile_ids.add(app_id)
+    profile_futures = {app_id: overdue_profile_pool.submit(
+                           fetch_overdue_profile, app_id)
+                       for app_id in profile_ids}
+    ptp_infos = {}
+    if app_ids:
+        for ptp_info in (BombingHistory.select()
+                         .where(BombingHistory.application << app_ids)):
+            ptp_infos.setdefault(ptp_info.application_id, ptp_info)
+
+    new_apps = OrderedDict()
+    updated_apps = {}
+    overdue_bills = []
+    created = []
+    for item, sub_bill in candidates:
+        app_id, sub_bill_id = item
+        local_app = local_apps.get(app_id)
+        bill_fields = overdue_bill_fields(app_id, app_id, sub_bill_id,
+                                          sub_bill)
+        is_staging = (sub_bill['category'] ==
+                      ApplicationType.CASH_LOAN_STAGING.value)
+        new_app = new_apps.get(app_id)
+        if new_app:
+            # 本批次里已经新建了催收单
+            if new_app['type'] != ApplicationType.CASH_LOAN_STAGING.value:
+                skip(item, 'already exists')
+                continue
+            if not is_staging:
+                fail(item, 'application already exists')
+                continue
+            bill_fields['collection_id'] = new_app['id']
+            new_app['amount'] += sub_bill.get('amount')
+            new_app['amount_net'] += sub_bill.get('amount_net')
+            overdue_bills.append(bill_fields)
+            created.append(item)
+            continue
+        if (is_staging and local_app and
+                local_app.status != ApplicationStatus.REPAID.value):
+            bill_fields['collection_id'] = local_app.id
+            local_app.amount += sub_bill.get('amount')
+            local_app.amount_net += sub_bill.get('amount_net')
+            updated_apps[local_app.id] = local_app
+            overdue_bills.append(bill_fields)
+            created.append(item)
+            continue
+
+        try:
+            gold_app, loan_success_times = profile_futures[app_id].result()
+        except Exception as e:
+            fail(item, str(e))
+            continue
+        if is_staging:
+            id, type = idg(), ApplicationType.CASH_LOAN_STAGING.value
+        else:
+            id, type = app_id, ApplicationType.CASH_LOAN.value
+        new_apps[app_id] = overdue_application_fields(
+            id, type, app_id, gold_app, sub_bill, loan_success_times,
+            ptp_infos.get(id))
+        bill_fields['collection_id'] = id
+        overdue_bills.append(bill_fields)
+        created.append(item)
+
+    if overdue_bills:
+        try:
+            insert_overdue_applications(list(new_apps.values()),
+                                        updated_apps.values(), overdue_bills)
+        except Exception as e:
+            # 整批写入失败时拆成单条消息重新入催，互不影响
+            logging.error('application overdue batch insert failed: %s',
+                          str(e))
+            with MessagePublisher() as publisher:
+                for item in created:
+                    publisher.send_to_default_q(
+                        MessageAction.APPLICATION_BOMBER,
+                        {'id': item[0], 'bill_sub_id': item[1]})
+            result['failed'].extend((item, 'resent: %s' % str(e))
+                                    for item in created)
+        else:
+            result['created'].extend(created)
+            for new_app in new_apps.values():
+                logging.info('overdue application %s created',
+                             new_app['external_id'])
+                contact_apps[new_app['id']] = Application(**new_app)
+
+    for application in contact_apps.values():
+        try:
+            add_contact(application)
+        except Exception as e:
+            logging.error('application %s add contact failed: %s',
+                          application.external_id, str(e))
+    return result
+
+
+def insert_overdue_applications(new_apps, updated_apps, overdue_bills):
+    # new overdue application equals to 'escalate from 0 to 1'
+    escalations = [{
+        'application': new_app['id'],
+        'type': EscalationType.AUTOMATIC.value,
+        'status': ApprovalStatus.APPROVED.value,
+        'current_cycle': 0,
+        'escalate_to': 1,
+    } for new_app in new_apps]
+    with db.atomic():
+        for local_app in updated_apps:
+            local_app.save()
+        if new_apps:
+            Application.insert_many(new_apps).execute()
+            Escalation.insert_many(escalations).execute()
+        OverdueBill.insert_many(overdue_bills).execute()
+
+
+# add_contact 中的外部请求互不依赖，放到线程池里并发发出
+contact_fetch_pool = ThreadPoolExecutor(max_workers=16)
+# applications_overdue 请求用户信息用单独的线程池，和 add_contact 互不占用
+overdue_profile_pool = ThreadPoolExecutor(max_workers=8)
+
+
+class ContactSources(object):
+    """
+    add_contact 的外部号码来源，构造时全部提交到线程池
+    - 等待时间从提交时开始算，所有来源共用一个截止时间
+    - 超时或抛出异常的来源 get 返回 None，调用处和请求失败一样处理
+    - close 取消还没开始执行的请求
+    """
+
+    def __init__(self, calls, wait, pool=contact_fetch_pool):
+        self.deadline = time.monotonic() + wait
+        self.futures = OrderedDict((name, pool.submit(call))
+                                   for name, call in calls.items())
+
+    def get(self, name):
+        future = self.futures[name]
+        try:
+            return future.result(max(self.deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            future.cancel()
+            logging.error('fetch contact source %s timeout', name)
+        except Exception as e:
+            logging.error('fetch contact source %s error: %s', name, str(e))
+        return None
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+
+
+def fetch_contact_sources(application):
+    """
+    并发请求 add_contact 需要的所有外部号码来源，返回 ContactSources
+    - goldeneye 请求带上连接/读取超时
+    - 所有来源最多等待 contact_fetch_timeout 的三倍，
+      AccountService 的一次调用里可能有多个请求
+    """
+    timeout = app.config.get('worker.contact_fetch_timeout', 10)
+    golden_eye = GoldenEye()
+    account = AccountService()
+
+    def golden_eye_get(endpoint):
+        return partial(golden_eye.get, endpoint, timeout=(3, timeout))
+
+    user_id = application.user_id
+    external_id = application.external_id
+    calls = {
+        'extra_phone': golden_eye_get('/users/%s/extra-phone' % user_id),
+        'sms_contacts': golden_eye_get(
+            '/applications/%s/sms-contacts' % external_id),
+        'call_frequency': golden_eye_get(
+            '/applications/%s/call/frequency' % external_id),
+        'family_member': golden_eye_get(
+            '/applications/%s/contact/family-member' % external_id),
+        'online_profile': partial(account.add_contact, user_id),
+        'dual_contact': golden_eye_get('/bomber/%s/dual_contact' % user_id),
+        'ktp_number': partial(account.ktp_number,
+                              path_params={'user_id': user_id}),
+        'ec': golden_eye_get('/applications/%s/contact/ec' % external_id),
+        'my_number': golden_eye_get(
+            '/applications/%s/contact/my_number' % external_id),
+        'company_number': golden_eye_get(
+            '/applications/%s/contact/company-number' % external_id),
+        'other_login': partial(account.other_login_contact, userId=user_id),
+    }
+    return ContactSources(calls, timeout * 3)
+
+
 def add_contact(application):
 
     logging.info('start add contact for application: %s', application.id)
 
-    # 添加联系人信息
-    contacts = Contact.filter(
-        Contact.user_id == application.user_id,
-    )
-    existing_numbers = {contact.number for contact in contacts}
+    # 外部请求先全部发出，下面按原来的优先级顺序合并结果
+    sources = fetch_contact_sources(application)
+    try:
+        _add_contact(application, sources)
+    finally:
+        sources.close()
 
-    insert_contacts = list()
+
+def _add_contact(application, sources):
+    # 添加联系人信息
+    upsert = ContactUpsert(application.user_id)
 
     mon_insert_contact = {}
     # applicant
-    user_mobile_no = number_strip(application.user_mobile_no)
-    if user_mobile_no and user_mobile_no not in existing_numbers:
-        insert_contacts.append({
-            'user_id': application.user_id,
-            'name': application.user_name,
-            'number': user_mobile_no,
-            'relationship': Relationship.APPLICANT.value,
-            'source': 'apply info',
-            'real_relationship': Relationship.APPLICANT.value
-        })
-        existing_numbers.add(number_strip(application.user_mobile_no))
+    user_mobile_no = normalize_number(application.user_mobile_no)
+    upsert.add(user_mobile_no, application.user_name,
+               Relationship.APPLICANT.value, 'apply info')
 
-    extra_phone = GoldenEye().get(
-        '/users/%s/extra-phone' % application.user_id
-    )
-    if not extra_phone.ok:
+    extra_phone = sources.get('extra_phone')
+    if extra_phone is None or not extra_phone.ok:
         extra_phone = []
         logging.error('get user %s extra contacts failed',
                       application.user_id)
     else:
         extra_phone = extra_phone.json()['data']
 
-    if extra_phone:
-        for i in extra_phone:
-            number = number_strip(i['number'])[:64]
-            if not number:
-                continue
-            if number in existing_numbers:
-                continue
-            insert_contacts.append({
-                'user_id': application.user_id,
-                'name': application.user_name,
-                'number': number,
-                'relationship': Relationship.APPLICANT.value,
-                'source': 'extra phone',
-                'real_relationship': Relationship.APPLICANT.value
-            })
+    for i in extra_phone:
+        number = upsert.add(i['number'], application.user_name,
+                            Relationship.APPLICANT.value, 'extra phone')
+        if number:
             key = user_mobile_no, number, ContactType.A_EXTRA_PHONE.value
             mon_insert_contact[key] = 1, 0, application.user_name
-        existing_numbers.add(number)
 
     # family
     # ec contact
-    ec_contact = []
     contact = json.loads(application.contact or '[]')
     for i in contact:
-        if (number_strip(i['mobile_no']) not in existing_numbers and
-                number_strip(i['mobile_no'])):
-            ec_contact.append({
-                'user_id': application.user_id,
-                'name': i['name'],
-                'number': number_strip(i['mobile_no']),
-                'relationship': Relationship.FAMILY.value,
-                'sub_relation': SubRelation.EC.value,
-                'source': FamilyContactType.EC.value,
-                'real_relationship': Relationship.FAMILY.value
-            })
-            key = (user_mobile_no,
-                   number_strip(i['mobile_no']),
-                   ContactType.F_EC.value)
-            mon_insert_contact[key] = 1, 0, i['name']
-            existing_numbers.add(number_strip(i['mobile_no']))
-        if i['type'] != 1:
-            continue
-        if (number_strip(i['tel_no']) not in existing_numbers and
-                number_strip(i['tel_no'])):
-            ec_contact.append({
-                'user_id': application.user_id,
-                'name': i['name'],
-                'number': number_strip(i['tel_no']),
-                'relationship': Relationship.FAMILY.value,
-                'sub_relation': SubRelation.EC.value,
-                'source': FamilyContactType.EC.value,
-                'real_relationship': Relationship.FAMILY.value
-            })
-            key = (user_mobile_no,
-                   number_strip(i['tel_no']),
-                   ContactType.F_EC.value)
-            mon_insert_contact[key] = 1, 0, i['name']
-            existing_numbers.add(number_strip(i['tel_no']))
-
-    if ec_contact:
-        Contact.insert_many(ec_contact).execute()
+        ec_numbers = [i['mobile_no']]
+        if i['type'] == 1:
+            ec_numbers.append(i['tel_no'])
+        for ec_number in ec_numbers:
+            number = upsert.add(ec_number, i['name'],
+                                Relationship.FAMILY.value,
+                                FamilyContactType.EC.value,
+                                sub_relation=SubRelation.EC.value)
+            if number:
+                key = user_mobile_no, number, ContactType.F_EC.value
+                mon_insert_contact[key] = 1, 0, i['name']
+
+    # 每部分号码处理完就写入，后面的来源出错不影响已经处理的号码
+    upsert.flush()
 
     # company
-    if all((application.job_tel,
-            number_strip(application.job_tel),
-            number_strip(application.job_tel) not in existing_numbers)):
-        insert_contacts.append({
-            'user_id': application.user_id,
-            'name': None,
-            'number': number_strip(application.job_tel),
-            'relationship': Relationship.COMPANY.value,
-            'source': 'basic info job_tel',
-            'real_relationship': Relationship.COMPANY.value
-        })
-        key = (user_mobile_no,
-               number_strip(application.job_tel),
-               ContactType.C_BASIC_INFO_JOB_TEL.value)
-        mon_insert_contact[key] = 1, 0, None
-        existing_numbers.add(number_strip(application.job_tel))
+    if application.job_tel:
+        number = upsert.add(application.job_tel, None,
+                            Relationship.COMPANY.value, 'basic info job_tel')
+        if number:
+            key = (user_mobile_no,
+                   number,
+                   ContactType.C_BASIC_INFO_JOB_TEL.value)
+            mon_insert_contact[key] = 1, 0, None
 
     # suggested
 
-    sms_contacts = GoldenEye().get(
-        '/applications/%s/sms-contacts' % application.external_id
-    )
-    if not sms_contacts.ok:
+    sms_contacts = sources.get('sms_contacts')
+    if sms_contacts is None or not sms_contacts.ok:
         sms_contacts = []
         logging.info('get user %s sms contacts failed', application.external_id)
     else:
         sms_contacts = sms_contacts.json()['data']
 
-    if sms_contacts:
-        for i in sms_contacts:
-            number = number_strip(i['number'])[:64]
-            if not number:
-                continue
-            if number in existing_numbers:
-                continue
-            insert_contacts.append({
-                'user_id': application.user_id,
-                'name': i['name'][:128],
-                'number': number,
-                'relationship': Relationship.SUGGESTED.value,
-                'source': 'sms contacts',
-                'real_relationship': Relationship.SUGGESTED.value
-            })
+    for i in sms_contacts:
+        number = upsert.add(i['number'], i['name'],
+                            Relationship.SUGGESTED.value, 'sms contacts')
+        if number:
             key = (user_mobile_no,
                    number,
                    ContactType.S_SMS_CONTACTS.value)
             mon_insert_contact[key] = 1, 0, i['name'][:128]
-            existing_numbers.add(number)
 
-    if insert_contacts:
-        Contact.insert_many(insert_contacts).execute()
+    upsert.flush()
 
-    cf = GoldenEye().get(
-        '/applications/%s/call/frequency' % application.external_id
-    )
-    if not cf.ok:
+    cf = sources.get('call_frequency')
+    if cf is None or not cf.ok:
         call_frequency = []
         logging.error('get application %s call frequency error',
                       application.external_id)
     else:
         call_frequency = cf.json()['data']
 
-    # 结构不一样，重新生成
-    insert_contacts = []
-    fm = GoldenEye().get(
-        '/applications/%s/contact/family-member' % application.external_id
-    )
-    if not fm.ok:
+    fm = sources.get('family_member')
+    if fm is None or not fm.ok:
         family = []
         logging.error('get application %s family-member info error',
                       application.external_id)
     else:
         family = fm.json()['data']
-    if family:
-        for i in family:
-            if not (i.get('number')):
-                logging.info('family member %s' % str(i))
-                continue
-            number = number_strip(i['number'])[:64]
-            if not number:
-                continue
-            if number in existing_numbers:
-                continue
+    for i in family:
+        if not (i.get('number')):
+            logging.info('family member %s' % str(i))
+            continue
+        number = upsert.add(i['number'], i['name'],
+                            Relationship.FAMILY.value,
+                            FamilyContactType.CALLEC.value,
+                            total_count=i.get('total_count', 1),
+                            total_duration=i.get('total_duration', 0))
+        if number:
             logging.info('family members: %s' % str(i))
-            insert_contacts.append({
-                'user_id': application.user_id,
-                'name': i['name'][:128],
-                'number': number,
-                'relationship': Relationship.FAMILY.value,
-                'source': FamilyContactType.CALLEC.value,
-                'total_count': i.get('total_count', 1),
-                'total_duration': i.get('total_duration', 0),
-                'real_relationship': Relationship.FAMILY.value
-            })
             key = user_mobile_no, number, ContactType.F_CALL_EC.value
             mon_insert_contact[key] = (i.get('total_count', 1),
                                        i.get('total_duration', 0),
                                        i['name'][:128])
-            existing_numbers.add(number)
 
     mon_update_contact = {}
-    if call_frequency:
-        with db.atomic():
-            count = 1
-            for i in call_frequency:
-                number = number_strip(i['number'])[:64]
-                if not number:
-                    continue
-                if number in existing_numbers:
-                    (Contact
-                     .update(total_count=i['total_count'],
-                             total_duration=i['total_duration'])
-                     .where(Contact.number == number,
-                            Contact.user_id == application.user_id))
-                    key = user_mobile_no, number
-                    mon_update_contact[key] = (i['total_count'],
-                                               i['total_duration'])
-                    continue
+    count = 1
+    for i in call_frequency:
+        if upsert.exists(i['number']):
+            number = upsert.update_frequency(i['number'], i['total_count'],
+                                             i['total_duration'])
+            key = user_mobile_no, number
+            mon_update_contact[key] = (i['total_count'],
+                                       i['total_duration'])
+            continue
 
-                # 设置通话频率最多的五个为family member
-                if count < 6:
-                    insert_contacts.append({
-                        'user_id': application.user_id,
-                        'name': i['name'][:128],
-                        'number': number,
-                        'relationship': Relationship.FAMILY.value,
-                        'total_count': i['total_count'],
-                        'total_duration': i['total_duration'],
-                        'source': FamilyContactType.CALLTOP5.value,
-                        'real_relationship': Relationship.FAMILY.value
-                    })
-                    count += 1
-                    key = user_mobile_no, number, ContactType.F_CALL_TOP5.value
-                    mon_insert_contact[key] = (i['total_count'],
-                                               i['total_duration'],
-                                               i['name'][:128])
-                else:
-                    insert_contacts.append({
-                        'user_id': application.user_id,
-                        'name': i['name'][:128],
-                        'number': number,
-                        'relationship': Relationship.SUGGESTED.value,
-                        'total_count': i['total_count'],
-                        'total_duration': i['total_duration'],
-                        'source': 'call frequency',
-                        'real_relationship': Relationship.SUGGESTED.value
-                    })
-                    key = (user_mobile_no,
-                           number,
-                           ContactType.S_CALL_FREQUENCY.value)
-                    mon_insert_contact[key] = (i['total_count'],
-                                               i['total_duration'],
-                                               i['name'][:128])
-
-                existing_numbers.add(number)
-            if insert_contacts:
-                Contact.insert_many(insert_contacts).execute()
+        # 设置通话频率最多的五个为family member
+        if count < 6:
+            number = upsert.add(i['number'], i['name'],
+                                Relationship.FAMILY.value,
+                                FamilyContactType.CALLTOP5.value,
+                                total_count=i['total_count'],
+                                total_duration=i['total_duration'])
+            if not number:
+                continue
+            count += 1
+            key = user_mobile_no, number, ContactType.F_CALL_TOP5.value
+        else:
+            number = upsert.add(i['number'], i['name'],
+                                Relationship.SUGGESTED.value,
+                                'call frequency',
+                                total_count=i['total_count'],
+                                total_duration=i['total_duration'])
+            if not number:
+                continue
+            key = (user_mobile_no,
+                   number,
+                   ContactType.S_CALL_FREQUENCY.value)
+        mon_insert_contact[key] = (i['total_count'],
+                                   i['total_duration'],
+                                   i['name'][:128])
+
+    upsert.flush()
 
     # 信用认证号码加入到本人
-    next_apply_list = (AccountService().add_contact(application.user_id))
+    next_apply_list = sources.get('online_profile') or []
 
     for next_apply in next_apply_list:
-        number = number_strip(str(next_apply))[:64]
-        if number and number not in existing_numbers:
-            Contact.create(
-                user_id=application.user_id,
-                name=application.user_name,
-                number=number,
-                relationship=Relationship.SUGGESTED.value,
-                source='online profile phone',
-                real_relationship=Relationship.SUGGESTED.value
-            )
+        number = upsert.add(next_apply, application.user_name,
+                            Relationship.SUGGESTED.value,
+                            'online profile phone')
+        if number:
             key = (user_mobile_no,
                    number,
                    ContactType.S_ONLINE_PROFILE_PHONE.value)
             mon_insert_contact[key] = 1, 0, application.user_name
-            existing_numbers.add(number)
 
     # 双卡手机另一个号码加入到本人队列
-    next_applicant = GoldenEye().get(
-        '/bomber/%s/dual_contact' % application.user_id
-    )
-    if not next_applicant.ok:
+    next_applicant = sources.get('dual_contact')
+    if next_applicant is None or not next_applicant.ok:
         next_applicant = []
         logging.error('get user %s dual_contact contacts failed'
                       % application.user_id)
     else:
         next_applicant = next_applicant.json()['data']
 
-    if next_applicant:
-        for i in next_applicant:
-            number = number_strip(str(i))[:64]
-            if number and number not in existing_numbers:
-                Contact.create(
-                    user_id=application.user_id,
-                    name=application.user_name,
-                    number=number,
-                    relationship=Relationship.APPLICANT.value,
-                    source='apply info',
-                    real_relationship=Relationship.APPLICANT.value
-                )
-                key = user_mobile_no, number, ContactType.A_APPLY_INFO.value
-                mon_insert_contact[key] = 1, 0, application.user_name
-                existing_numbers.add(number)
-            logging.info('get user %s dual_contact contacts success' %
-                         application.user_id)
+    for i in next_applicant:
+        number = upsert.add(i, application.user_name,
+                            Relationship.APPLICANT.value, 'apply info')
+        if number:
+            key = user_mobile_no, number, ContactType.A_APPLY_INFO.value
+            mon_insert_contact[key] = 1, 0, application.user_name
+        logging.info('get user %s dual_contact contacts success' %
+                     application.user_id)
+
+    upsert.flush()
 
     # add new contact
     # 将同个ktp注册的多个号码添加到本人
-    numbers = []
-    try:
-        numbers = (AccountService()
-                   .ktp_number(path_params={'user_id': application.user_id}))
-    except Exception as e:
-        logging.info('request ktp numbers failed %s' % str(e))
+    numbers = sources.get('ktp_number') or []
 
     for n in numbers:
-        number = number_strip(str(n))[:64]
-        if number and number not in existing_numbers:
-            Contact.create(
-                user_id=application.user_id,
-                name=application.user_name,
-                number=number,
-                relationship=Relationship.APPLICANT.value,
-                source='ktp number',
-                real_relationship=Relationship.APPLICANT.value
-            )
+        number = upsert.add(n, application.user_name,
+                            Relationship.APPLICANT.value, 'ktp number')
+        if number:
             key = (user_mobile_no,
                    number,
                    ContactType.A_KTP_NUMBER.value)
             mon_insert_contact[key] = 1, 0, application.user_name
-            existing_numbers.add(number)
         logging.info('get user %s dual_contact contacts success'
                      % application.user_id)
 
+    upsert.flush()
+
     # 将contact表中is_family为true的标记为ec
+    ecs = sources.get('ec')
     try:
-        ecs = GoldenEye().get(
-            '/applications/%s/contact/ec' % application.external_id
-        )
-    except Exception as e:
-        logging.info('request ec-member error: %s' % str(e))
-    try:
-        if not ecs.ok:
+        if ecs is None or not ecs.ok:
             ec = []
             logging.info('get application %s ec-member info error',
                          application.external_id)
         else:
             ec = ecs.json()['data']
 
-        if ec:
-            for e in ec:
-                number = number_strip(e['numbers'])[:64]
-                if not number:
-                    continue
-                if number not in existing_numbers:
-                    Contact.create(
-                        user_id=application.user_id,
-                        name=e['name'][:128],
-                        number=number,
-                        relationship=Relationship.FAMILY.value,
-                        source=FamilyContactType.CONTACTEC.value,
-                        real_relationship=Relationship.FAMILY.value
-                    )
-                    key = (user_mobile_no,
-                           number,
-                           ContactType.F_CONTACT_EC.value)
-                    mon_insert_contact[key] = 1, 0, e['name'][:128]
-                    existing_numbers.add(number)
+        for e in ec:
+            number = upsert.add(e['numbers'], e['name'],
+                                Relationship.FAMILY.value,
+                                FamilyContactType.CONTACTEC.value)
+            if number:
+                key = (user_mobile_no,
+                       number,
+                       ContactType.F_CONTACT_EC.value)
+                mon_insert_contact[key] = 1, 0, e['name'][:128]
+        upsert.flush()
     except Exception as e:
         logging.info('add ec_member error:%s' % str(e))
 
     # 将contact中is_me标记为true的标记为本人
+    mn = sources.get('my_number')
     try:
-        mn = GoldenEye().get(
-            '/applications/%s/contact/my_number' % application.external_id
-        )
-    except Exception as e:
-        logging.info('request my_number error: %s' % str(e))
-    try:
-        if not mn.ok:
+        if mn is None or not mn.ok:
             my = []
             logging.info('get application %s my_number info error',
                          application.external_id)
         else:
             my = mn.json()['data']
 
-        if my:
-            for m in my:
-                number = number_strip(m)[:64]
-                if not number:
-                    continue
-                if number not in existing_numbers:
-                    Contact.create(
-                        user_id=application.user_id,
-                        name=my[m][:128],
-                        number=number,
-                        relationship=Relationship.SUGGESTED.value,
-                        source='my number',
-                        real_relationship=Relationship.SUGGESTED.value
-                    )
-                    key = user_mobile_no, number, ContactType.S_MY_NUMBER.value
-                    mon_insert_contact[key] = 1, 0, my[m][:128]
-                    existing_numbers.add(number)
+        for m in my:
+            number = upsert.add(m, my[m], Relationship.SUGGESTED.value,
+                                'my number')
+            if number:
+                key = user_mobile_no, number, ContactType.S_MY_NUMBER.value
+                mon_insert_contact[key] = 1, 0, my[m][:128]
+        upsert.flush()
     except Exception as e:
         logging.info('add my_member error:%s' % str(e))
 
     # 得到company的号码
+    cn = sources.get('company_number')
     try:
-        cn = GoldenEye().get(
-            '/applications/%s/contact/company-number' % application.external_id
-        )
-    except Exception as e:
-        logging.info('request company-number error: %s' % str(e))
-    try:
-        if not cn.ok:
+        if cn is None or not cn.ok:
             cn = []
             logging.info('get application %s company_number info error',
                          application.external_id)
         else:
             cn = cn.json()['data']
 
-        if cn:
-            for c in cn:
-                number = c
-                if not number:
-                    continue
-                if number not in existing_numbers:
-                    Contact.create(
-                        user_id=application.user_id,
-                        name=cn[c][:128],
-                        number=number,
-                        relationship=Relationship.COMPANY.value,
-                        source='company',
-                        real_relationship=Relationship.COMPANY.value
-                    )
-                    key = user_mobile_no, number, ContactType.C_COMPANY.value
-                    mon_insert_contact[key] = 1, 0, cn[c][:128]
-                    existing_numbers.add(number)
+        for c in cn:
+            number = upsert.add(c, cn[c], Relationship.COMPANY.value,
+                                'company')
+            if number:
+                key = user_mobile_no, number, ContactType.C_COMPANY.value
+                mon_insert_contact[key] = 1, 0, cn[c][:128]
+        upsert.flush()
     except Exception as e:
         logging.info('add company_member error:%s' % str(e))
 
     # 得到本人在其他设备上登陆的sim联系方式，加入applicant中
-    try:
-        ol = (AccountService()
-              .other_login_contact(userId=application.user_id))
-    except Exception as e:
-        logging.error('request other_login error: %s' % e)
-        ol = {}
+    ol = sources.get('other_login') or {}
 
     try:
         for o in ol:
-            number = number_strip(o)
-            if not number:
-                continue
-            if number not in existing_numbers:
-                Contact.create(
-                    user_id=application.user_id,
-                    name=ol[o][:128],
-                    number=number,
-                    relationship=Relationship.SUGGESTED.value,
-                    source='other_login',
-                    real_relationship=Relationship.SUGGESTED.value
-                )
+            number = upsert.add(o, ol[o], Relationship.SUGGESTED.value,
+                                'other_login')
+            if number:
                 key = (user_mobile_no,
                        number,
                        ContactType.S_OTHER_LOGIN.value)
                 mon_insert_contact[key] = 1, 0, ol[o][:128]
+        upsert.flush()
     except Exception as e:
         logging.error('add other_login number error:%s' % e)
 
-    logging.info('add contact for application %s finished', application.id)
+    logging.info('add contact for application %s finished: %s',
+                 application.id, upsert.total)
     if mon_insert_contact or mon_update_contact:
         send_to_default_q(MessageAction.IMPORT_CONTACT_TO_MON,
                           {
                               'user_mobile_no': user_mobile_no,
-                              'insert_contact': str(mon_insert_contact),
-                              'update_contact': str(mon_update_contact),
+                              'insert_contact': [
+                                  {'number': dn,
+                                   'source': s,
+                                   'total_count': tc,
+                                   'total_duration': td,
+                                   'name': na}
+                                  for (_, dn, s), (tc, td, na)
+                                  in mon_insert_contact.items()],
+                              'update_contact': [
+                                  {'number': dn,
+                                   'total_count': tc,
+                                   'total_duration': td}
+                                  for (_, dn), (tc, td)
+                                  in mon_update_contact.items()],
                               'user_id': application.user_id,
                               'name': application.user_name
                           })
 
 
-@action(MessageAction.IMPORT_CONTACT_TO_MON)
+def parse_mon_contacts(payload):
+    """
+    IMPORT_CONTACT_TO_MON 中的 insert_contact 和 update_contact
+    - insert_contact: [{'number', 'source', 'total_count', 'total_duration',
+      'name'}]
+    - update_contact: [{'number', 'total_count', 'total_duration'}]
+    兼容以前用 str(dict) 发出的消息
+    """
+    insert_contact = payload.get('insert_contact') or []
+    update_contact = payload.get('update_contact') or []
+    if isinstance(insert_contact, str):
+        insert_contact = [{'number': dn,
+                           'source': s,
+                           'total_count': tc,
+                           'total_duration': td,
+                           'name': na}
+                          for (_, dn, s), (tc, td, na)
+                          in literal_eval(insert_contact).items()]
+    if isinstance(update_contact, str):
+        update_contact = [{'number': dn,
+                           'total_count': tc,
+                           'total_duration': td}
+                          for (_, dn), (tc, td)
+                          in literal_eval(update_contact).items()]
+    return insert_contact, update_contact
+
+
+@action(MessageAction.IMPORT_CONTACT_TO_MON, dedup_content=True)
 def import_contact_to_mon(payload, msg_id):
     user_mobile_no = payload['user_mobile_no']
-    insert_contact = eval(payload['insert_contact'])
-    update_contact = eval(payload['update_contact'])
+    insert_contact, update_contact = parse_mon_contacts(payload)
     user_id = payload['user_id']
     name = payload['name']
 
@@ -1212,39 +1424,43 @@ def import_contact_to_mon(payload, msg_id):
         })
         return
 
-    contacts = TotalContact.objects(src_number=user_mobile_no, is_calc=False)
-    insert_list = []
-    for c in contacts:
-        key = (user_mobile_no, c.dest_number, c.source)
-        if key in insert_contact:
-            insert_contact.pop(key)
-
-    for (sn, dn, s), (tc, td, na) in insert_contact.items():
-        insert_list.append({
-            'src_number': sn,
-            'src_name': name,
-            'dest_number': dn,
-            'dest_name': na,
-            'source': s,
-            'total_count': tc,
-            'total_duration': td
-        })
-
-    if insert_list:
-        insert_count = len((TotalContact
-                            .objects
-                            .insert([TotalContact(**dct)
-                                     for dct in insert_list])))
-        logging.info("insert success %s", insert_count)
-
-    update_count = 0
-    for (sn, dn), (tc, td) in update_contact.items():
+    # 已经存在的 (sn, dn, s) 不再插入，由 upsert 在 mongo 中判断
+    operations = []
+    # 同步更新 contact_edge
+    edge_operations = []
+    for c in insert_contact:
+        key = {'sn': user_mobile_no,
+               'dn': c['number'],
+               's': c['source'],
+               'is_c': False}
+        doc = TotalContact(src_number=user_mobile_no,
+                           src_name=name,
+                           dest_number=c['number'],
+                           dest_name=c['name'],
+                           source=c['source'],
+                           total_count=c['total_count'],
+                           total_duration=c['total_duration']).to_mongo()
+        doc = {k: v for k, v in doc.items() if k not in key}
+        operations.append(UpdateOne(key, {'$setOnInsert': doc}, upsert=True))
+        edge_operations.extend(contact_graph.add_edge_operations(
+            user_mobile_no, c['number'], c['source'], c['total_count'],
+            c['total_duration'], name, c['name']))
+
+    for c in update_contact:
+        operations.append(UpdateMany(
+            {'sn': user_mobile_no, 'dn': c['number'], 'is_c': False},
+            {'$set': {'tc': c['total_count'], 'td': c['total_duration']}}))
+        edge_operations.extend(contact_graph.update_weight_operations(
+            user_mobile_no, c['number'], c['total_count'],
+            c['total_duration']))
+
+    if operations:
         result = (TotalContact
-                  .objects(src_number=sn, dest_number=dn, is_calc=False)
-                  .update(total_count=tc, total_duration=td))
-        if result:
-            update_count += 1
-    logging.info("update success %s", update_count)
+                  ._get_collection()
+                  .bulk_write(operations, ordered=False))
+        logging.info("insert success %s, update success %s",
+                     result.upserted_count, result.matched_count)
+        contact_graph.apply_operations(edge_operations)
 
     drop_duplicated_contact({'numbers': [user_mobile_no]}, None)
     send_to_default_q(MessageAction.CONTACT_FROM_TOTAL, {
@@ -1266,105 +1482,102 @@ def drop_duplicated_contact(payload, msg_id):
     if not numbers:
         logging.error("no numbers should drop")
 
-    query = (TotalContact
-             .objects(Q(src_number__in=numbers) | Q(dest_number__in=numbers)))
-
-    contact_list = defaultdict(list)
-    delete_list = []
-    insert_list = []
-    for c in query:
-        if c.src_number == c.dest_number:
-            delete_list.append(c.id)
-
-        key = c.src_number, c.dest_number, c.source
-        contact_list[key].append({
-            'id': c.id,
-            'src_number': c.src_number,
-            'dest_number': c.dest_number,
-            'total_count': c.total_count,
-            'total_duration': c.total_duration,
-            'is_calc': c.is_calc,
-            'source': c.source,
-            'src_name': c.src_name,
-            'dest_name': c.dest_name
-        })
-
-    contact_list2 = deepcopy(contact_list)
-    for key, info in contact_list.items():
-        _info = sorted(info,
-                       key=lambda x: (not x['is_calc'],
-                                      x['total_count'],
-                                      x['total_duration']),
-                       reverse=True)
-        rs = _info[0]
-        if not rs['is_calc']:
-            contact_list2[(key[1], key[0], key[2])].append({
-                'src_number': rs['dest_number'],
-                'dest_number': rs['src_number'],
-                'total_count': rs['total_count'],
-                'total_duration': rs['total_duration'],
-                'is_calc': True,
-                'source': rs['source'],
-                'id': '',
-                'src_name': rs['dest_name'],
-                'dest_name': rs['src_name']
-            })
-            delete_ids = [i['id'] for i in _info[1:] if i['id']]
-            delete_list.extend(delete_ids)
-
-    for key, info in contact_list2.items():
-        _info = sorted(info,
-                       key=lambda x: (not x['is_calc'],
-                                      x['total_count'],
-                                      x['total_duration']),
-                       reverse=True)
-        rs = _info[0]
-        # 第一轮已经把不是反转的号码全部刷过
-        if not rs['is_calc']:
-            continue
-        if not rs['id']:
-            rs.pop('id')
-            insert_list.append(rs)
-
-        delete_ids = [i['id'] for i in _info[1:] if i['id']]
+    # 排序分组在 mongo 中完成，每次只处理一对号码
+    cursor = (TotalContact
+              ._get_collection()
+              .aggregate(dedup_pipeline(numbers), allowDiskUse=True))
+    delete_count = insert_count = 0
+    delete_list, insert_list = [], []
+    # contact_edge 和去重后的非反转记录保持一致
+    edge_operations = []
+    for group in cursor:
+        delete_ids, inserts = resolve_contact_edges(group['edges'])
         delete_list.extend(delete_ids)
+        insert_list.extend(inserts)
+        edge_operations.extend(graph_sync_operations(group['edges']))
+        if len(edge_operations) >= 1000:
+            contact_graph.apply_operations(edge_operations)
+            edge_operations = []
+        if len(delete_list) >= 1000:
+            delete_count += TotalContact.objects(id__in=delete_list).delete()
+            delete_list = []
+        if len(insert_list) >= 1000:
+            insert_count += len(TotalContact.objects.insert(
+                [TotalContact(**dct) for dct in insert_list]))
+            insert_list = []
 
     if delete_list:
-        delete_count = TotalContact.objects(id__in=delete_list).delete()
-        logging.info("numbers %s: delete success %s", numbers, delete_count)
-
+        delete_count += TotalContact.objects(id__in=delete_list).delete()
     if insert_list:
-        insert_count = len((TotalContact
-                            .objects
-                            .insert([TotalContact(**dct)
-                                     for dct in insert_list])))
-        logging.info("numbers %s: insert success %s", numbers, insert_count)
+        insert_count += len(TotalContact.objects.insert(
+            [TotalContact(**dct) for dct in insert_list]))
+    contact_graph.apply_operations(edge_operations)
+    logging.info("numbers %s: delete success %s, insert success %s",
+                 numbers, delete_count, insert_count)
+
+
+def graph_sync_operations(edges):
+    """
+    dedup_pipeline 一条结果对应的 contact_edge 操作
+    - 非反转记录按保留的那条更新通话次数和时长
+    - sn == dn 的记录会被删除，对应的边也删除
+    """
+    operations = []
+    for edge in edges:
+        best = edge['best']
+        if best['sn'] == best['dn']:
+            operations.extend(
+                contact_graph.remove_self_loop_operations([best['sn']]))
+        elif not best['is_c']:
+            operations.extend(contact_graph.sync_edge_operations(
+                best['sn'], best['dn'], best['s'], best['tc'], best['td'],
+                best.get('sa'), best.get('da')))
+    return operations
 
 
 def get_contact_from_mongo(number):
     if not number:
         return []
 
+    # relationship 和 str_source 的过滤放到查询条件里
+    sources = {}
+    for s in TotalContact.available():
+        relation = TotalContact.relationship(s)
+        source = TotalContact.str_source(s)
+        if relation != -1 and source:
+            sources[s] = relation, source
+
+    # 导入完 contact_edge 后打开，按号码一次查询所有联系人
+    if (app.config.get('worker.contact_graph_read', '')
+            .lower() in ('1', 'true', 'yes')):
+        return [{
+            'related_number': edge['number'],
+            'source': sources[edge['source']][1],
+            'is_calc': not edge['outgoing'],
+            'total_count': edge['total_count'],
+            'total_duration': edge['total_duration'],
+            'relation': sources[edge['source']][0],
+            'name': edge['name'],
+        } for edge in contact_graph.counterparties(number, sources)]
+
+    # 走 (sn, s) 索引，只取需要的字段，不生成 mongoengine 对象
     query = (TotalContact
-             .objects(src_number=number,
-                      source__in=TotalContact.available())
-             .order_by('source'))
+             ._get_collection()
+             .find({'sn': number, 's': {'$in': list(sources)}},
+                   {'_id': 0, 'dn': 1, 'da': 1, 's': 1, 'is_c': 1,
+                    'tc': 1, 'td': 1})
+             .sort('s', 1))
     lst = []
     for c in query:
-        relation = TotalContact.relationship(c.source)
-        if relation == -1:
-            continue
-        source = TotalContact.str_source(c.source)
-        if not source:
-            continue
+        relation, source = sources[c['s']]
         lst.append({
-            'related_number': c.dest_number,
+            'related_number': c.get('dn'),
             'source': source,
-            'is_calc': c.is_calc,
-            'total_count': c.total_count,
-            'total_duration': c.total_duration,
+            'is_calc': c.get('is_c', False),
+            'total_count': c.get('tc', 1),
+            'total_duration': c.get('td', 0),
             'relation': relation,
-            'name': c.dest_name
+            'name': c.get('da')
         })
     return lst
 
@@ -1381,32 +1594,16 @@ def contact_from_total(payload, msg_id):
         logging.error("contact from mongo is none")
         return
 
-    contacts = Contact.filter(Contact.user_id == user_id)
-    existing_numbers = {contact.number for contact in contacts}
-    contact_list = []
-
+    upsert = ContactUpsert(user_id)
     for c in result:
-        number = number_strip(c['related_number'])
-        if number in existing_numbers:
-            continue
-
-        contact_list.append({
-            'user_id': user_id,
-            'name': c['name'],
-            'number': number,
-            'relationship': c['relation'],
-            'source': c['source'],
-            'total_duration': c['total_duration'],
-            'total_count': c['total_count'],
-            'real_relationship': c['relation']
-        })
-        existing_numbers.add(number)
+        upsert.add(c['related_number'], c['name'], c['relation'],
+                   c['source'], total_count=c['total_count'],
+                   total_duration=c['total_duration'])
+    counts = upsert.flush()
+    logging.info('contact from total %s: %s', user_id, counts)
 
-    if contact_list:
-        Contact.insert_many(contact_list).execute()
 
-
-@action(MessageAction.BILL_REVOKE)
+@action(MessageAction.BILL_REVOKE, lane=Lane.REALTIME)
 def bill_revoke(payload, msg_id):
     application_id = payload['external_id']
     if 'bill_sub_id' not in payload:
@@ -1500,7 +1697,7 @@ def check_key_not_none(payload, keys):
 
 
 # 还款
-@action(MessageAction.BILL_PAID)
+@action(MessageAction.BILL_PAID, lane=Lane.REALTIME)
 def bill_paid(payload, msg_id):
     # Don't use validator, it will throw exception
     validate = check_key_not_none(payload,
@@ -1599,7 +1796,7 @@ def bill_paid(payload, msg_id):
         )
 
 
-@action(MessageAction.BILL_RELIEF)
+@action(MessageAction.BILL_RELIEF, lane=Lane.REALTIME)
 def bill_relief(payload, msg_id):
     """已废弃"""
     bill = payload['head_bill']
@@ -1614,8 +1811,8 @@ def bill_relief(payload, msg_id):
 
 
 # 还款完成，
-@action(MessageAction.BILL_CLEARED)
-@action(MessageAction.BILL_CLEARED_BEFORE_CONFIRM)
+@action(MessageAction.BILL_CLEARED, lane=Lane.REALTIME)
+@action(MessageAction.BILL_CLEARED_BEFORE_CONFIRM, lane=Lane.REALTIME)
 def bill_cleared(payload, msg_id):
     """
     BILL_CLEARED_BEFORE_CONFIRM仅在bomber系统中使用,MST清除账单时先修改其状态
@@ -1755,7 +1952,7 @@ def overdue_bill_sync(payload, msg_id):
         logging.info('overdue sync done, updated count: %s', updated_count)
 
 
-@action(MessageAction.BOMBER_CALC_OVERDUE_DAYS_OVER)
+@action(MessageAction.BOMBER_CALC_OVERDUE_DAYS_OVER, lane=Lane.BATCH)
 def calc_overdue_days_over(payload, msg_id):
     """
     Call by BOMBER_CALC_SUMMARY
@@ -1763,26 +1960,8 @@ def calc_overdue_days_over(payload, msg_id):
     :param msg_id:
     :return:
     """
-    #更新逾期天数大于95天的件
-    now = fn.NOW()
-    origin_diff_days = fn.DATEDIFF(now, Application.origin_due_at)
-    overdue_days = fn.GREATEST(origin_diff_days, SQL('0'))
-    query = (Application
-             .update(overdue_days=overdue_days)
-             .where(Application.status <<
-                    [ApplicationStatus.PROCESSING.value,
-                     ApplicationStatus.UNCLAIMED.value,
-                     ApplicationStatus.AB_TEST.value],
-                    Application.overdue_days > 95,
-                    Application.type == ApplicationType.CASH_LOAN.value))
-    updated_rows_count = query.execute()
-    logging.info('calc overdue days done, updated count: %s',
-                 updated_rows_count)
-
-    try:
-        calc_overdue_days_over_instalment()
-    except Exception as e:
-        logging.error("calc_overdue_days_over_instalment_error: %s"%str(e))
+    #更新逾期天数大于95天的件，和原来一样只有分期部分出错时继续执行
+    recalc_overdue_days(over=True, tolerate=('overdue_bill', 'instalment'))
 
     # 计算overdue_days后自动触发升级
     apps = Application.filter(
@@ -1793,56 +1972,16 @@ def calc_overdue_days_over(payload, msg_id):
         Application.promised_date.is_null(True) |
         (fn.DATE(Application.promised_date) < datetime.today().date()))
     ids = [i.id for i in apps]
-    for idx in range(0, len(ids), 100):
-        send_to_default_q(
-            MessageAction.BOMBER_AUTOMATIC_ESCALATION,
-            {'application_list': ids[idx:idx + 100]})
+    with MessagePublisher() as publisher:
+        for idx in range(0, len(ids), 100):
+            publisher.send_to_default_q(
+                MessageAction.BOMBER_AUTOMATIC_ESCALATION,
+                {'application_list': ids[idx:idx + 100]})
     send_to_default_q(MessageAction.UPDATE_OLD_LOAN_APPLICATION, {})
 
-# 计算逾期天数超过95天的件的逾期天数
-def calc_overdue_days_over_instalment():
-    now = fn.NOW()
-    origin_diff_days = fn.DATEDIFF(now, OverdueBill.origin_due_at)
-    overdue_days = fn.GREATEST(origin_diff_days, SQL('0'))
-    sub_bill_status_list = [ApplicationStatus.PROCESSING.value,
-                            ApplicationStatus.UNCLAIMED.value,
-                            ApplicationStatus.AB_TEST.value]
-    for status in sub_bill_status_list:
-        # 更新逾期天数
-        query = (OverdueBill.update(overdue_days=overdue_days)
-                 .where(OverdueBill.status == status,
-                        OverdueBill.overdue_days > 95))
-        updated_rows_count = query.execute()
-        logging.info("calc_overdue_days_over_instalment done,count:%s,status:%s" %
-                     (updated_rows_count, status))
-
-        # 获取所有的子账单信息
-        overdue_bills = (OverdueBill
-                         .select(OverdueBill.collection_id,
-                                 OverdueBill.overdue_days)
-                         .join(Application, JOIN_LEFT_OUTER,
-                               on=OverdueBill.collection_id == Application.id)
-                         .where(Application.status == status,
-                                (Application.type ==
-                                 ApplicationType.CASH_LOAN_STAGING.value)))
-        # 获取每个分期催收单要更新的逾期天数
-        app_update = {}
-        for ob in overdue_bills:
-            if ob.collection_id not in app_update:
-                app_update[ob.collection_id] = ob.overdue_days
-            else:
-                ob_days = max(app_update[ob.collection_id], ob.overdue_days)
-                app_update[ob.collection_id] = ob_days
-        # 更新催收单的逾期天数
-        for aid, a_days in app_update.items():
-            q = (Application.update(overdue_days=a_days)
-                 .where(Application.id == aid)
-                 .execute())
-    logging.info("update instalment application done")
 
-
-
-@action(MessageAction.BOMBER_CALC_OVERDUE_DAYS)
+@action(MessageAction.BOMBER_CALC_OVERDUE_DAYS,
+        concurrency=1, max_duration=1800, lane=Lane.BATCH)
 def calc_overdue_days(payload, msg_id):
     """
     Call by BOMBER_CALC_SUMMARY
@@ -1850,44 +1989,14 @@ def calc_overdue_days(payload, msg_id):
     :param msg_id:
     :return:
     """
-    now = fn.NOW()
-    origin_diff_days = fn.DATEDIFF(now, Application.origin_due_at)
-    overdue_days = fn.GREATEST(origin_diff_days, SQL('0'))
-    query_unclaimed = (Application
-                       .update(overdue_days=overdue_days)
-                       .where(Application.status ==
-                              ApplicationStatus.UNCLAIMED.value,
-                              Application.overdue_days <= 95,
-                              (Application.type ==
-                               ApplicationType.CASH_LOAN.value)))
-    updated_rows_count_unclaimed = query_unclaimed.execute()
-    logging.info('calc overdue days done, updated count: %s',
-                 updated_rows_count_unclaimed)
-
-    query_processing = (Application
-                        .update(overdue_days=overdue_days)
-                        .where(Application.status ==
-                               ApplicationStatus.PROCESSING.value,
-                               Application.overdue_days <= 95,
-                               (Application.type ==
-                                ApplicationType.CASH_LOAN.value)))
-    updated_rows_count_processing = query_processing.execute()
-    logging.info('calc overdue days done, updated count: %s',
-                 updated_rows_count_processing)
-
-    query_test = (Application
-                  .update(overdue_days=overdue_days)
-                  .where(Application.status ==
-                         ApplicationStatus.AB_TEST.value,
-                         Application.overdue_days <= 95,
-                         (Application.type ==
-                          ApplicationType.CASH_LOAN.value)))
-    updated_rows_count_test = query_test.execute()
-    logging.info('calc overdue days done, updated count: %s',
-                 updated_rows_count_test)
-
-    # 分期账单计算逾期天数
-    calc_overdue_days_instalment()
+    # 增量模式只写跨过 cycle 边界或到达分件日的行，见 bomber.overdue_days
+    # controllers.worker 中手动触发时 payload 为 None
+    incremental = (payload or {}).get('incremental')
+    if incremental is None:
+        incremental = (app.config.get('worker.overdue_days_incremental', '')
+                       .lower() in ('1', 'true', 'yes'))
+    # 现金贷、分期子账单和分期催收单各一条 UPDATE
+    recalc_overdue_days(incremental=incremental)
 
     # 计算overdue_days后自动触发升级
     apps = Application.select(Application.id).where(
@@ -1897,11 +2006,15 @@ def calc_overdue_days(payload, msg_id):
                 Application.overdue_days <= 95,
                 Application.promised_date.is_null(True) |
                 (fn.DATE(Application.promised_date) < datetime.today().date()))
+    if incremental:
+        # 只有逾期天数超出当前 cycle 的件需要升级
+        apps = apps.where(escalation_filter())
     ids = [i.id for i in apps]
-    for idx in range(0, len(ids), 100):
-        send_to_default_q(
-            MessageAction.BOMBER_AUTOMATIC_ESCALATION,
-            {'application_list': ids[idx:idx + 100]})
+    with MessagePublisher() as publisher:
+        for idx in range(0, len(ids), 100):
+            publisher.send_to_default_q(
+                MessageAction.BOMBER_AUTOMATIC_ESCALATION,
+                {'application_list': ids[idx:idx + 100]})
     send_to_default_q(MessageAction.UPDATE_OLD_LOAN_APPLICATION, {})
 
     # overdue_days 计算完成后，修改C1A_entry(预期天数为4的设为C1A)
@@ -1914,60 +2027,6 @@ def calc_overdue_days(payload, msg_id):
         Application.overdue_days == 4
     ).execute()
 
-# 分期的件计算逾期天数
-def calc_overdue_days_instalment():
-    now = fn.NOW()
-    origin_diff_days = fn.DATEDIFF(now, OverdueBill.origin_due_at)
-    overdue_days = fn.GREATEST(origin_diff_days, SQL('0'))
-    sub_bill_status_list = [ApplicationStatus.PROCESSING.value,
-                            ApplicationStatus.UNCLAIMED.value,
-                            ApplicationStatus.AB_TEST.value]
-    # 获取当月第一天的时间
-    today_now_time = datetime.now()
-    month_first_day = today_now_time.replace(day=1,
-                                             hour=1,
-                                             minute=30,
-                                             second=0,
-                                             microsecond=0)
-    for status in sub_bill_status_list:
-        # 更新逾期天数
-        query = (OverdueBill.update(overdue_days = overdue_days)
-                 .where(OverdueBill.status == status,
-                        OverdueBill.overdue_days <= 95))
-        updated_rows_count = query.execute()
-        logging.info("calc_overdue_days_instalment done,count:%s,status:%s" %
-                     (updated_rows_count, status))
-
-        # 获取所有的子账单信息
-        overdue_bills = (OverdueBill
-                         .select(OverdueBill.status,
-                                 OverdueBill.created_at,
-                                 OverdueBill.collection_id,
-                                 OverdueBill.overdue_days)
-                         .join(Application, JOIN_LEFT_OUTER,
-                               on=OverdueBill.collection_id == Application.id)
-                         .where(Application.status == status,
-                                (Application.type ==
-                                 ApplicationType.CASH_LOAN_STAGING.value)))
-        # 获取每个分期催收单要更新的逾期天数
-        app_update = {}
-        for ob in overdue_bills:
-            # 排除到分期这个月之前还款完成的那一期
-            if (ob.status == ApplicationStatus.REPAID.value and
-                    ob.created_at < month_first_day):
-                continue
-            if ob.collection_id not in app_update:
-                app_update[ob.collection_id] = ob.overdue_days
-            else:
-                ob_days = max(app_update[ob.collection_id],ob.overdue_days)
-                app_update[ob.collection_id] = ob_days
-        # 更新催收单的逾期天数
-        for aid,a_days in app_update.items():
-            q = (Application.update(overdue_days = a_days)
-                 .where(Application.id == aid)
-                 .execute())
-    logging.info("update instalment application done")
-
 
 @action(MessageAction.BOMBER_AUTOMATIC_ESCALATION)
 def automatic_escalation(payload, msg_id):
@@ -1975,10 +2034,14 @@ def automatic_escalation(payload, msg_id):
     if not app_ids:
         return
     # 过滤掉已完成的订单
-    apps = (Application.select()
+    apps = (Application.select(Application.id,
+                               Application.cycle,
+                               Application.overdue_days,
+                               Application.latest_bomber)
             .where(Application.id.in_(app_ids),
                    Application.status != ApplicationStatus.REPAID.value))
 
+    escalated = []
     for a in apps:
         new_cycle = application_entry_different_calculations(a)
         if a.overdue_days < 90:
@@ -1986,67 +2049,91 @@ def automatic_escalation(payload, msg_id):
                 "automatic_escalation_bomber_app_id:{},new_cycle:{},cycle:{},overdue_days:{}".format(
                     a.id, new_cycle, a.cycle, a.overdue_days))
         if new_cycle > a.cycle:
-            with db.atomic():
-                if (a.latest_bomber_id or
-                        a.cycle in (Cycle.C1A.value, Cycle.C1B.value)):
-                    bomber_id = (a.latest_bomber_id
-                                 if a.latest_bomber_id else a.cycle)
-                    (DispatchAppHistory.update(
-                        out_at=datetime.now(),
-                        out_overdue_days=a.overdue_days,
-                    ).where(
-                        DispatchAppHistory.application == a.id,
-                        DispatchAppHistory.bomber_id == bomber_id
-                    )).execute()
-
-                Escalation.create(
-                    application=a.id,
-                    type=EscalationType.AUTOMATIC.value,
-                    status=ApprovalStatus.APPROVED.value,
-                    current_cycle=a.cycle,
-                    escalate_to=new_cycle,
-                    current_bomber_id=a.latest_bomber,
-                )
+            escalated.append((a, new_cycle))
+    if escalated:
+        escalate_applications(escalated)
+    logging.info('automatic escalation done, escalated count: %s',
+                 len(escalated))
+
+
+def escalate_applications(escalated):
+    """
+    批量自动升级，escalated: [(application, new_cycle)]
+    在一个事务里:
+    - 每个催收员一条 DispatchAppHistory 出件 UPDATE
+    - Escalation 一次 insert_many
+    - DispatchApp 一条 UPDATE
+    - 每个 (cycle, new_cycle) 一条 Application UPDATE，
+      写入的字段和原来逐个 save 的一致
+    """
+    now = datetime.now()
+    history_apps = defaultdict(list)
+    cycle_apps = defaultdict(list)
+    escalations = []
+    for a, new_cycle in escalated:
+        if (a.latest_bomber_id or
+                a.cycle in (Cycle.C1A.value, Cycle.C1B.value)):
+            bomber_id = (a.latest_bomber_id
+                         if a.latest_bomber_id else a.cycle)
+            history_apps[bomber_id].append(a)
+        escalations.append({
+            'application': a.id,
+            'type': EscalationType.AUTOMATIC.value,
+            'status': ApprovalStatus.APPROVED.value,
+            'current_cycle': a.cycle,
+            'escalate_to': new_cycle,
+            'current_bomber': a.latest_bomber_id,
+        })
+        cycle_apps[(a.cycle, new_cycle)].append(a)
+
+    with db.atomic():
+        for bomber_id, apps in history_apps.items():
+            out_overdue_days = Case(DispatchAppHistory.application,
+                                    [(a.id, a.overdue_days) for a in apps])
+            (DispatchAppHistory.update(
+                out_at=now,
+                out_overdue_days=out_overdue_days,
+            ).where(
+                DispatchAppHistory.application << [a.id for a in apps],
+                DispatchAppHistory.bomber_id == bomber_id
+            )).execute()
+
+        Escalation.insert_many(escalations).execute()
+
+        # 升级的时候如果是外包的件更新dispatch_app中的状态
+        (DispatchApp
+         .update(status=DisAppStatus.ABNORMAL.value)
+         .where(DispatchApp.application << [a.id for a, _ in escalated])
+         .execute())
 
-                # 升级的时候如果是外包的件更新dispatch_app中的状态
-                dis_app_update = (DispatchApp
-                                  .update(status = DisAppStatus.ABNORMAL.value)
-                                  .where(DispatchApp.application == a.id))
-                dis_app_update.execute()
-                a.cycle = new_cycle
-                a.last_bomber = a.latest_bomber
-                a.status = ApplicationStatus.UNCLAIMED.value
-                a.latest_bomber = None
-                a.ptp_bomber = None
-                a.latest_call = None
+        for (cycle, new_cycle), apps in cycle_apps.items():
+            fields = {
+                'cycle': new_cycle,
+                'last_bomber': Case(Application.id,
+                                    [(a.id, a.latest_bomber_id)
+                                     for a in apps]),
+                'status': ApplicationStatus.UNCLAIMED.value,
+                'latest_bomber': None,
+                'ptp_bomber': None,
+                'latest_call': None,
                 # 升级之后 拨打次数清零
-                a.called_times = 0
-                if new_cycle == Cycle.C1B.value:
-                    a.C1B_entry = datetime.now()
-                elif new_cycle == Cycle.C2.value:
-                    a.C2_entry = datetime.now()
-                elif new_cycle == Cycle.C3.value:
-                    a.C3_entry = datetime.now()
-                a.save()
-    logging.info('automatic escalation done')
+                'called_times': 0,
+            }
+            if new_cycle in CYCLE_ENTRY_FIELDS:
+                fields[CYCLE_ENTRY_FIELDS[new_cycle]] = now
+            (Application
+             .update(**fields)
+             .where(Application.id << [a.id for a in apps])
+             .execute())
+
 
 # 把部分件的进入C1B的时间改为10天
 def application_entry_different_calculations(app):
-    conf = {
-        1: [1, 10],
-        2: [11, 30],
-        3: [31, 60],
-        4: [61, 90],
-        5: [91, 999999],
-    }
-    for new_cycle,scopes in conf.items():
-        if scopes[0] <= app.overdue_days <= scopes[1]:
-            return new_cycle
-    return app.cycle
+    return cycle_of(app.overdue_days, default=app.cycle)
 
 
 
-@action(MessageAction.BOMBER_CALC_SUMMARY)
+@action(MessageAction.BOMBER_CALC_SUMMARY, lane=Lane.BATCH)
 def cron_summary(payload, msg_id):
     """已废弃"""
     employees = Bomber.select(Bomber, Role).join(Role)
@@ -2260,7 +2347,7 @@ def cron_summary(payload, msg_id):
     send_to_default_q(MessageAction.BOMBER_CALC_OVERDUE_DAYS, {})
 
 
-@action(MessageAction.BOMBER_CALC_SUMMARY2)
+@action(MessageAction.BOMBER_CALC_SUMMARY2, lane=Lane.BATCH)
 def cron_summary2(payload, msg_id):
     """已废弃，定时任务还在执行,具体情况待确定"""
     cal_date = date.today() - timedelta(days=1)
@@ -2363,12 +2450,10 @@ def sync_suggested_contacts(payload, msg_id):
 def sync_contacts(application):
     logging.info('application %s start sync contact', application.id)
 
-    # 添加联系人信息
-    contacts = Contact.filter(Contact.user_id == application.user_id)
-    existing_numbers = {contact.number for contact in contacts}
+    # 添加联系人信息，和原来一样按接口返回的号码写入
+    upsert = ContactUpsert(application.user_id, strip=False)
 
     # sms contacts
-    insert_contacts = []
     sms_contacts = GoldenEye().get(
         '/applications/%s/sms-contacts' % application.external_id
     )
@@ -2379,23 +2464,10 @@ def sync_contacts(application):
         sms_contacts = sms_contacts.json()['data']
 
     for i in sms_contacts:
-        if i['number'] in existing_numbers:
-            continue
-        insert_contacts.append({
-            'user_id': application.user_id,
-            'name': i['name'],
-            'number': i['number'],
-            'relationship': Relationship.SUGGESTED.value,
-            'source': 'sms contacts',
-            'real_relationship': Relationship.SUGGESTED.value
-        })
-        existing_numbers.add(i['number'])
-
-    if insert_contacts:
-        Contact.insert_many(insert_contacts).execute()
+        upsert.add(i['number'], i['name'], Relationship.SUGGESTED.value,
+                   'sms contacts')
 
     # call frequency
-    insert_contacts = []
     cf = GoldenEye().get(
         '/applications/%s/call/frequency' % application.external_id
     )
@@ -2406,28 +2478,19 @@ def sync_contacts(application):
     else:
         call_frequency = cf.json()['data']
 
-    with db.atomic():
-        for i in call_frequency:
-            if i['number'] in existing_numbers:
-                (Contact
-                 .update(total_count=i['total_count'],
-                         total_duration=i['total_duration'])
-                 .where(Contact.number == i['number'],
-                        Contact.user_id == application.user_id))
-                continue
+    for i in call_frequency:
+        if upsert.exists(i['number']):
+            upsert.update_frequency(i['number'], i['total_count'],
+                                    i['total_duration'])
+            continue
 
-            insert_contacts.append({
-                'user_id': application.user_id,
-                'name': i['name'],
-                'number': i['number'],
-                'relationship': Relationship.SUGGESTED.value,
-                'total_count': i['total_count'],
-                'total_duration': i['total_duration'],
-                'source': 'call frequency',
-                'real_relationship': Relationship.SUGGESTED.value
-            })
-        if insert_contacts:
-            Contact.insert_many(insert_contacts).execute()
+        upsert.add(i['number'], i['name'], Relationship.SUGGESTED.value,
+                   'call frequency', total_count=i['total_count'],
+                   total_duration=i['total_duration'])
+
+    counts = upsert.flush()
+    logging.info('application %s sync contact finished: %s',
+                 application.id, counts)
 
 
 @action(MessageAction.BOMBER_AUTO_SMS)
@@ -2441,7 +2504,7 @@ def bomber_auto_sms(payload, msg_id):
     applications = (
         Application
         .select()
-        .where(Application.overdue_days == day_diff,
+        .where(application_overdue_days() == day_diff,
                Application.status << [ApplicationStatus.PROCESSING.value,
                                       ApplicationStatus.UNCLAIMED.value],
                Application.promised_date.is_null(True) |
@@ -2808,7 +2871,8 @@ def send_sms(data_list, msg_type, app_name):
     logging.info("send_sms_success:%s", msg_type)
 
 #生成自动外呼，和分件
-@action(MessageAction.BOMBER_AUTO_CALL_LIST)
+@action(MessageAction.BOMBER_AUTO_CALL_LIST,
+        concurrency=1, max_duration=3600, lane=Lane.BATCH)
 def bomber_auto_call_list(payload, msg_id):
 
     with db.atomic():
@@ -2862,16 +2926,17 @@ def bomber_auto_call_list(payload, msg_id):
         for idx in range(0, len(insert_args), 100):
             AutoCallList.insert_many(insert_args[idx:idx + 100]).execute()
 
-    for idx in range(0, len(insert_args), 100):
-        application_list = [
-            i['application']
-            for i in insert_args[idx:idx + 100]
-        ]
-        #获取校验后有效的电话号码
-        send_to_default_q(
-            MessageAction.BOMBER_AUTO_CALL_CONTACT,
-            {'application_list': application_list}
-        )
+    with MessagePublisher() as publisher:
+        for idx in range(0, len(insert_args), 100):
+            application_list = [
+                i['application']
+                for i in insert_args[idx:idx + 100]
+            ]
+            #获取校验后有效的电话号码
+            publisher.send_to_default_q(
+                MessageAction.BOMBER_AUTO_CALL_CONTACT,
+                {'application_list': application_list}
+            )
 
     logging.info('bomber generate auto call list finished')
 
@@ -3060,26 +3125,23 @@ def bomber_dispatch_app():
     except Exception as e:
         logging.error("c1a_dispatch_app error:%s"%str(e))
 
-    cycle = {
-        1: 10,
-        2: 30,
-        3: 60,
-        4: 90
-    }
-
     # 单期外包 Cycle.C2 overdue_day 31
-    apps = (Application.select()
-            .where(fn.DATE(Application.C2_entry) == date.today(),
-                   Application.type == ApplicationType.CASH_LOAN.value))
+    apps = list(Application
+                .select(Application.id,
+                        Application.cycle,
+                        Application.amount,
+                        Application.overdue_days)
+                .where(fn.DATE(Application.C2_entry) == date.today(),
+                       Application.type == ApplicationType.CASH_LOAN.value))
 
     partners = (Partner.select()
                 .where(Partner.status == PartnerStatus.NORMAL.value,
                        Partner.cycle == Cycle.C2.value))
 
-    apps_ids = [a.id for a in apps]
-    dispatch_inserts = []
+    # [(application, bomber_id, partner_id, day_next_cycle)]
+    assignments = []
     start_index = 0
-    apps_length = len(apps_ids)
+    apps_length = len(apps)
     logging.warning('apps length %s' % str(apps_length))
 
     for p in partners:  # 目前就一个partner
@@ -3094,113 +3156,125 @@ def bomber_dispatch_app():
         end_index = start_index + int(apps_length * p.app_percentage)
         logging.info('partner length %s' % str(end_index))
 
-        if not apps_ids[start_index:end_index]:
+        if not apps[start_index:end_index]:
             continue
-        bills = BillService().bill_list(
-            application_ids=apps_ids[start_index:end_index])
-        bill_dict = {bill['application_id']: bill for bill in bills}
-
-        for a_id in apps_ids[start_index:end_index]:
+        for application in apps[start_index:end_index]:
             bomber = average_gen(gen, existing_list)
-            q = (DispatchApp.delete()
-                 .where(DispatchApp.application == a_id)
-                 .execute())
-            dispatch_inserts.append({
-                'application': a_id,
-                'bomber': bomber,
-                'partner': p.id,
-            })
-
-            # 件分给外包后，对数据进行备份以备数据分析
-            application = (Application.select()
-                           .where(Application.id == a_id)).first()
-            application.latest_bomber = bomber
-            application.status = ApplicationStatus.AB_TEST.value
-            application.ptp_bomber = None
-            application.save()
-            day_next_cycle = (cycle.get(application.cycle) -
+            day_next_cycle = (cycle_end_day(application.cycle) -
                               application.overdue_days)
-            DispatchAppHistory.create(
-                application=a_id,
-                partner_id=p.id,
-                bomber_id=bomber,
-                entry_at=datetime.now(),
-                entry_overdue_days=application.overdue_days,
-                entry_principal_pending=(
-                    application.amount -
-                    Decimal(bill_dict[a_id].get('principal_paid'))),
-                entry_late_fee_pending=(
-                    Decimal(bill_dict[a_id].get('late_fee')) -
-                    Decimal(bill_dict[a_id].get('late_fee_paid'))),
-                expected_out_time=(date.today() +
-                                   timedelta(days=day_next_cycle))
-            )
+            assignments.append((application, bomber, p.id, day_next_cycle))
 
         start_index = end_index
 
-    with db.atomic():
-        for idx in range(0, len(dispatch_inserts), 100):
-            DispatchApp.insert_many(dispatch_inserts[idx:idx + 100]).execute()
-
     # AB test 分件(人工维护分件)
 
     config = SystemConfig.prefetch(SCI.AB_TEST_C2)
     c2_bomber = config.get(SCI.AB_TEST_C2, SCI.AB_TEST_C2.default_value)
     # 余下的单期件分给内部指定催收员id [76, 100, 106, 107, 213, 215, 216, 221, 222, 223, 226, 235]
     c2_bomber = get_cash_bomber(c2_bomber, Cycle.C2.value)
-    #python库的application  id
-    c2 = apps_ids[start_index:]
-    if c2:
-        bills = BillService().bill_list(
-            application_ids=c2)
-    else:
-        bills = []
-    #java库的bill
-    bill_dict = {bill['application_id']: bill for bill in bills}
-    logging.info('c2 AB_test length: %s' % str(c2))
+    c2 = apps[start_index:]
+    logging.info('c2 AB_test length: %s' % str([a.id for a in c2]))
     gen = CycleIter(c2_bomber)
     existing_list = []
-    for c in c2:
+    for application in c2:
         bomber = average_gen(gen, existing_list)
-        application = Application.filter(Application.id == c).first()
-        application.status = ApplicationStatus.AB_TEST.value
-        application.latest_bomber = bomber
-        application.ptp_bomber = None
-        application.save()
-
         day_next_cycle = 46 - application.overdue_days
-        DispatchAppHistory.create(
-            application=c,
-            bomber_id=bomber,
-            entry_at=datetime.now(),
-            entry_overdue_days=application.overdue_days,
-            entry_principal_pending=(application.amount
-                                     - bill_dict[c].get('principal_paid', 0)),
-            entry_late_fee_pending=(
-                    bill_dict[c].get('late_fee', 0) -
-                    bill_dict[c].get('late_fee_paid', 0)),
-            expected_out_time=(date.today() + timedelta(days=day_next_cycle))
-        )
+        assignments.append((application, bomber, None, day_next_cycle))
+
+    bulk_dispatch(assignments,
+                  status=ApplicationStatus.AB_TEST.value,
+                  ptp_bomber=None)
     ab_test_other()
 
 
+def bulk_dispatch(assignments, bills=None, **fields):
+    """
+    批量分件，assignments: [(application, bomber_id, partner_id, day_next_cycle)]
+    application 需要有 id、amount、overdue_days，fields 为催收单上额外更新的字段
+    - 账单在事务之外一次获取，已经有的通过 bills 传入
+    - 每个催收员一条 Application UPDATE
+    - 分给外包(partner_id 不为空)的件 DispatchApp 一次删除、一次写入
+    - DispatchAppHistory 一次 insert_many
+    """
+    if not assignments:
+        return
+    if bills is None:
+        app_ids = [a.id for a, _, _, _ in assignments]
+        bills = []
+        for idx in range(0, len(app_ids), 1000):
+            bills.extend(BillService().bill_list(
+                application_ids=app_ids[idx:idx + 1000]))
+    bill_dict = {str(bill['application_id']): bill for bill in bills}
+
+    now, today = datetime.now(), date.today()
+    bomber_apps = defaultdict(list)
+    dispatch_inserts, history_inserts = [], []
+    for a, bomber, partner_id, day_next_cycle in assignments:
+        bill = bill_dict[str(a.id)]
+        bomber_apps[bomber].append(a.id)
+        if partner_id is not None:
+            dispatch_inserts.append({
+                'application': a.id,
+                'bomber': bomber,
+                'partner': partner_id,
+                'status': DisAppStatus.NORMAL.value,
+            })
+        # 件分给外包后，对数据进行备份以备数据分析
+        history_inserts.append({
+            'application': a.id,
+            'partner_id': partner_id,
+            'bomber_id': bomber,
+            'entry_at': now,
+            'entry_overdue_days': a.overdue_days,
+            'entry_principal_pending': (
+                Decimal(a.amount or 0) -
+                Decimal(bill.get('principal_paid', 0))),
+            'entry_late_fee_pending': (
+                Decimal(bill.get('late_fee', 0)) -
+                Decimal(bill.get('late_fee_paid', 0))),
+            'expected_out_time': today + timedelta(days=day_next_cycle),
+        })
+
+    with db.atomic():
+        for bomber, ids in bomber_apps.items():
+            (Application
+             .update(latest_bomber=bomber, **fields)
+             .where(Application.id << ids)
+             .execute())
+        if dispatch_inserts:
+            (DispatchApp.delete()
+             .where(DispatchApp.application <<
+                    [i['application'] for i in dispatch_inserts])
+             .execute())
+        for idx in range(0, len(dispatch_inserts), 100):
+            DispatchApp.insert_many(dispatch_inserts[idx:idx + 100]).execute()
+        for idx in range(0, len(history_inserts), 100):
+            (DispatchAppHistory
+             .insert_many(history_inserts[idx:idx + 100])
+             .execute())
+    logging.info('bulk dispatch done, applications: %s, bombers: %s',
+                 len(history_inserts), len(bomber_apps))
+
 
 # 单期的件部分分给外包，内部的C1a 不用分件进入自动外呼
 def c1a_dispatch_app():
     today = datetime.today().date()
     tomorrow = today + timedelta(days=1)
     #获取单期的件
-    c1a_apps = (Application.select()
-                .where(Application.status << [ApplicationStatus.UNCLAIMED.value,
-                                              ApplicationStatus.PROCESSING.value],
-                       Application.dpd1_entry >= today,
-                       Application.dpd1_entry < tomorrow,
-                       Application.type == ApplicationType.CASH_LOAN.value))
-    all_aids = [a.id for a in c1a_apps]
+    c1a_apps = list(
+        Application.select(Application.id,
+                           Application.amount,
+                           Application.overdue_days)
+        .where(Application.status << [ApplicationStatus.UNCLAIMED.value,
+                                      ApplicationStatus.PROCESSING.value],
+               Application.dpd1_entry >= today,
+               Application.dpd1_entry < tomorrow,
+               Application.type == ApplicationType.CASH_LOAN.value))
     # 获取外包部门
     partners = (Partner.select()
                 .where(Partner.status == PartnerStatus.NORMAL.value,
                        Partner.cycle == Cycle.C1A.value))
+    assignments = []
     end = 0
     for p in partners:
         #直接通过partner 获取bomber
@@ -3208,42 +3282,23 @@ def c1a_dispatch_app():
                    .where(Bomber.partner == p.id,
                           Bomber.is_del == 0))
         start = end
-        end += int(len(all_aids) * p.app_percentage)
-        aids = all_aids[start:end]
+        end += int(len(c1a_apps) * p.app_percentage)
+        apps = c1a_apps[start:end]
         bids = [b.id for b in bombers]
-        if not bids or not aids:
+        if not bids or not apps:
             continue
         # 获取每个外包应该分到的件的个数
-        average_number = get_average_number(len(aids),len(bids))
+        average_number = get_average_number(len(apps),len(bids))
         p_end = 0
         for i,bid in enumerate(bids):
             p_start = p_end
             p_end += average_number[i]
-            b_aids = aids[p_start:p_end]
-            with db.atomic():
-                q = (Application
-                     .update(latest_bomber = bid,
-                             status = ApplicationStatus.AB_TEST.value)
-                     .where(Application.id << b_aids)
-                     .execute())
-                params = {
-                    "cycle": Cycle.C1A.value,
-                    "dest_partner_id": p.id,
-                    "application_ids": b_aids,
-                    "dest_bomber_id": bid
-                }
-                new_in_record(**params)
-            try:
-                dispatch_inserts = []
-                for aid in b_aids:
-                    dispatch_inserts.append({'application': aid,
-                                             'bomber': bid,
-                                             'partner': p.id,
-                                             'status': DisAppStatus.NORMAL.value})
-                if dispatch_inserts:
-                    q = (DispatchApp.insert_many(dispatch_inserts).execute())
-            except Exception as e:
-                logging.error("c1a分件写入dispatch_app error:%s"%str(e))
+            for a in apps[p_start:p_end]:
+                day_next_cycle = (cycle_end_day(Cycle.C1A.value) -
+                                  a.overdue_days)
+                assignments.append((a, bid, p.id, day_next_cycle))
+
+    bulk_dispatch(assignments, status=ApplicationStatus.AB_TEST.value)
 
 
 def ab_test_other():
@@ -3269,6 +3324,7 @@ def ab_test_other():
           .where(fn.DATE(Application.C3_entry) == date.today(),
                  Application.type == ApplicationType.CASH_LOAN.value))
     all_id = [b.id for b in c3]
+    app_dict = {a.id: a for a in list(c1b) + list(c3)}
 
     try:
         # 将C3的件一部分分配给外包
@@ -3305,29 +3361,16 @@ def ab_test_other():
         bills = BillService().bill_list(
             application_ids=applications)
         bill_dict = {bill['application_id']: bill for bill in bills}
+        assignments = []
         for a in applications[:end]:
             bomber = average_gen(gen, existing_list)
-            application = Application.filter(Application.id == a).first()
-            application.status = ApplicationStatus.AB_TEST.value
-            application.latest_bomber = bomber
-            application.ptp_bomber = None
-            application.save()
-
+            application = app_dict[a]
             day_next_cycle = (cycle_upper.get(application.cycle) -
                               application.overdue_days)
-            DispatchAppHistory.create(
-                application=a,
-                bomber_id=bomber,
-                entry_at=datetime.now(),
-                entry_overdue_days=application.overdue_days,
-
-                entry_principal_pending=(application.amount -
-                                         bill_dict[a]['principal_paid']),
-                entry_late_fee_pending=(bill_dict[a]['late_fee'] -
-                                        bill_dict[a]['late_fee_paid']),
-                expected_out_time=(date.today() +
-                                   timedelta(days=day_next_cycle))
-            )
+            assignments.append((application, bomber, None, day_next_cycle))
+        bulk_dispatch(assignments, bills=bills,
+                      status=ApplicationStatus.AB_TEST.value,
+                      ptp_bomber=None)
 
         # 根据partner表中的配置给外包团队分件。
         if d.get('cycle') == Cycle.C1B.value:
@@ -3364,6 +3407,9 @@ def ab_test_other():
             dispatch_c1b_inner_apps(aids=inner_c1b_apps,
                                     bills=bill_dict,
                                     period=cycle_upper.get(Cycle.C1B.value))
+            # 外包的件一起在一个事务里写入，失败时整体回滚，不影响后面的分件
+            partner_assignments = []
+            period = cycle_upper.get(Cycle.C1B.value)
             for pid,c1b_wb in c1b_wb_pba.items():
                 c1b_wb_apps = c1b_wb["apps"]
                 c1b_wb_bids = c1b_wb["bids"]
@@ -3375,35 +3421,17 @@ def ab_test_other():
                     bid_end = bid_start + average_nums[b_index]
                     bid_apps = c1b_wb_apps[bid_start:bid_end]
                     logging.info("c1b_分件:bid:%s,bid_apps:%s"%(bid, bid_apps))
-                    with db.atomic():
-                        app_sql = (Application.update(latest_bomber=bid,
-                                        status=ApplicationStatus.AB_TEST.value,
-                                                      ptp_bomber=None)
-                                    .where(Application.id << bid_apps))
-                        app_sql.execute()
-                        params = {
-                            "apps":bid_apps,
-                            "partner_id": int(pid),
-                            "bill_dict": bill_dict,
-                            "period": cycle_upper.get(Cycle.C1B.value),
-                            "bomber_id":bid
-                        }
-                        c1b_dispatch_in_record(**params)
-                    try:
-                        for aid in bid_apps:
-                            dispatch_inserts = {
-                                'application': aid,
-                                'bomber': bid,
-                                'partner': int(pid),
-                                'status': DisAppStatus.NORMAL.value,
-                            }
-                            q = (DispatchApp.update(**dispatch_inserts)
-                                        .where(DispatchApp.application == aid)
-                                        .execute())
-                            if not q:
-                                DispatchApp.create(**dispatch_inserts)
-                    except Exception as e:
-                        logging.error("dispatchApp插入失败:%s"%str(e))
+                    for aid in bid_apps:
+                        application = app_dict[aid]
+                        partner_assignments.append(
+                            (application, bid, int(pid),
+                             period - application.overdue_days))
+            try:
+                bulk_dispatch(partner_assignments, bills=bills,
+                              status=ApplicationStatus.AB_TEST.value,
+                              ptp_bomber=None)
+            except Exception as e:
+                logging.error("c1b 外包分件失败:%s" % str(e))
 
 
 def allot_c3_case(out_data):
@@ -3552,13 +3580,9 @@ def out_and_in_record_instalment(**kwargs):
                     DispatchAppHistory.out_at.is_null(True))
              .execute())
     # 入案
-    cycle_period = {
-        1: '10',
-        2: '30',
-        3: '60',
-        4: '90'
-    }
-    period = cycle_period.get(kwargs['cycle'], '90 + t1.overdue_days')
+    # 增量更新时库里的逾期天数可能落后，按实际逾期天数计算
+    overdue_days = application_overdue_days_sql()
+    period = cycle_end_day(kwargs['cycle'], '90 + %s' % overdue_days)
     kwargs['dest_partner_id'] = kwargs.get('dest_partner_id') or 'null'
     subquery = (Application
                 .select(Application.amount,
@@ -3567,10 +3591,11 @@ def out_and_in_record_instalment(**kwargs):
                         Application.id.alias('application_id'),
                         R(str(kwargs['dest_bomber_id'])).alias('bomber_id'),
                         fn.NOW().alias('entry_at'),
-                        Application.overdue_days.alias('entry_overdue_days'),
+                        application_overdue_days()
+                        .alias('entry_overdue_days'),
                         R(str(kwargs['dest_partner_id'])).alias('partner_id'),
-                        (SQL('DATE_ADD(CURDATE(),INTERVAL (%s -'
-                             ' t1.overdue_days) DAY)' % period))
+                        (SQL('DATE_ADD(CURDATE(),INTERVAL (%s - %s) DAY)' %
+                             (period, overdue_days)))
                         .alias('expected_out_time'))
                 .where(Application.status != ApplicationStatus.REPAID.value,
                        Application.id << kwargs['application_ids']))
@@ -3642,10 +3667,11 @@ def c1b_dispatch_in_record(**kwargs):
                         Application.id.alias('application_id'),
                         R(str(bomber_id)).alias('bomber_id'),
                         fn.NOW().alias('entry_at'),
-                        Application.overdue_days.alias('entry_overdue_days'),
+                        application_overdue_days()
+                        .alias('entry_overdue_days'),
                         R(str(partner_id)).alias('partner_id'),
-                        (SQL('DATE_ADD(CURDATE(),INTERVAL (%s -'
-                             ' t1.overdue_days) DAY)' % period))
+                        (SQL('DATE_ADD(CURDATE(),INTERVAL (%s - %s) DAY)' %
+                             (period, application_overdue_days_sql())))
                         .alias('expected_out_time'))
                 .where(Application.id << app_ids))
     application_list = list(subquery)
@@ -3907,7 +3933,7 @@ def bomber_clear_overdue_ptp(payload, msg_id):
     logging.info('bomber overdue ptp cleared: %s', count)
 
 
-@action(MessageAction.REPORT_BOMBER_COLLECTION)
+@action(MessageAction.REPORT_BOMBER_COLLECTION, lane=Lane.BATCH)
 def report_bomber_collection(payload, msg_id):
     start_date = (ReportCollection
                   .select(fn.MAX(ReportCollection.apply_date))
@@ -4187,13 +4213,9 @@ def new_out_record(**kwargs):
                       (kwargs["application_ids"],str(e)))
 
 def new_in_record(**kwargs):
-    cycle_period = {
-        1: '10',
-        2: '30',
-        3: '60',
-        4: '90'
-    }
-    period = cycle_period.get(kwargs['cycle'], '90 + t1.overdue_days')
+    # 增量更新时库里的逾期天数可能落后，按实际逾期天数计算
+    overdue_days = application_overdue_days_sql()
+    period = cycle_end_day(kwargs['cycle'], '90 + %s' % overdue_days)
     kwargs['dest_partner_id'] = kwargs.get('dest_partner_id') or 'null'
     subquery = (Application
                 .select(Application.amount,
@@ -4202,10 +4224,11 @@ def new_in_record(**kwargs):
                         Application.id.alias('application_id'),
                         R(str(kwargs['dest_bomber_id'])).alias('bomber_id'),
                         fn.NOW().alias('entry_at'),
-                        Application.overdue_days.alias('entry_overdue_days'),
+                        application_overdue_days()
+                        .alias('entry_overdue_days'),
                         R(str(kwargs['dest_partner_id'])).alias('partner_id'),
-                        (SQL('DATE_ADD(CURDATE(),INTERVAL (%s -'
-                             ' t1.overdue_days) DAY)' % period))
+                        (SQL('DATE_ADD(CURDATE(),INTERVAL (%s - %s) DAY)' %
+                             (period, overdue_days)))
                         .alias('expected_out_time'))
                 .where(Application.status != ApplicationStatus.REPAID.value,
                        Application.id << kwargs['application_ids']))
@@ -4282,7 +4305,8 @@ def in_record(**kwargs):
                         Application.id.alias('application_id'),
                         R(str(kwargs['dist_bomber_id'])).alias('bomber_id'),
                         fn.NOW().alias('entry_at'),
-                        Application.overdue_days.alias('entry_overdue_days'),
+                        application_overdue_days()
+                        .alias('entry_overdue_days'),
                         R(str(kwargs['dist_partner_id'])).alias('partner_id'),
                         R('"{}"'.format(kwargs['expected_out_time']))
                         .alias('expected_out_time'))
@@ -4565,7 +4589,7 @@ def get_before_bomber(date_time):
 
 
 # 每周刷新一次recover_rate报表数据(待催维度)
-@action(MessageAction.RECOVER_RATE_WEEK_MONEY)
+@action(MessageAction.RECOVER_RATE_WEEK_MONEY, sync_log=True, lane=Lane.BATCH)
 def recover_rate_week_money(payload, msg_id):
     #获取当天RECOVER_RATE_WEEK_MONEY日志次数
     worker_log = (WorkerLog.select(fn.COUNT(WorkerLog.action).alias('logs'))
@@ -5101,7 +5125,8 @@ def get_c3_into_rate(date_time):
 
 
 # 每天刷新一次recover_rate报表数据(入催维度)
-@action(MessageAction.RECOVER_RATE_WEEK_MONEY_INTO)
+@action(MessageAction.RECOVER_RATE_WEEK_MONEY_INTO,
+        sync_log=True, lane=Lane.BATCH)
 def recover_rate_week_money_into(payload, msg_id):
     worker_log = (WorkerLog.select(fn.COUNT(WorkerLog.action).alias('logs'))
                   .where(WorkerLog.created_at >= date.today(),
@@ -5150,7 +5175,7 @@ def get_static_bomber(begin_date):
 
 
 # 部分指标须在当天晚上计算完成
-@action(MessageAction.SUMMARY_CREATE)
+@action(MessageAction.SUMMARY_CREATE, sync_log=True, lane=Lane.BATCH)
 def summary_create(payload, msg_id):
     begin_date = date.today()
     worker_log = (WorkerLog.select(fn.COUNT(WorkerLog.action).alias('logs'))
@@ -5394,7 +5419,8 @@ def get_recover_amount(end_date, begin_date, real_time_query=False):
 
 
 # summary 报表新数据(分布计算，先计算一部分数据)
-@action(MessageAction.SUMMARY_NEW)
+@action(MessageAction.SUMMARY_NEW,
+        concurrency=1, max_duration=3600, sync_log=True, lane=Lane.BATCH)
 def summary_new(payload, msg_id):
     end_date = date.today()
     begin_date = end_date - timedelta(days=1)
@@ -6137,7 +6163,7 @@ def get_unfollowed_call(begin_date):
 
 
 # summary 更新新的数据（计算summary_bomber的另一部分数据）
-@action(MessageAction.UPDATE_SUMMARY_NEW)
+@action(MessageAction.UPDATE_SUMMARY_NEW, sync_log=True, lane=Lane.BATCH)
 def update_summary_new(payload, msg_id):
     end_date = date.today()
     begin_date = end_date - timedelta(days=1)
@@ -6384,7 +6410,8 @@ def get_cycle_case_made_cnt(begin_date, end_date):
 
 
 # 得到cycle維度的数据
-@action(MessageAction.SUMMARY_NEW_CYCLE)
+@action(MessageAction.SUMMARY_NEW_CYCLE,
+        concurrency=1, max_duration=3600, sync_log=True, lane=Lane.BATCH)
 def summary_new_cycle(payload, msg_id):
     end_date = date.today()
     begin_date = end_date - timedelta(days=1)
@@ -6546,7 +6573,7 @@ def summary_new_cycle(payload, msg_id):
         data.save()
 
 
-@action(MessageAction.MODIFY_BILL)
+@action(MessageAction.MODIFY_BILL, lane=Lane.REALTIME)
 def modify_bill(payload, msg_id):
     application_id = payload.get('external_id')
     principal_paid = Decimal(payload.get('principal_paid', 0))
@@ -6964,7 +6991,8 @@ def change_bomber_dispatch_apps(change_bombers,
 
 
 #bomber人员变动，进行分件
-@action(MessageAction.BOMBER_CHANGE_DISPATCH_APPS)
+@action(MessageAction.BOMBER_CHANGE_DISPATCH_APPS,
+        concurrency=1, max_duration=1800, lane=Lane.BATCH)
 def bomber_dispatch_applications(payload, msg_id):
     #通过当天的登录日志，判断人员变动，若删除bomber_log会记录
     change_bombers = get_change_bomber()
@@ -7002,18 +7030,10 @@ def repair_bomber(payload, msg_id):
 def repair_contact(number, application, name):
     # 填写的ec有过逾期则将号码加入contact中
     application = application.first()
-    contact = (Contact
-               .filter(Contact.user_id == application.user_id,
-                       Contact.number == number))
-    if not contact.exists():
-        Contact.create(
-            user_id=application.user_id,
-            name=name,
-            number=number,
-            relationship=Relationship.FAMILY.value,
-            source='repair ec',
-            real_relationship=Relationship.FAMILY.value
-        )
+    upsert = ContactUpsert(application.user_id, numbers=[number],
+                           strip=False)
+    upsert.add(number, name, Relationship.FAMILY.value, 'repair ec')
+    upsert.flush()
     logging.info('add repair contact success, number: %s' % number)
 
 
@@ -7033,6 +7053,8 @@ def add_relationship(number, ec_number, username, name):
             dest_number=ec_number,
             dest_name=name,
             source=20).save()
+        contact_graph.apply_operations(contact_graph.add_edge_operations(
+            str(number), ec_number, 20, src_name=username, dest_name=name))
     logging.info('add relationship success, number: %s' % number)
 
 
@@ -7062,7 +7084,8 @@ def get_summary_daily_time():
     return begin_time, end_time, summary_date
 
 # 每天12：40 和 17：20 和 凌晨 更新当天数据
-@action(MessageAction.SUMMARY_DAILY)
+@action(MessageAction.SUMMARY_DAILY,
+        concurrency=1, max_duration=1800, lane=Lane.BATCH)
 def summary_daily_data(payload, msg_id):
     begin_time, end_time, summary_date = get_summary_daily_time()
     call_actions = (CallActionsR.select(CallActionsR.id,
@@ -7426,20 +7449,9 @@ def calc_instalment_apps_cycle():
 
 # 降cycle之后根据逾期天数更新以下几个时间
 def calc_entry_time(overdue_days):
-    app_entry_time = {}
-    overdue_entry = {
-        "dpd1_entry": [1, 3],
-        "C1A_entry": [4, 10],
-        "C1B_entry": [11, 30],
-        "C2_entry": [31, 60],
-        "C3_entry": [61, 90]
-    }
-    for key,value in overdue_entry.items():
-        if value[0] <= overdue_days <= value[1]:
-            app_entry_time[key] = datetime.now()
-        else:
-            app_entry_time[key] = None
-    return app_entry_time
+    field = entry_field(overdue_days)
+    return {key: datetime.now() if key == field else None
+            for key in ENTRY_FIELDS if key}
 
 # 分期分件
 def instalment_month_dispatch_app():
@@ -7524,7 +7536,8 @@ def instalment_month_dispatch_app():
 
 
 # 每个月月底进行所有件重新分配
-@action(MessageAction.MONTH_DISPATCH_APP)
+@action(MessageAction.MONTH_DISPATCH_APP,
+        concurrency=1, max_duration=7200, lane=Lane.BATCH)
 def month_dispatch_app(payload, msg_id):
     # 判断几天的日期是不是1号
     if datetime.today().day != 1:
@@ -7578,7 +7591,7 @@ def month_dispatch_app(payload, msg_id):
 
 
 # 每天定时统计催收单信息
-@action(MessageAction.SUMMARY_BOMBER_OVERDUE)
+@action(MessageAction.SUMMARY_BOMBER_OVERDUE, lane=Lane.BATCH)
 def summary_bomber_overdue_everyday(payload, msg_id):
     cycle_list = Cycle.values()
     which_day = date.today()
@@ -7716,6 +7729,7 @@ def user_change_phone(payload, msg_id):
     if not all([user_id, new_mobile_no]):
         logging.info("用户修改电话,没有获取到用户id获这用户手机号")
         return
+    GoldenEye.invalidate('/users/%s/extra-phone' % user_id)
     source = 'applicant updated number'
     contacts = (Contact.select()
                .where(Contact.user_id == int(user_id)))
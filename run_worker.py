@@ -1,21 +1,161 @@
 import json
+import os
+import signal
+import threading
 import traceback
 
 import logging
+import queue
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import boto3
 from bottle import default_app
 
 from bomber.app import init_app
-from bomber.db import db
+from bomber.db import db, readonly_db, db_auto_call, readonly_db_auto_call
+from bomber.idempotency import IdempotencyStore
+from bomber.metrics import registry as metrics, serve as serve_metrics
 from bomber.models import WorkerLog, WorkerResult
+from bomber.sns import Lane, get_client, lane_queue_url
 from bomber.utils import diff_end_time
-from bomber.worker import actions
+from bomber.worker import actions, action_options
 
 app = default_app()
 
 
+class WorkerShutdown(Exception):
+    """ 停止 worker 时中断超时未完成的任务 """
+
+
+def _raise_shutdown(signum, frame):
+    raise WorkerShutdown('worker drain timeout')
+
+
+class WorkerPool(object):
+    """
+    消息处理线程池
+    - size: 线程数，<= 1 时在当前线程串行执行（与原来的行为一致）
+    - 拉取消息前用 available 查看空闲线程数，只拉取能马上处理的消息，
+      线程全部繁忙时 submit 会阻塞，避免拉取过多消息导致可见性超时
+    - lock: 多个通道的线程池共用一个 Condition，loop 可以等待任一通道有任务完成
+    """
+
+    def __init__(self, size=1, lock=None):
+        self.size = max(int(size), 1)
+        self._executor = None
+        self._slots = None
+        self._inflight = 0
+        # 已完成的任务数，用于统计处理速率
+        self.completed = 0
+        self._lock = threading.Condition() if lock is None else lock
+        if self.size > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.size)
+            self._slots = threading.BoundedSemaphore(self.size)
+
+    def available(self):
+        if self._executor is None:
+            # 串行模式下一次只拉取一条，避免排队等待的消息没有续期而重新可见
+            return 1
+        with self._lock:
+            return self.size - self._inflight
+
+    def idle(self):
+        with self._lock:
+            return self._inflight == 0
+
+    def submit(self, func, *args):
+        if self._executor is None:
+            try:
+                return func(*args)
+            finally:
+                self.completed += 1
+
+        self._slots.acquire()
+        with self._lock:
+            self._inflight += 1
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def wait_available(self, timeout=None):
+        """ 等待有空闲线程，返回空闲线程数 """
+        if self._executor is None:
+            return self.available()
+        with self._lock:
+            self._lock.wait_for(lambda: self._inflight < self.size, timeout)
+            return self.size - self._inflight
+
+    def _done(self, future):
+        with self._lock:
+            self._inflight -= 1
+            self.completed += 1
+            self._lock.notify_all()
+        self._slots.release()
+        if future.exception() is not None:
+            logging.error('worker pool task failed: %s', future.exception())
+
+    def shutdown(self, timeout=None):
+        """ 等待执行中的任务完成，最多等 timeout 秒，返回是否全部完成 """
+        if self._executor is None:
+            return True
+        with self._lock:
+            drained = self._lock.wait_for(lambda: self._inflight == 0,
+                                          timeout)
+            if not drained:
+                logging.error('worker pool shutdown with %s tasks running',
+                              self._inflight)
+        self._executor.shutdown(wait=drained)
+        return drained
+
+
+class LaneQueue(object):
+    """ 一个通道对应的队列，每个通道使用独立的线程池，批量任务占满线程时不影响实时消息 """
+
+    def __init__(self, lane, url, weight, pool):
+        self.lane = lane
+        self.url = url
+        self.weight = weight
+        self.pool = pool
+        self._mark = (time.time(), 0)
+
+    def throughput(self):
+        """ 距离上次调用完成的消息数和耗时，只在 loop 线程中调用 """
+        now, completed = time.time(), self.pool.completed
+        last_at, last_completed = self._mark
+        self._mark = (now, completed)
+        return completed - last_completed, now - last_at
+
+
+def worker_lanes(lock=None):
+    """
+    需要轮询的通道，按权重从高到低排列
+    - worker.lane_weights: 每轮最多拉取的次数，如 realtime:6,default:3,batch:1
+    - worker.<lane>_pool_size: 通道的线程数，默认 worker.pool_size
+    - 多个通道配置成同一个队列时只轮询一次
+    """
+    weights = {}
+    lane_weights = app.config.get('worker.lane_weights',
+                                  'realtime:6,default:3,batch:1')
+    for item in lane_weights.split(','):
+        name, _, weight = item.strip().partition(':')
+        weights[name] = max(int(weight or 1), 1)
+
+    pool_size = app.config.get('worker.pool_size', 1)
+    lanes, urls = [], set()
+    for lane in (Lane.DEFAULT, Lane.REALTIME, Lane.BATCH):
+        url = lane_queue_url(lane)
+        if url in urls:
+            continue
+        urls.add(url)
+        size = app.config.get('worker.%s_pool_size' % lane.value, pool_size)
+        lanes.append(LaneQueue(lane, url, weights.get(lane.value, 1),
+                               WorkerPool(size, lock)))
+    lanes.sort(key=lambda l: l.weight, reverse=True)
+    return lanes
+
+
 def parse_message(raw_message):
     receipt_handle = raw_message['ReceiptHandle']
 
@@ -31,60 +171,553 @@ def parse_message(raw_message):
     return receipt_handle, msg_id, message
 
 
-def loop():
-    client = boto3.client('sqs')
+def message_action(raw_message):
+    """ 不执行消息，只取出 action，解析失败时返回 None """
+    try:
+        _, _, message = parse_message(raw_message)
+        if isinstance(message, str):
+            message = json.loads(message)
+        return message.get('action', '').lower()
+    except (ValueError, KeyError, AttributeError):
+        return None
+
 
-    while True:
-        query_url = app.config['aws.sqs.queue_url']
-        wait_time_seconds = int(app.config['aws.sqs.wait_time_seconds'])
+class DeleteBatch(object):
+    """
+    批量删除已处理的消息
+    - 各线程处理完后 add，凑满 MAX_BATCH 条时在该线程 flush，
+      不满的由后台线程每 interval 秒 flush 一次，不用等下一轮长轮询
+    - delete_message_batch 部分失败时，非调用方错误的条目逐条重试
+    """
+    MAX_BATCH = 10
 
-        resp = client.receive_message(
-            QueueUrl=query_url,
-            WaitTimeSeconds=wait_time_seconds)
-        for raw_message in resp.get('Messages', []):
+    def __init__(self, client, interval=1):
+        self.client = client
+        self.interval = float(interval)
+        self._pending = defaultdict(list)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='delete-batch',
+                                        daemon=True)
+        self._thread.start()
+
+    def add(self, query_url, receipt_handle):
+        with self._lock:
+            self._pending[query_url].append(receipt_handle)
+            full = len(self._pending[query_url]) >= self.MAX_BATCH
+        if full:
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
             try:
-                receipt_handle, msg_id, message = parse_message(raw_message)
-            except json.decoder.JSONDecodeError:
-                receipt_handle = raw_message['ReceiptHandle']
-                delete_message(client, query_url, receipt_handle)
+                self.flush()
+            except Exception:
+                logging.exception('flush sqs msg delete batch failed')
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(list)
+
+        deleted = failed = 0
+        for query_url, handles in pending.items():
+            for idx in range(0, len(handles), self.MAX_BATCH):
+                ok, err = self._delete_batch(query_url,
+                                             handles[idx:idx + self.MAX_BATCH])
+                deleted += ok
+                failed += err
+        if deleted or failed:
+            logging.info('delete sqs msg batch, deleted: %s, failed: %s',
+                         deleted, failed)
+        return deleted, failed
+
+    def _delete_batch(self, query_url, handles):
+        entries = [{'Id': str(i), 'ReceiptHandle': handle}
+                   for i, handle in enumerate(handles)]
+        try:
+            resp = self.client.delete_message_batch(QueueUrl=query_url,
+                                                    Entries=entries)
+        except Exception as e:
+            logging.error('delete sqs msg batch error: %s', str(e))
+            resp = {'Failed': [{'Id': entry['Id'], 'SenderFault': False}
+                               for entry in entries]}
+
+        deleted = len(resp.get('Successful', []))
+        failed = 0
+        for item in resp.get('Failed', []):
+            receipt_handle = handles[int(item['Id'])]
+            if item.get('SenderFault'):
+                # receipt handle 失效等调用方错误，重试也没用
+                logging.error('delete sqs msg %s failed: %s %s',
+                              receipt_handle, item.get('Code'),
+                              item.get('Message'))
+                failed += 1
                 continue
+            try:
+                delete_message(self.client, query_url, receipt_handle)
+                deleted += 1
+            except Exception as e:
+                logging.error('delete sqs msg %s failed: %s',
+                              receipt_handle, str(e))
+                failed += 1
+        return deleted, failed
+
+
+class VisibilityHeartbeat(object):
+    """
+    为执行中的长任务续期消息的可见性超时，避免消息重新出现被其他 worker 重复执行
+    - 只处理在 @action 中声明了 max_duration 的 action
+    - 续期时长用消息所在队列的 VisibilityTimeout 属性
+    - 从消息登记时开始每 timeout / 2 秒续期一次，执行超过 max_duration 后不再续期
+    """
+    # 检查需要续期的消息的间隔，秒
+    TICK = 1
+
+    def __init__(self, client, urls=()):
+        self.client = client
+        # url -> VisibilityTimeout
+        self._timeouts = {}
+        for url in urls:
+            self.queue_timeout(url)
+        # receipt_handle -> [url, start, max_duration, timeout, next_at]
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='visibility-heartbeat',
+                                        daemon=True)
+        self._thread.start()
+
+    def queue_timeout(self, url):
+        timeout = self._timeouts.get(url)
+        if timeout is None:
+            resp = self.client.get_queue_attributes(
+                QueueUrl=url, AttributeNames=['VisibilityTimeout'])
+            timeout = int(resp['Attributes']['VisibilityTimeout'])
+            self._timeouts[url] = timeout
+        return timeout
+
+    def register(self, query_url, receipt_handle, max_duration):
+        timeout = self.queue_timeout(query_url)
+        now = time.time()
+        with self._lock:
+            self._inflight[receipt_handle] = [
+                query_url, now, max_duration, timeout,
+                now + max(timeout / 2, self.TICK)]
+
+    def unregister(self, receipt_handle):
+        with self._lock:
+            self._inflight.pop(receipt_handle, None)
+
+    def stop(self):
+        self._stopped.set()
+
+    def due(self, now):
+        """ 需要续期的 [(receipt_handle, url, timeout)]，并计算下次续期时间 """
+        result = []
+        with self._lock:
+            for receipt_handle, item in self._inflight.items():
+                query_url, start, max_duration, timeout, next_at = item
+                if next_at > now or now - start > max_duration:
+                    continue
+                item[4] = now + max(timeout / 2, self.TICK)
+                result.append((receipt_handle, query_url, timeout))
+        return result
+
+    def _run(self):
+        while not self._stopped.wait(self.TICK):
+            for receipt_handle, query_url, timeout in self.due(time.time()):
+                try:
+                    self.client.change_message_visibility(
+                        QueueUrl=query_url,
+                        ReceiptHandle=receipt_handle,
+                        VisibilityTimeout=timeout)
+                except Exception as e:
+                    logging.error('change sqs msg %s visibility error: %s',
+                                  receipt_handle, str(e))
+
+
+class WorkerLogBuffer(object):
+    """
+    异步批量写入 WorkerLog
+    - 队列有上限，写满时 add 会阻塞，避免数据库异常时内存无限增长
+    - 攒够 batch_size 条或每 interval 秒用 insert_many 写一次
+    - close 时把剩余的日志全部写入
+    - insert_many 按第一行的 key 决定写入的字段，所以每行都用固定的字段生成
+    """
+    FIELDS = WorkerLog._meta.sorted_field_names
+
+    def __init__(self, batch_size=100, interval=5, capacity=10000):
+        self.batch_size = int(batch_size)
+        self.interval = float(interval)
+        self._queue = queue.Queue(maxsize=int(capacity))
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='worker-log-buffer',
+                                        daemon=True)
+        self._thread.start()
 
-            logging.debug('aws sqs message receive: %s %s', msg_id, message)
+    def add(self, worker):
+        worker.updated_at = datetime.now()
+        self._queue.put({name: worker._data.get(name)
+                         for name in self.FIELDS})
 
-            if isinstance(message, str):
+    def close(self, timeout=None):
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not (self._stopped.is_set() and self._queue.empty()):
+            rows = []
+            deadline = time.time() + self.interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0 or (self._stopped.is_set() and
+                                      self._queue.empty()):
+                    break
                 try:
-                    message = json.loads(message)
-                except json.decoder.JSONDecodeError:
-                    delete_message(client, query_url, receipt_handle)
+                    rows.append(self._queue.get(timeout=min(remaining, 1)))
+                except queue.Empty:
                     continue
+            if rows:
+                self._flush(rows)
+
+    def _flush(self, rows):
+        try:
+            WorkerLog.insert_many(rows).execute()
+        except Exception:
+            logging.exception('flush worker log failed, lost %s rows',
+                              len(rows))
+        finally:
+            close_db()
+
+
+class WorkerRuntime(object):
+    """ loop 中各消息处理线程共享的对象 """
+
+    def __init__(self, client):
+        self.client = client
+        self.pool_lock = threading.Condition()
+        self.lanes = worker_lanes(self.pool_lock)
+        self._action_limits = {}
+        for action_name, options in action_options.items():
+            concurrency = options.get('concurrency')
+            if concurrency:
+                self._action_limits[action_name] = threading.BoundedSemaphore(
+                    concurrency)
+        self.acks = DeleteBatch(
+            client, app.config.get('worker.ack_flush_interval', 1))
+        self.heartbeat = VisibilityHeartbeat(
+            client, [lane.url for lane in self.lanes])
+        self.log_buffer = WorkerLogBuffer(
+            app.config.get('worker.log_batch_size', 100),
+            app.config.get('worker.log_flush_interval', 5))
+        self.idempotency = IdempotencyStore(
+            ttl=app.config.get('worker.idempotency_ttl', 86400),
+            cache_size=app.config.get('worker.idempotency_cache_size', 10000))
+        self.drain_timeout = float(app.config.get('worker.drain_timeout', 25))
+        # action 并发已满时消息延迟多少秒再重新可见
+        self.defer_seconds = int(app.config.get('worker.action_defer_seconds',
+                                                10))
+        self.stopping = threading.Event()
+
+    def idle(self):
+        return all(lane.pool.idle() for lane in self.lanes)
+
+    def completed(self):
+        return sum(lane.pool.completed for lane in self.lanes)
+
+    def wait_completed(self, completed, timeout=None):
+        """ 等待任一通道有任务完成，completed 为开始等待前的 completed() """
+        with self.pool_lock:
+            return self.pool_lock.wait_for(
+                lambda: self.completed() != completed, timeout)
+
+    def reserve(self, raw_message):
+        """
+        按 action_options 中的 concurrency 限制单个 action 的并发数
+        在提交到线程池之前占用名额，返回 (是否占用成功, 名额)，
+        名额在 process_message 结束时释放
+        """
+        limit = self._action_limits.get(message_action(raw_message))
+        if limit is None:
+            return True, None
+        return limit.acquire(blocking=False), limit
+
+    def stop(self, signum=None, frame=None):
+        """
+        收到 SIGTERM / SIGINT 后停止拉取新消息，执行中的任务最多再执行
+        drain_timeout 秒。串行模式下任务在主线程执行，超时后通过 SIGALRM
+        抛出 WorkerShutdown 中断任务，事务回滚，消息稍后重新可见
+        """
+        if self.stopping.is_set():
+            return
+        logging.warning('worker stopping, signal: %s', signum)
+        self.stopping.set()
+        if any(lane.pool.size == 1 for lane in self.lanes):
+            signal.alarm(max(int(self.drain_timeout), 1))
+
+    def close(self):
+        signal.alarm(0)
+        deadline = time.time() + self.drain_timeout
+        drained = True
+        for lane in self.lanes:
+            timeout = max(deadline - time.time(), 0)
+            drained = lane.pool.shutdown(timeout) and drained
+        self.acks.close()
+        self.heartbeat.stop()
+        self.log_buffer.close(max(deadline - time.time(), 1))
+        close_db()
+        logging.warning('worker stopped, drained: %s', drained)
+        return drained
+
 
-            if 'action' in message:
-                message_action = message.get('action', '').lower()
-                message_payload = message.get('payload', {})
-
-                action_funcs = actions.get(message_action, [])
-
-                for action_func in action_funcs:
-                    start = time.time()
-                    logging.info('aws sqs message receive: %s %s', msg_id, message)
-                    worker = worker_create(msg_id, message_action,
-                                           message_payload, receipt_handle)
-                    try:
-                        action_func(message_payload, msg_id)
-                        logging.info('message process done: %s func: %s',
-                                     msg_id, action_func.__name__)
-                        worker_done(worker, start)
-                    except:  # noqa
-                        logging.exception('message process failed: %s func: %s',
-                                          msg_id, action_func.__name__)
-                        worker_failed(worker, start,
-                                      traceback.format_exc(), receipt_handle)
+def loop(until_empty=False):
+    """
+    - until_empty: 所有队列都没有消息且没有执行中的任务时返回，用于本地回放压测
+    """
+    client = get_client('sqs')
+    runtime = WorkerRuntime(client)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, runtime.stop)
+        signal.signal(signal.SIGINT, runtime.stop)
+        signal.signal(signal.SIGALRM, _raise_shutdown)
+    metrics_port = app.config.get('worker.metrics_port')
+    if metrics_port:
+        serve_metrics(metrics_port)
+        logging.info('worker metrics server listen on %s', metrics_port)
+    for lane in runtime.lanes:
+        logging.info('worker lane %s: %s, weight: %s, pool size: %s',
+                     lane.lane.value, lane.url, lane.weight, lane.pool.size)
+
+    try:
+        while not runtime.stopping.is_set():
+            wait_time_seconds = int(app.config['aws.sqs.wait_time_seconds'])
+            max_number = int(app.config.get('aws.sqs.max_number_of_messages',
+                                            DeleteBatch.MAX_BATCH))
+            if len(runtime.lanes) == 1:
+                lane = runtime.lanes[0]
+                free = lane.pool.available()
+                if free:
+                    count = receive_messages(runtime, lane,
+                                             min(max_number, free),
+                                             wait_time_seconds)
+                    if not count and until_empty and runtime.idle():
                         break
-                    finally:
-                        if not db.is_closed():
-                            db.close()
                 else:
-                    delete_message(client, query_url, receipt_handle)
+                    lane.pool.wait_available(1)
+                continue
+
+            # 加权轮询：每轮按权重依次短轮询各通道，通道为空时提前结束
+            completed = runtime.completed()
+            polled = received = 0
+            for lane in runtime.lanes:
+                for _ in range(lane.weight):
+                    free = lane.pool.available()
+                    if not free or runtime.stopping.is_set():
+                        break
+                    polled += 1
+                    count = receive_messages(runtime, lane,
+                                             min(max_number, free), 0)
+                    received += count
+                    if not count:
+                        break
+
+            if received:
+                continue
+            if until_empty and runtime.idle():
+                break
+            # 所有通道都没有消息时长轮询权重最高的通道
+            lane = runtime.lanes[0]
+            if polled and lane.pool.available():
+                receive_messages(runtime, lane,
+                                 min(max_number, lane.pool.available()),
+                                 wait_time_seconds)
+            else:
+                # 线程都在忙，等有任务完成再轮询，最多等 1 秒
+                runtime.wait_completed(completed, 1)
+    finally:
+        drained = runtime.close()
+    return drained
+
+
+def receive_messages(runtime, lane, max_number, wait_time_seconds):
+    start = time.time()
+    resp = runtime.client.receive_message(
+        QueueUrl=lane.url,
+        MaxNumberOfMessages=max_number,
+        WaitTimeSeconds=wait_time_seconds)
+    raw_messages = resp.get('Messages', [])
+    receive_time = diff_end_time(start)
+    if raw_messages and runtime.stopping.is_set():
+        # 停止过程中收到的消息马上放回队列，不等可见性超时
+        release_messages(runtime.client, lane.url, raw_messages)
+        return 0
+    metrics.inc('bomber_worker_received_total', {'lane': lane.lane.value},
+                len(raw_messages), help_text='Messages received from queue')
+
+    start = time.time()
+    deferred = []
+    for i, raw_message in enumerate(raw_messages):
+        if runtime.stopping.is_set():
+            release_messages(runtime.client, lane.url, raw_messages[i:])
+            break
+        reserved, limit = runtime.reserve(raw_message)
+        if not reserved:
+            deferred.append(raw_message)
+            continue
+        lane.pool.submit(process_message, runtime, lane.url, raw_message,
+                         limit)
+    if deferred:
+        # action 并发已满，不占用线程等待，稍后重新投递
+        metrics.inc('bomber_worker_deferred_total', {'lane': lane.lane.value},
+                    len(deferred),
+                    help_text='Messages deferred by action concurrency')
+        release_messages(runtime.client, lane.url, deferred,
+                         runtime.defer_seconds)
+
+    if raw_messages:
+        # 线程池模式下 submit 马上返回，速率按实际处理完成的消息数计算
+        completed, spent = lane.throughput()
+        logging.info('sqs batch %s: %s msgs, receive: %ss, submit: %ss, '
+                     'completed: %s msgs in %.3fs, rate: %.2f msg/s',
+                     lane.lane.value, len(raw_messages), receive_time,
+                     diff_end_time(start), completed, spent,
+                     completed / max(spent, 0.001))
+    return len(raw_messages)
+
+
+def release_messages(client, query_url, raw_messages, timeout=0):
+    for raw_message in raw_messages:
+        try:
+            client.change_message_visibility(
+                QueueUrl=query_url,
+                ReceiptHandle=raw_message['ReceiptHandle'],
+                VisibilityTimeout=timeout)
+        except Exception as e:
+            logging.error('release sqs msg %s error: %s',
+                          raw_message['ReceiptHandle'], str(e))
+
+
+def process_message(runtime, query_url, raw_message, limit=None):
+    """ limit: receive_messages 中为该消息占用的 action 并发名额 """
+    try:
+        _process_message(runtime, query_url, raw_message)
+    finally:
+        if limit is not None:
+            limit.release()
+
+
+def _process_message(runtime, query_url, raw_message):
+    acks = runtime.acks
+    try:
+        receipt_handle, msg_id, message = parse_message(raw_message)
+    except json.decoder.JSONDecodeError:
+        acks.add(query_url, raw_message['ReceiptHandle'])
+        return
+
+    logging.debug('aws sqs message receive: %s %s', msg_id, message)
+
+    if isinstance(message, str):
+        try:
+            message = json.loads(message)
+        except json.decoder.JSONDecodeError:
+            acks.add(query_url, receipt_handle)
+            return
+
+    if 'action' not in message:
+        return
+
+    message_action = message.get('action', '').lower()
+    message_payload = message.get('payload', {})
+
+    action_funcs = actions.get(message_action, [])
+    options = action_options.get(message_action, {})
+    # 需要在执行时读到自己 WorkerLog 的 action 仍然同步写库
+    log_buffer = None if options.get('sync_log') else runtime.log_buffer
+
+    dedup_keys = [runtime.idempotency.message_key(message_action, msg_id)]
+    if options.get('dedup_content'):
+        dedup_keys.append(runtime.idempotency.content_key(message_action,
+                                                          message_payload))
+    if runtime.idempotency.processed(dedup_keys):
+        logging.info('skip duplicated message: %s %s', msg_id, message_action)
+        metrics.inc('bomber_worker_duplicated_total',
+                    {'action': message_action},
+                    help_text='Redelivered messages skipped')
+        acks.add(query_url, receipt_handle)
+        return
+    if not runtime.idempotency.claim(dedup_keys):
+        # 同样的消息正在执行，结果未知，不删除，可见性超时后重新投递
+        logging.info('duplicated message running: %s %s',
+                     msg_id, message_action)
+        metrics.inc('bomber_worker_running_duplicated_total',
+                    {'action': message_action},
+                    help_text='Messages left for redelivery while running')
+        return
+
+    max_duration = options.get('max_duration')
+    if max_duration:
+        runtime.heartbeat.register(query_url, receipt_handle, max_duration)
+
+    succeeded = False
+    try:
+        for action_func in action_funcs:
+            start = time.time()
+            logging.info('aws sqs message receive: %s %s', msg_id, message)
+            worker = worker_create(msg_id, message_action,
+                                   message_payload, receipt_handle,
+                                   sync=log_buffer is None)
+            labels = {'action': message_action, 'func': action_func.__name__}
+            metrics.gauge_add('bomber_worker_action_inflight', labels, 1,
+                              help_text='Actions being executed')
+            try:
+                action_func(message_payload, msg_id)
+                logging.info('message process done: %s func: %s',
+                             msg_id, action_func.__name__)
+                worker_done(worker, start, log_buffer)
+                action_finished(labels, start, WorkerResult.DONE)
+            except:  # noqa
+                logging.exception('message process failed: %s func: %s',
+                                  msg_id, action_func.__name__)
+                worker_failed(worker, start, traceback.format_exc(),
+                              receipt_handle, log_buffer)
+                action_finished(labels, start, WorkerResult.FAILED)
+                break
+            finally:
+                metrics.gauge_add('bomber_worker_action_inflight', labels, -1)
+                close_db()
+        else:
+            succeeded = True
+            runtime.idempotency.done(dedup_keys, message_action)
+            acks.add(query_url, receipt_handle)
+    finally:
+        # 失败的消息只释放进程内的占用，重新投递时可以再次执行
+        if not succeeded:
+            runtime.idempotency.release(dedup_keys)
+        if max_duration:
+            runtime.heartbeat.unregister(receipt_handle)
+
+
+def action_finished(labels, start, result):
+    metrics.observe('bomber_worker_action_seconds', time.time() - start,
+                    labels, help_text='Action execution time in seconds')
+    metrics.inc('bomber_worker_action_total',
+                dict(labels, result=result.name.lower()),
+                help_text='Actions executed by result')
+
+
+def close_db():
+    # peewee 的连接是线程独享的，这里只关闭当前线程的连接
+    for database in (db, readonly_db, db_auto_call, readonly_db_auto_call):
+        if not database.is_closed():
+            database.close()
 
 
 def delete_message(client, query_url, receipt_handle):
@@ -95,29 +728,42 @@ def delete_message(client, query_url, receipt_handle):
     logging.info('delete sqs msg %s resp: %s', receipt_handle, delete_resp)
 
 
-def worker_create(msg_id, message_action, message_payload, receipt_handle):
-    worker = WorkerLog.create(message_id=msg_id,
-                              action=message_action,
-                              payload=str(message_payload),
-                              receipt_handle=receipt_handle)
+def worker_create(msg_id, message_action, message_payload, receipt_handle,
+                  sync=True):
+    worker = WorkerLog(message_id=msg_id,
+                       action=message_action,
+                       payload=str(message_payload),
+                       receipt_handle=receipt_handle)
+    if sync:
+        worker.save(force_insert=True)
     return worker
 
 
-def worker_failed(worker, start, error_traceback=None, receipt_handle=None):
+def worker_failed(worker, start, error_traceback=None, receipt_handle=None,
+                  log_buffer=None):
     worker.time_spent = diff_end_time(start)
     worker.result = WorkerResult.FAILED.value
     worker.traceback = error_traceback
     worker.receipt_handle = receipt_handle
-    worker.save()
+    worker_save(worker, log_buffer)
 
 
-def worker_done(worker, start):
+def worker_done(worker, start, log_buffer=None):
     worker.time_spent = diff_end_time(start)
     worker.result = WorkerResult.DONE.value
-    worker.save()
+    worker_save(worker, log_buffer)
+
+
+def worker_save(worker, log_buffer=None):
+    if log_buffer is None:
+        worker.save()
+    else:
+        log_buffer.add(worker)
 
 
 if __name__ == '__main__':
     init_app()
     logging.warning('worker start up success. version {}'.format('2.10.15'))
-    loop()
+    if not loop():
+        # 超时未完成的线程无法中断，直接退出，未删除的消息会重新投递
+        os._exit(1)
@@ -0,0 +1,169 @@
+"""
+在合成的联系人图上对比 drop_duplicated_contact 原来在内存中去重的做法和
+bomber.contact_dedup 的分组处理，并校验两者结果一致
+
+    python scripts/bench_contact_dedup.py [numbers] [degree] [hub_degree]
+
+- numbers: 图中号码个数，默认 2000
+- degree: 普通号码的联系人个数，默认 20
+- hub_degree: 被去重的中心号码的联系人个数，默认 100000
+
+mongo 中的 $sort/$group 在这里用 python 模拟，只比较 worker 端的耗时和内存
+"""
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from copy import deepcopy
+from itertools import count
+
+from bomber.contact_dedup import resolve_contact_edges
+
+SOURCES = [0, 1, 2, 20, 21, 60, 61]
+
+
+def make_graph(numbers=2000, degree=20, hub_degree=100000):
+    ids = count(1)
+    durations = count(1)
+    phones = ['8%010d' % i for i in range(int(numbers))]
+    hub = phones[0]
+
+    def doc(sn, dn, s, is_c):
+        return {'_id': next(ids), 'sn': sn, 'dn': dn, 's': s,
+                'sa': 'name %s' % sn, 'da': 'name %s' % dn,
+                'tc': random.randint(1, 50), 'td': next(durations),
+                'is_c': is_c}
+
+    docs = []
+    for sn in phones[1:]:
+        for dn in random.sample(phones, int(degree)):
+            s = random.choice(SOURCES)
+            docs.append(doc(sn, dn, s, False))
+            # 部分号码有重复记录和反转记录
+            if random.random() < 0.3:
+                docs.append(doc(sn, dn, s, False))
+            if random.random() < 0.3:
+                docs.append(doc(dn, sn, s, True))
+    for _ in range(int(hub_degree)):
+        dn = random.choice(phones)
+        s = random.choice(SOURCES)
+        docs.append(doc(hub, dn, s, random.random() < 0.2))
+        if random.random() < 0.5:
+            docs.append(doc(dn, hub, s, random.random() < 0.5))
+    return hub, docs
+
+
+def legacy(docs):
+    """ drop_duplicated_contact 原来的实现 """
+    contact_list = defaultdict(list)
+    delete_list = []
+    insert_list = []
+    for c in docs:
+        if c['sn'] == c['dn']:
+            delete_list.append(c['_id'])
+
+        key = c['sn'], c['dn'], c['s']
+        contact_list[key].append({
+            'id': c['_id'],
+            'src_number': c['sn'],
+            'dest_number': c['dn'],
+            'total_count': c['tc'],
+            'total_duration': c['td'],
+            'is_calc': c['is_c'],
+            'source': c['s'],
+            'src_name': c['sa'],
+            'dest_name': c['da']
+        })
+
+    contact_list2 = deepcopy(contact_list)
+    for key, info in contact_list.items():
+        _info = sorted(info,
+                       key=lambda x: (not x['is_calc'],
+                                      x['total_count'],
+                                      x['total_duration']),
+                       reverse=True)
+        rs = _info[0]
+        if not rs['is_calc']:
+            contact_list2[(key[1], key[0], key[2])].append({
+                'src_number': rs['dest_number'],
+                'dest_number': rs['src_number'],
+                'total_count': rs['total_count'],
+                'total_duration': rs['total_duration'],
+                'is_calc': True,
+                'source': rs['source'],
+                'id': '',
+                'src_name': rs['dest_name'],
+                'dest_name': rs['src_name']
+            })
+            delete_ids = [i['id'] for i in _info[1:] if i['id']]
+            delete_list.extend(delete_ids)
+
+    for key, info in contact_list2.items():
+        _info = sorted(info,
+                       key=lambda x: (not x['is_calc'],
+                                      x['total_count'],
+                                      x['total_duration']),
+                       reverse=True)
+        rs = _info[0]
+        if not rs['is_calc']:
+            continue
+        if not rs['id']:
+            rs.pop('id')
+            insert_list.append(rs)
+
+        delete_ids = [i['id'] for i in _info[1:] if i['id']]
+        delete_list.extend(delete_ids)
+    return delete_list, insert_list
+
+
+def pipeline_groups(docs):
+    """ 模拟 dedup_pipeline 的输出 """
+    groups = defaultdict(list)
+    for c in sorted(docs, key=lambda x: (x['is_c'], -x['tc'], -x['td'])):
+        groups[c['sn'], c['dn'], c['s']].append(c)
+    pairs = defaultdict(list)
+    for (sn, dn, s), group in groups.items():
+        pairs[min(sn, dn), max(sn, dn), s].append(
+            {'best': group[0], 'ids': [c['_id'] for c in group]})
+    return pairs.values()
+
+
+def measure(name, func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    spent = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logging.warning('%-10s %.3fs, peak %.1f MB', name, spent, peak / 2 ** 20)
+    return result
+
+
+def normalize(result):
+    delete_list, insert_list = result
+    inserts = {(c['src_number'], c['dest_number'], c['source'],
+                c['total_count'], c['total_duration']) for c in insert_list}
+    return set(delete_list), inserts
+
+
+def bench(numbers=2000, degree=20, hub_degree=100000):
+    hub, docs = make_graph(numbers, degree, hub_degree)
+    # drop_duplicated_contact({'numbers': [hub]}) 读取的记录
+    matched = [c for c in docs if hub in (c['sn'], c['dn'])]
+    logging.warning('%s documents, %s touch the hub', len(docs), len(matched))
+
+    old = measure('legacy', legacy, matched)
+    # mongo 中完成分组，worker 只处理分组后的结果
+    groups = list(pipeline_groups(matched))
+    new = measure('grouped', lambda: [resolve_contact_edges(edges)
+                                      for edges in groups])
+    new = ([i for d, _ in new for i in d], [c for _, ins in new for c in ins])
+    assert normalize(old) == normalize(new), 'results differ'
+    logging.warning('results match: delete %s, insert %s',
+                    len(set(old[0])), len(old[1]))
+
+
+if __name__ == '__main__':
+    bench(*map(int, sys.argv[1:4]))
@@ -0,0 +1,54 @@
+"""
+对比 bomber.utils.number_strip 和 bomber.phone 的号码规范化耗时
+
+    python scripts/bench_phone.py [count] [distinct]
+
+- count: 规范化的号码总数，默认 100000
+- distinct: 其中不同号码的个数，默认 5000，模拟 add_contact 中同一号码反复出现
+"""
+import logging
+import random
+import sys
+import time
+
+from bomber.phone import normalize_number, normalize_numbers
+from bomber.utils import number_strip
+
+FORMATS = ['+62 8%s-%s-%s', '08%s %s %s', '628%s%s%s', '(08%s) %s-%s',
+           '+62-8%s%s%s']
+
+
+def make_numbers(count, distinct):
+    pool = [random.choice(FORMATS) % (random.randint(10, 99),
+                                      random.randint(1000, 9999),
+                                      random.randint(1000, 9999))
+            for _ in range(distinct)]
+    return [random.choice(pool) for _ in range(count)]
+
+
+def timed(name, func, numbers):
+    start = time.perf_counter()
+    func(numbers)
+    spent = time.perf_counter() - start
+    logging.warning('%-22s %.3fs, %.0f numbers/s', name, spent,
+                    len(numbers) / max(spent, 1e-9))
+
+
+def bench(count=100000, distinct=5000):
+    numbers = make_numbers(int(count), int(distinct))
+    normalize_number.cache_clear()
+
+    timed('number_strip', lambda ns: [number_strip(n) for n in ns], numbers)
+    timed('normalize_number', lambda ns: [normalize_number(n) for n in ns],
+          numbers)
+    timed('normalize_numbers', normalize_numbers, numbers)
+    try:
+        import pandas as pd
+    except ImportError:
+        return
+    series = pd.Series(numbers)
+    timed('normalize_numbers(Series)', normalize_numbers, series)
+
+
+if __name__ == '__main__':
+    bench(*sys.argv[1:3])
@@ -0,0 +1,48 @@
+"""
+把 total_contact 中已有的非反转关系导入 contact_edge
+
+    APP_ENV=dev python scripts/build_contact_graph.py [batch_size]
+
+已经存在的边不会被覆盖，可以重复执行，sn == dn 的关系不导入
+"""
+import logging
+import sys
+import time
+
+from bomber.app import init_app
+from bomber import contact_graph
+from bomber.models import TotalContact
+
+
+def build(batch_size=1000):
+    init_app()
+    cursor = (TotalContact
+              ._get_collection()
+              .find({'is_c': {'$ne': True}},
+                    {'sn': 1, 'dn': 1, 'sa': 1, 'da': 1, 's': 1,
+                     'tc': 1, 'td': 1})
+              .batch_size(batch_size))
+
+    start = time.time()
+    count = 0
+    operations = []
+    for c in cursor:
+        edges = contact_graph.add_edge_operations(
+            c.get('sn'), c.get('dn'), c.get('s'), c.get('tc', 1),
+            c.get('td', 0), c.get('sa'), c.get('da'))
+        if not edges:
+            continue
+        operations.extend(edges)
+        count += 1
+        if len(operations) >= batch_size:
+            contact_graph.apply_operations(operations)
+            operations = []
+            logging.warning('%s contacts imported, %.1fs',
+                            count, time.time() - start)
+    contact_graph.apply_operations(operations)
+    logging.warning('done, %s contacts imported in %.1fs',
+                    count, time.time() - start)
+
+
+if __name__ == '__main__':
+    build(*map(int, sys.argv[1:2]))
@@ -0,0 +1,49 @@
+"""
+把抓取的消息回放到本地队列，用真实的 actions 执行并统计吞吐
+
+    APP_ENV=dev python scripts/replay_messages.py messages.jsonl [backend]
+
+- messages.jsonl: 每行一条消息，格式与 sqs 消息体一致，如
+  {"action": "BILL_PAID", "payload": {...}}
+- backend: memory（默认）或 sqlite:<path>
+"""
+import json
+import logging
+import sys
+import time
+
+from bottle import default_app
+
+from bomber.app import init_app
+from bomber.sns import MessageAction, action_queue_url, get_client
+import run_worker
+
+app = default_app()
+
+
+def replay(path, backend='memory'):
+    init_app()
+    app.config['aws.sqs.backend'] = backend
+    client = get_client('sqs')
+
+    count = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            action = MessageAction(message['action'].upper())
+            client.send_message(QueueUrl=action_queue_url(action),
+                                MessageBody=json.dumps(message))
+            count += 1
+
+    start = time.time()
+    run_worker.loop(until_empty=True)
+    spent = time.time() - start
+    logging.warning('replay %s messages in %.3fs, %.2f msg/s',
+                    count, spent, count / max(spent, 0.001))
+
+
+if __name__ == '__main__':
+    replay(sys.argv[1], *sys.argv[2:3])
@@ -0,0 +1,171 @@
+from datetime import datetime
+
+import pytest
+
+from bomber import worker
+from bomber.constant_mapping import (ApplicationStatus, ApplicationType,
+                                     MessageAction)
+from bomber.models import Application, Escalation, OverdueBill
+
+STAGING = ApplicationType.CASH_LOAN_STAGING.value
+CASH_LOAN = ApplicationType.CASH_LOAN.value
+
+
+def sub_bill(id, category, status=1, overdue_days=1):
+    return {'id': id, 'bill_id': id, 'category': category, 'status': status,
+            'overdue_days': overdue_days, 'periods': 1, 'amount': 100,
+            'amount_net': 90, 'interest_rate': 0,
+            'origin_due_at': datetime(2019, 1, 1)}
+
+
+class BillService:
+    bills = [sub_bill(910011, STAGING),
+             sub_bill(910012, STAGING),
+             sub_bill(910021, CASH_LOAN),
+             sub_bill(910031, CASH_LOAN, status=2),
+             sub_bill(910051, STAGING)]
+
+    def sub_bill_list(self, bill_sub_ids):
+        # 接口返回的 id 不一定是整数
+        return [dict(b, id=str(b['id'])) for b in self.bills
+                if b['id'] in bill_sub_ids]
+
+
+class Publisher:
+    messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send_to_default_q(self, action, payload):
+        self.messages.append((action, payload))
+
+
+def fetch_overdue_profile(application_id):
+    return {'user_id': application_id, 'user_mobile_no': '08123456789',
+            'id_name': 'test', 'app': 'DanaCepat', 'device_no': 'device'}, 1
+
+
+@pytest.fixture
+def services(monkeypatch):
+    monkeypatch.setattr(worker, 'BillService', BillService)
+    monkeypatch.setattr(worker, 'fetch_overdue_profile', fetch_overdue_profile)
+    monkeypatch.setattr(worker, 'add_contact', lambda application: None)
+    monkeypatch.setattr(worker, 'idg', lambda: 919999)
+
+
+@pytest.fixture
+def inserted(monkeypatch, services):
+    inserted = []
+    monkeypatch.setattr(worker, 'insert_overdue_applications',
+                        lambda *args: inserted.append(args))
+    return inserted
+
+
+ITEMS = [(910001, 910011), (910001, 910012), (910002, 910021),
+         (910002, 910021), (910003, 910031), (910004, 910041)]
+
+
+def test_applications_overdue_grouping(inserted):
+    result = worker.applications_overdue(ITEMS)
+
+    assert result['created'] == [(910001, 910011), (910001, 910012),
+                                 (910002, 910021)]
+    assert result['skipped'] == [(910003, 910031)]
+    assert [item for item, _ in result['failed']] == [(910004, 910041)]
+
+    # 同一个分期单的两个子账单合并到一个催收单
+    (new_apps, updated_apps, overdue_bills), = inserted
+    assert [(a['id'], a['type'], a['amount']) for a in new_apps] == [
+        (919999, STAGING, 200), (910002, CASH_LOAN, 100)]
+    assert list(updated_apps) == []
+    bills = [(b['collection_id'], b['sub_bill_id']) for b in overdue_bills]
+    assert bills == [(919999, 910011), (919999, 910012), (910002, 910021)]
+
+
+def test_applications_overdue_fallback(inserted, monkeypatch):
+    def insert_failed(*args):
+        raise ValueError('insert failed')
+
+    Publisher.messages = []
+    monkeypatch.setattr(worker, 'insert_overdue_applications', insert_failed)
+    monkeypatch.setattr(worker, 'MessagePublisher', Publisher)
+    result = worker.applications_overdue(ITEMS)
+
+    # 整批写入失败时逐条重新发送 APPLICATION_BOMBER
+    assert result['created'] == []
+    assert Publisher.messages == [
+        (MessageAction.APPLICATION_BOMBER, {'id': id, 'bill_sub_id': sub_id})
+        for id, sub_id in [(910001, 910011), (910001, 910012),
+                           (910002, 910021)]]
+
+
+def test_application_overdue_batch(monkeypatch):
+    batches = []
+
+    def applications_overdue(items):
+        batches.append(items)
+        return {'created': items, 'skipped': [], 'failed': []}
+
+    monkeypatch.setattr(worker, 'applications_overdue', applications_overdue)
+    items = [{'id': str(i), 'bill_sub_id': str(i + 1)} for i in range(120)]
+    worker.application_overdue_batch({'items': items}, 'msg id')
+
+    assert [len(batch) for batch in batches] == [50, 50, 20]
+    assert batches[0][0] == (0, 1)
+
+
+@pytest.fixture
+def staging_app(request):
+    # 线上 overdue_bill 的 id 自增、no_active 默认为 0，模型里没有声明
+    OverdueBill._meta.database.execute_sql(
+        'ALTER TABLE overdue_bill '
+        'MODIFY id INT NOT NULL AUTO_INCREMENT, '
+        'MODIFY no_active INT NOT NULL DEFAULT 0')
+    application = Application.create(
+        id=919001, external_id=910005, type=STAGING, amount=100,
+        amount_net=90, status=ApplicationStatus.UNCLAIMED.value,
+        user_id=910005, user_mobile_no='08123456789', user_name='test',
+        app='DanaCepat', device_no='device')
+
+    def teardown():
+        external_ids = [910001, 910002, 910005]
+        (OverdueBill.delete()
+         .where(OverdueBill.external_id << external_ids).execute())
+        (Escalation.delete()
+         .where(Escalation.application << [919999, 910002]).execute())
+        (Application.delete()
+         .where(Application.external_id << external_ids).execute())
+
+    request.addfinalizer(teardown)
+    return application
+
+
+def test_insert_overdue_applications(services, staging_app):
+    items = [(910005, 910051), (910001, 910011), (910001, 910012),
+             (910002, 910021)]
+    result = worker.applications_overdue(items)
+    assert result['created'] == items
+
+    # 已有的分期催收单累加金额
+    application = Application.get(Application.id == staging_app.id)
+    assert (application.amount, application.amount_net) == (200, 180)
+
+    created = (Application.select()
+               .where(Application.external_id << [910001, 910002])
+               .order_by(Application.id))
+    assert [(a.id, a.type, a.amount) for a in created] == [
+        (910002, CASH_LOAN, 100), (919999, STAGING, 200)]
+    escalations = (Escalation.select()
+                   .where(Escalation.application << [919999, 910002]))
+    assert sorted((e.application_id, e.escalate_to)
+                  for e in escalations) == [(910002, 1), (919999, 1)]
+    bills = (OverdueBill.select()
+             .where(OverdueBill.external_id << [910001, 910002, 910005])
+             .order_by(OverdueBill.sub_bill_id))
+    assert [(b.collection_id, b.sub_bill_id, b.no_active) for b in bills] == [
+        (919999, 910011, 0), (919999, 910012, 0), (910002, 910021, 0),
+        (919001, 910051, 0)]
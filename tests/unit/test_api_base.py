@@ -0,0 +1,152 @@
+import pytest
+
+requests = pytest.importorskip('requests')
+base = pytest.importorskip('bomber.api.base')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000
+        self.delays = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.delays.append(seconds)
+
+
+class Session:
+    def __init__(self):
+        self.results = []
+        self.requests = []
+
+    def request(self, **kwargs):
+        self.requests.append(kwargs)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        response = requests.Response()
+        response.status_code = result
+        response._content = b'{"data": [1]}'
+        return response
+
+
+class API(base.BaseAPI):
+    retries = 2
+    breaker_threshold = 2
+    breaker_cooldown = 30
+    cache_ttls = [(r'^/users/\d+$', 60)]
+
+    def __init__(self, token='token'):
+        self.token = token
+
+    def get_base_url(self):
+        return 'http://api'
+
+    def before_request(self, kwargs):
+        kwargs.setdefault('auth', (self.token, None))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(base, 'time', clock)
+    # 退避时间取上限，方便检查
+    monkeypatch.setattr(base.random, 'uniform', lambda low, high: high)
+    monkeypatch.delitem(base._breakers, API, raising=False)
+    monkeypatch.delitem(base._caches, API, raising=False)
+    return clock
+
+
+@pytest.fixture
+def session(monkeypatch, clock):
+    session = Session()
+    monkeypatch.setitem(base._sessions, API, session)
+    return session
+
+
+def test_retry_backoff(session, clock):
+    session.results = [requests.exceptions.ConnectionError(), 503, 200]
+    assert API().get('/users').status_code == 200
+    assert len(session.requests) == 3
+    assert clock.delays == [0.4, 0.8]
+    assert session.requests[0]['timeout'] == API.timeout
+    assert API._breaker().failures == 0
+
+
+def test_no_retry(session):
+    # POST 不重试，500 不算下游不可用
+    session.results = [503, 500]
+    assert API().post('/users').status_code == 503
+    assert API().post('/users').status_code == 500
+    assert len(session.requests) == 2
+    assert API._breaker().failures == 0
+
+    session.results = [requests.exceptions.Timeout()]
+    with pytest.raises(requests.exceptions.Timeout):
+        API().post('/users')
+    assert API._breaker().failures == 1
+
+
+def test_breaker(session, clock):
+    breaker = API._breaker()
+    # 一次调用重试几次都只记一次失败
+    session.results = [503, 503, 503]
+    assert API().get('/users').status_code == 503
+    assert breaker.failures == 1 and breaker.opened_at is None
+
+    session.results = [requests.exceptions.Timeout()] * 3
+    with pytest.raises(requests.exceptions.Timeout):
+        API().get('/users')
+    assert breaker.failures == 2 and breaker.opened_at == clock.now
+
+    # 熔断期间不请求下游
+    with pytest.raises(base.CircuitOpenError):
+        API().get('/users')
+    assert len(session.requests) == 6
+
+    # 冷却之后放过一个请求试探，失败继续熔断
+    clock.now += 30
+    session.results = [requests.exceptions.ConnectionError()]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        API().post('/users')
+    with pytest.raises(base.CircuitOpenError):
+        API().get('/users')
+
+    # 试探成功后恢复
+    clock.now += 30
+    session.results = [200]
+    assert API().get('/users').ok
+    assert breaker.failures == 0 and breaker.opened_at is None
+
+
+def test_cache(session):
+    session.results = [200, 200, 200, 404]
+    response = API().get('/users/1', params={'a': 1})
+    response.json()['data'].append(2)
+    # 命中缓存时返回新的 Response
+    cached = API().get('/users/1', params={'a': 1})
+    assert cached is not response
+    assert cached.json() == {'data': [1]}
+    assert len(session.requests) == 1
+
+    # 不同 token 和 params 不共用缓存
+    API('other').get('/users/1', params={'a': 1})
+    API().get('/users/1')
+    assert len(session.requests) == 3
+
+    # 不缓存失败的响应和没有配置的接口
+    assert API().get('/users/2').status_code == 404
+    session.results = [200, 200]
+    API().get('/users/2')
+    API().get('/users')
+    assert len(session.requests) == 6
+
+    # invalidate 清理所有调用方的缓存
+    API.invalidate('/users/1', {'a': 1})
+    session.results = [200, 200]
+    API().get('/users/1', params={'a': 1})
+    API('other').get('/users/1', params={'a': 1})
+    API().get('/users/1')
+    assert len(session.requests) == 8
@@ -0,0 +1,99 @@
+import pytest
+
+contact_graph = pytest.importorskip('bomber.contact_graph')
+BulkWriteError = pytest.importorskip('pymongo.errors').BulkWriteError
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.contact_edge
+    collection.create_index([('n', 1), ('c', 1), ('s', 1), ('o', 1)],
+                            unique=True)
+    collection.create_index([('n', 1), ('td', -1)])
+    monkeypatch.setattr(contact_graph.ContactEdge, '_get_collection',
+                        lambda: collection)
+    return collection
+
+
+def test_self_loop():
+    assert contact_graph.add_edge_operations('811', '811', 1) == []
+    assert contact_graph.add_edge_operations('811', None, 1) == []
+    assert contact_graph.sync_edge_operations('811', '811', 1, 1, 0) == []
+    assert len(contact_graph.add_edge_operations('811', '822', 1)) == 2
+
+
+def test_counterparties(collection):
+    contact_graph.apply_operations(
+        contact_graph.add_edge_operations('811', '822', 2, 1, 10, 'a', 'b') +
+        contact_graph.add_edge_operations('833', '811', 1, 3, 30, 'c', 'a') +
+        # 已经存在的边不覆盖
+        contact_graph.add_edge_operations('811', '822', 2, 5, 50, 'a', 'b'))
+
+    assert contact_graph.counterparties('811') == [
+        {'number': '833', 'name': 'c', 'source': 1, 'outgoing': False,
+         'total_count': 3, 'total_duration': 30},
+        {'number': '822', 'name': 'b', 'source': 2, 'outgoing': True,
+         'total_count': 1, 'total_duration': 10},
+    ]
+    assert [e['number'] for e in contact_graph.counterparties('811', [2])] == [
+        '822']
+    assert contact_graph.counterparties('822')[0]['outgoing'] is False
+
+    # 去重后同步通话次数和时长
+    contact_graph.apply_operations(
+        contact_graph.sync_edge_operations('811', '822', 2, 5, 50) +
+        contact_graph.update_weight_operations('833', '811', 4, 40))
+    assert [(e['number'], e['total_count'], e['total_duration'], e['name'])
+            for e in contact_graph.counterparties('811')] == [
+        ('833', 4, 40, 'c'), ('822', 5, 50, 'b')]
+    assert contact_graph.counterparties('822')[0]['total_count'] == 5
+
+
+def test_top_counterparties(collection):
+    contact_graph.apply_operations(
+        contact_graph.add_edge_operations('811', '822', 1, 1, 10) +
+        contact_graph.add_edge_operations('833', '811', 1, 1, 30) +
+        contact_graph.add_edge_operations('811', '844', 2, 1, 20) +
+        contact_graph.add_edge_operations('822', '833', 1, 1, 50))
+
+    assert [(e['number'], e['total_duration'])
+            for e in contact_graph.top_counterparties('811', 2)] == [
+        ('833', 30), ('844', 20)]
+    assert len(contact_graph.top_counterparties('811')) == 3
+
+
+def test_remove_self_loop(collection):
+    collection.insert_many([{'n': '811', 'c': '811', 's': 1, 'o': True},
+                            {'n': '811', 'c': '822', 's': 1, 'o': True}])
+    contact_graph.apply_operations(
+        contact_graph.remove_self_loop_operations(['811']))
+    assert [e['number'] for e in contact_graph.counterparties('811')] == [
+        '822']
+
+
+class DuplicatedCollection:
+    def __init__(self, code):
+        self.code = code
+        self.calls = []
+
+    def bulk_write(self, operations, ordered):
+        self.calls.append(operations)
+        if len(self.calls) == 1:
+            raise BulkWriteError({'writeErrors': [
+                {'index': 1, 'code': self.code, 'errmsg': 'error'}]})
+        return 'retried'
+
+
+def test_duplicated_retry(monkeypatch):
+    collection = DuplicatedCollection(contact_graph.DUPLICATE_KEY)
+    monkeypatch.setattr(contact_graph.ContactEdge, '_get_collection',
+                        lambda: collection)
+    operations = contact_graph.add_edge_operations('811', '822', 1)
+    # 并发写入同一条边时只重试重复 key 的操作
+    assert contact_graph.apply_operations(operations) == 'retried'
+    assert collection.calls == [operations, operations[1:]]
+
+    collection = DuplicatedCollection(121)
+    with pytest.raises(BulkWriteError):
+        contact_graph.apply_operations(operations)
@@ -0,0 +1,112 @@
+from contextlib import contextmanager
+
+import pytest
+
+
+class Field:
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return self.name, '=', other
+
+    def __lshift__(self, other):
+        return self.name, 'in', other
+
+
+class Query:
+    def __init__(self, contact, **kwargs):
+        self.contact = contact
+        self.kwargs = kwargs
+
+    def where(self, *conditions):
+        return self
+
+    def tuples(self):
+        return [(number,) for number in self.contact.numbers]
+
+    def execute(self):
+        self.contact.executed.append(self.kwargs)
+
+
+class FakeContact:
+    number = Field('number')
+    user_id = Field('user_id')
+
+    def __init__(self, numbers):
+        self.numbers = numbers
+        self.executed = []
+
+    def select(self, *fields):
+        return Query(self)
+
+    def insert_many(self, rows):
+        return Query(self, rows=rows)
+
+    def update(self, **kwargs):
+        return Query(self, **kwargs)
+
+
+class FakeDB:
+    @contextmanager
+    def atomic(self):
+        yield
+
+
+@pytest.fixture
+def upsert(monkeypatch):
+    module = pytest.importorskip('bomber.contact_upsert')
+    contact = FakeContact(['+62 812-1111', '08122222'])
+    monkeypatch.setattr(module, 'Contact', contact)
+    monkeypatch.setattr(module, 'db', FakeDB())
+    # CASE 表达式用 dict 代替，方便检查
+    monkeypatch.setattr(module, 'Case', lambda field, pairs: dict(pairs))
+    monkeypatch.setattr(module, 'CHUNK_SIZE', 2)
+    return module.ContactUpsert(1), contact
+
+
+def test_dedup(upsert):
+    upsert, contact = upsert
+    # 已有的号码规范化后去重
+    assert upsert.add('08121111', 'a', 0, 'test') is None
+    assert upsert.add('8122222', 'b', 0, 'test') is None
+    assert upsert.add('0812-3333', 'c', 0, 'test') == '8123333'
+    assert upsert.add('+628123333', 'd', 0, 'test') is None
+    assert upsert.add(None, 'e', 0, 'test') is None
+    assert upsert.exists('8123333')
+
+    assert upsert.flush() == {'inserted': 1, 'updated': 0, 'skipped': 4}
+    rows, = [executed['rows'] for executed in contact.executed]
+    assert [(row['number'], row['name']) for row in rows] == [('8123333', 'c')]
+    # 写入后的号码也会去重
+    assert upsert.add('8123333', 'f', 0, 'test') is None
+
+
+def test_update_frequency(upsert):
+    upsert, contact = upsert
+    upsert.add('8123333', 'c', 0, 'test')
+    assert upsert.update_frequency('8123333', 3, 30) == '8123333'
+    assert upsert.update_frequency('0812 1111', 5, 50) == '8121111'
+    assert upsert.update_frequency('8129999', 1, 1) is None
+
+    assert upsert.flush() == {'inserted': 1, 'updated': 1, 'skipped': 0}
+    insert, update = contact.executed
+    assert insert['rows'][0]['total_count'] == 3
+    # 更新的是库里原来的号码
+    assert update == {'total_count': {'+62 812-1111': 5},
+                      'total_duration': {'+62 812-1111': 50}}
+
+
+def test_chunk(upsert):
+    upsert, contact = upsert
+    for i in range(5):
+        upsert.add('81230000%s' % i, 'c', 0, 'test')
+    upsert.update_frequency('8121111', 1, 10)
+    upsert.update_frequency('8122222', 2, 20)
+    upsert.flush()
+    assert upsert.flush() == {'inserted': 0, 'updated': 0, 'skipped': 0}
+
+    sizes = [len(executed.get('rows', executed.get('total_count')))
+             for executed in contact.executed]
+    assert sizes == [2, 2, 1, 2]
+    assert upsert.total == {'inserted': 5, 'updated': 2, 'skipped': 0}
@@ -0,0 +1,74 @@
+import pytest
+
+from bomber.cycle_policy import (
+    ENTRY_FIELDS,
+    cycle_case,
+    cycle_end_day,
+    cycle_of,
+    cycles_of,
+    entry_field,
+)
+
+# 原来 get_cycle_by_overdue_days 中的配置
+CYCLE_DAYS = {
+    1: [1, 10],
+    2: [11, 30],
+    3: [31, 60],
+    4: [61, 90],
+    5: [91, 999999],
+}
+
+# 原来 calc_entry_time 中的配置
+ENTRY_DAYS = {
+    'dpd1_entry': [1, 3],
+    'C1A_entry': [4, 10],
+    'C1B_entry': [11, 30],
+    'C2_entry': [31, 60],
+    'C3_entry': [61, 90],
+}
+
+DAYS = list(range(-3, 200)) + [999998, 999999, 1000000]
+
+
+def _scan(conf, days, default):
+    for key, (start, end) in conf.items():
+        if start <= days <= end:
+            return key
+    return default
+
+
+def test_cycle_of():
+    for days in DAYS:
+        assert cycle_of(days) == _scan(CYCLE_DAYS, days, 0)
+        assert cycle_of(days, default=-1) == _scan(CYCLE_DAYS, days, -1)
+
+
+def test_cycles_of_list():
+    assert cycles_of(DAYS) == [cycle_of(days) for days in DAYS]
+
+
+def test_cycles_of_numpy():
+    np = pytest.importorskip('numpy')
+    cycles = cycles_of(np.array(DAYS))
+    assert cycles.tolist() == [cycle_of(days) for days in DAYS]
+
+
+def test_entry_field():
+    for days in DAYS:
+        assert entry_field(days) == _scan(ENTRY_DAYS, days, None)
+    assert set(ENTRY_DAYS) == {field for field in ENTRY_FIELDS if field}
+
+
+def test_cycle_end_day():
+    assert [cycle_end_day(cycle) for cycle in range(1, 5)] == [10, 30, 60, 90]
+    assert cycle_end_day(5, '90 + t1.overdue_days') == '90 + t1.overdue_days'
+
+
+def test_cycle_case():
+    peewee = pytest.importorskip('peewee')
+    db = peewee.SqliteDatabase(':memory:')
+    for days in DAYS:
+        case = cycle_case(peewee.SQL(str(days)), default=-1)
+        sql, params = db.compiler().parse_node(case)
+        result, = db.execute_sql('SELECT %s' % sql, params).fetchone()
+        assert result == cycle_of(days, default=-1)
@@ -0,0 +1,41 @@
+import pytest
+
+idempotency = pytest.importorskip('bomber.idempotency')
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.processed_message
+    monkeypatch.setattr(idempotency.ProcessedMessage, '_get_collection',
+                        lambda: collection)
+    return collection
+
+
+def test_done_after_success(collection):
+    store = idempotency.IdempotencyStore(ttl=60)
+    keys = ['msg:a:1', 'content:a:x']
+    assert not store.processed(keys)
+    assert store.claim(keys)
+    # 执行中只占用进程内的 key，内容相同的消息不能马上执行，也不能删除
+    assert collection.count_documents({}) == 0
+    assert not store.claim(['msg:a:2', 'content:a:x'])
+    assert not store.processed(['msg:a:2', 'content:a:x'])
+
+    store.done(keys, 'a')
+    assert store.processed(['msg:a:2', 'content:a:x'])
+    # 其他进程从 mongo 中读到记录
+    other = idempotency.IdempotencyStore(ttl=60)
+    assert other.processed(['msg:a:1'])
+    other.done(['msg:a:1'], 'a')
+    assert collection.count_documents({}) == 2
+
+
+def test_release_on_failure(collection):
+    store = idempotency.IdempotencyStore(ttl=60)
+    keys = ['msg:a:1']
+    assert store.claim(keys)
+    store.release(keys)
+    # 失败或进程被杀掉时没有记录，重新投递的消息会再次执行
+    assert not store.processed(keys)
+    assert store.claim(keys)
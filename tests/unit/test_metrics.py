@@ -0,0 +1,95 @@
+import json
+import os
+
+import pytest
+
+from bomber.metrics import MetricsRegistry, SnapshotWriter, render_all
+
+
+def test_render():
+    registry = MetricsRegistry()
+    registry.inc('requests_total', {'route': '/a'}, help_text='Requests')
+    registry.inc('requests_total', {'route': '/a'}, value=2)
+    registry.gauge_set('inflight', 3)
+    registry.observe('seconds', 0.3, buckets=(0.1, 1))
+
+    text = registry.render()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{route="/a"} 3.0' in text
+    assert 'inflight 3.0' in text
+    assert 'seconds_bucket{le="0.1"} 0' in text
+    assert 'seconds_bucket{le="1.0"} 1' in text
+    assert 'seconds_bucket{le="+Inf"} 1' in text
+    assert 'seconds_count 1' in text
+
+
+def test_snapshot_merge():
+    first, second = MetricsRegistry(), MetricsRegistry()
+    for registry in (first, second):
+        registry.inc('requests_total', {'route': '/a'})
+        registry.gauge_set('inflight', 1)
+        registry.observe('seconds', 0.3, buckets=(0.1, 1))
+
+    merged = MetricsRegistry()
+    merged.merge(json.loads(json.dumps(first.snapshot())))
+    merged.merge(json.loads(json.dumps(second.snapshot())), gauges=False)
+
+    text = merged.render()
+    assert 'requests_total{route="/a"} 2.0' in text
+    assert 'inflight 1.0' in text
+    assert 'seconds_bucket{le="1.0"} 2' in text
+    assert 'seconds_sum 0.6' in text
+
+
+def test_render_all(tmp_path):
+    other = MetricsRegistry()
+    other.inc('requests_total')
+    other.gauge_set('inflight', 5)
+    writer = SnapshotWriter(str(tmp_path), registry=other)
+    writer.write()
+    # 当作另一个进程写的文件
+    os.rename(os.path.join(str(tmp_path), 'metrics-%s.json' % os.getpid()),
+              os.path.join(str(tmp_path), 'metrics-1.json'))
+
+    own = MetricsRegistry()
+    own.inc('requests_total')
+    text = render_all(str(tmp_path), registry=own)
+    assert 'requests_total 2.0' in text
+    assert 'inflight 5.0' in text
+
+    # 很久没有更新的进程不再计入 gauge
+    os.utime(os.path.join(str(tmp_path), 'metrics-1.json'), (0, 0))
+    text = render_all(str(tmp_path), registry=own)
+    assert 'requests_total 2.0' in text
+    assert 'inflight' not in text
+
+
+def test_metrics_plugin(monkeypatch):
+    bottle = pytest.importorskip('bottle')
+    plugin = pytest.importorskip('bomber.plugins.metrics_plugin')
+
+    registry = MetricsRegistry()
+    monkeypatch.setattr(plugin, 'registry', registry)
+    app = bottle.Bottle()
+    app.install(plugin.metrics_plugin)
+
+    @app.get('/ok/<id>')
+    def ok(id):
+        return 'ok'
+
+    @app.get('/boom')
+    def boom():
+        raise ValueError()
+
+    for path in ('/ok/1', '/ok/2', '/boom'):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'wsgi.errors': open(os.devnull, 'w')}
+        app(environ, lambda status, headers, exc_info=None: None)
+
+    text = registry.render()
+    assert ('bomber_http_requests_total'
+            '{method="GET",route="/ok/<id>",status="200"} 2.0') in text
+    assert ('bomber_http_requests_total'
+            '{method="GET",route="/boom",status="500"} 1.0') in text
+    assert ('bomber_http_request_seconds_count'
+            '{method="GET",route="/ok/<id>"} 2') in text
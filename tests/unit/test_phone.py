@@ -0,0 +1,51 @@
+import pytest
+
+from bomber.phone import normalize_number, normalize_numbers
+
+# 印尼号码的常见写法：国际区号、本地 0 开头、固话、带分隔符和说明文字
+NUMBERS = [
+    ('+62 812-3456-7890', '81234567890'),
+    ('+6281234567890', '81234567890'),
+    ('6281234567890', '81234567890'),
+    ('081234567890', '81234567890'),
+    ('0812 3456 7890', '81234567890'),
+    ('(0812) 3456-7890', '81234567890'),
+    ('0062 812 3456 7890', '6281234567890'),
+    ('+62 (021) 5020 2889', '2150202889'),
+    ('021-5020-2889 ext. 12', '215020288912'),
+    ('02150202889', '2150202889'),
+    ('6262812345678', '62812345678'),
+    ('+86 138 0013 8000', '13800138000'),
+    ('+8662812345678', '812345678'),
+    ('8612345678', '8612345678'),
+    ('62', ''),
+    ('000', ''),
+    ('tidak ada', ''),
+    ('', ''),
+]
+
+
+@pytest.mark.parametrize('number, expected', NUMBERS)
+def test_normalize_number(number, expected):
+    assert normalize_number(number) == expected
+
+
+def test_same_as_number_strip():
+    from bomber.utils import number_strip
+
+    for number, _ in NUMBERS:
+        assert normalize_number(number) == number_strip(number)
+
+
+def test_normalize_numbers():
+    numbers = [number for number, _ in NUMBERS] * 2
+    expected = [normalized for _, normalized in NUMBERS] * 2
+    assert normalize_numbers(numbers) == expected
+
+
+def test_normalize_numbers_series():
+    pd = pytest.importorskip('pandas')
+
+    numbers = [number for number, _ in NUMBERS]
+    result = normalize_numbers(pd.Series(numbers))
+    assert list(result) == [normalized for _, normalized in NUMBERS]
@@ -0,0 +1,54 @@
+import pytest
+
+from bomber.queue_backend import MemoryQueue, SQLiteQueue
+
+URL = 'local://bomber'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def queue(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryQueue(visibility_timeout=30)
+    return SQLiteQueue(str(tmp_path / 'queue.db'), visibility_timeout=30)
+
+
+def test_send_receive_delete(queue):
+    queue.send_message(QueueUrl=URL, MessageBody='a')
+    queue.send_message_batch(QueueUrl=URL, Entries=[
+        {'Id': '0', 'MessageBody': 'b'},
+        {'Id': '1', 'MessageBody': 'c'},
+    ])
+
+    messages = queue.receive_message(QueueUrl=URL,
+                                     MaxNumberOfMessages=10)['Messages']
+    assert [m['Body'] for m in messages] == ['a', 'b', 'c']
+    # 已接收的消息在可见性超时内不会再次返回
+    assert queue.receive_message(QueueUrl=URL) == {}
+
+    queue.delete_message_batch(QueueUrl=URL, Entries=[
+        {'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']}
+        for i, m in enumerate(messages)])
+    assert queue.size(URL) == 0
+
+
+def test_visibility_timeout(queue):
+    queue.send_message(QueueUrl=URL, MessageBody='a')
+    message = queue.receive_message(QueueUrl=URL)['Messages'][0]
+
+    queue.change_message_visibility(QueueUrl=URL,
+                                    ReceiptHandle=message['ReceiptHandle'],
+                                    VisibilityTimeout=0)
+    again = queue.receive_message(QueueUrl=URL)['Messages'][0]
+    assert again['MessageId'] == message['MessageId']
+
+    # 旧的 receipt handle 已失效
+    queue.delete_message(QueueUrl=URL, ReceiptHandle=message['ReceiptHandle'])
+    assert queue.size(URL) == 1
+    queue.delete_message(QueueUrl=URL, ReceiptHandle=again['ReceiptHandle'])
+    assert queue.size(URL) == 0
+
+
+def test_queue_attributes(queue):
+    attributes = queue.get_queue_attributes(
+        QueueUrl=URL, AttributeNames=['VisibilityTimeout'])['Attributes']
+    assert attributes['VisibilityTimeout'] == '30'
@@ -0,0 +1,34 @@
+import pytest
+
+run_worker = pytest.importorskip('run_worker')
+
+
+class Insert:
+    def __init__(self, batches, rows):
+        self.batches = batches
+        self.rows = rows
+
+    def execute(self):
+        self.batches.append(self.rows)
+
+
+def test_mixed_batch(monkeypatch):
+    batches = []
+    monkeypatch.setattr(run_worker.WorkerLog, 'insert_many',
+                        staticmethod(lambda rows: Insert(batches, rows)))
+    monkeypatch.setattr(run_worker, 'close_db', lambda: None)
+    buffer = run_worker.WorkerLogBuffer(batch_size=10, interval=60)
+
+    done = run_worker.worker_create('1', 'test', {}, 'r1', sync=False)
+    run_worker.worker_done(done, 0, buffer)
+    failed = run_worker.worker_create('2', 'test', {}, 'r2', sync=False)
+    run_worker.worker_failed(failed, 0, 'traceback', 'r2', buffer)
+    buffer.close()
+
+    # 成功的日志没有 traceback，也要和失败的日志写入同样的字段
+    rows, = batches
+    assert [set(row) for row in rows] == [set(buffer.FIELDS)] * 2
+    assert [row['traceback'] for row in rows] == [None, 'traceback']
+    result = run_worker.WorkerResult
+    assert [row['result'] for row in rows] == [result.DONE.value,
+                                               result.FAILED.value]